@@ -1,15 +1,46 @@
 import logging
 import sqlite3
 import asyncio
+import argparse
+import bisect
+import csv
+import gzip
+import hashlib
+import heapq
+import html
+import itertools
+import json
+import marshal
+import multiprocessing
+import queue
 import re
 import os
-from typing import Dict, List, Optional
-from aiogram import Bot, Dispatcher, types, F
+import random
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+from aiohttp import web
+from aiogram import Bot, Dispatcher, Router, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import DataNotDictLikeError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import SendSticker
 from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,189 +51,3632 @@ logger = logging.getLogger(__name__)
 
 # Конфигурация
 API_TOKEN =os.getenv("TOKEN")
-ADMIN_USER_IDS = ['']
+ADMIN_USER_IDS = [int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()]
+ITEMS_PER_PAGE = 8  # Количество ассоциаций на странице inline-клавиатуры
+# Адрес Bot API (локальный Bot API сервер или тестовый стенд)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# Количество процессов-обработчиков (больше 1 - режим супервизора)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "64"))
+# Inline-режим: размер страницы (не больше 50), всего результатов на запрос,
+# cache_time для Telegram и время жизни локального кэша запросов
+INLINE_PAGE_SIZE = min(50, max(1, int(os.getenv("INLINE_PAGE_SIZE", "50"))))
+INLINE_MAX_RESULTS = int(os.getenv("INLINE_MAX_RESULTS", "200"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))
+INLINE_CACHE_TTL = float(os.getenv("INLINE_CACHE_TTL", "30"))
+# Поиск с опечатками: расстояние Дамерау-Левенштейна, минимальная длина слова,
+# бюджет времени на исправление одного сообщения (мс)
+FUZZY_MATCHING = os.getenv("FUZZY_MATCHING", "0") == "1"
+FUZZY_MAX_DISTANCE = int(os.getenv("FUZZY_MAX_DISTANCE", "1"))
+FUZZY_MIN_LENGTH = int(os.getenv("FUZZY_MIN_LENGTH", "4"))
+FUZZY_BUDGET_MS = float(os.getenv("FUZZY_BUDGET_MS", "5"))
+# Порт эндпоинта /metrics (0 - выключен); процессы-обработчики слушают следующие порты
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Снимок in-memory индекса ассоциаций для быстрого запуска (пусто - не сохраняется)
+INDEX_SNAPSHOT_PATH = os.getenv("INDEX_SNAPSHOT_PATH", "")
+# Сколько стикеров пробовать отправить на одно сообщение, если Telegram отклоняет file_id
+SEARCH_SEND_ATTEMPTS = int(os.getenv("SEARCH_SEND_ATTEMPTS", "3"))
+# Недействительные file_id: стикер пропускается при поиске BACKOFF секунд, каждая
+# следующая ошибка удваивает срок (не больше MAX_BACKOFF); /deadstickers purge удаляет
+# ассоциации стикеров, не принятых Telegram PURGE_FAILURES раз подряд
+DEAD_STICKER_BACKOFF = int(os.getenv("DEAD_STICKER_BACKOFF", "3600"))
+DEAD_STICKER_MAX_BACKOFF = int(os.getenv("DEAD_STICKER_MAX_BACKOFF", "604800"))
+DEAD_STICKER_PURGE_FAILURES = int(os.getenv("DEAD_STICKER_PURGE_FAILURES", "3"))
+# Фоновая проверка сохранённых file_id через getFile: пауза между проходами
+# в секундах (0 - выключена) и запросов в секунду
+STICKER_VALIDATION_INTERVAL = float(os.getenv("STICKER_VALIDATION_INTERVAL", "0"))
+STICKER_VALIDATION_RATE = float(os.getenv("STICKER_VALIDATION_RATE", "5"))
 
-# Инициализация бота
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+# Состояния для FSM
+class StickerStates(StatesGroup):
+    waiting_for_associations = State()
+    waiting_for_sticker = State()
+    editing_associations = State()
+
+
+# file_id стикеров в памяти процесса
+class StickerTable:
+    """file_id по id из таблицы stickers: каждая строка хранится один раз на процесс"""
+    __slots__ = ('file_ids',)
+
+    def __init__(self):
+        # Позиция - id стикера в базе
+        self.file_ids: List[Optional[str]] = []
+
+    def __len__(self) -> int:
+        return len(self.file_ids)
+
+    def __getitem__(self, ref: int) -> str:
+        return self.file_ids[ref]
+
+    def add(self, ref: int, file_id: str):
+        if ref >= len(self.file_ids):
+            self.file_ids.extend([None] * (ref + 1 - len(self.file_ids)))
+        if self.file_ids[ref] is None:
+            self.file_ids[ref] = file_id
+
+    def to_state(self) -> list:
+        return self.file_ids
+
+    @classmethod
+    def from_state(cls, state: list) -> 'StickerTable':
+        table = cls()
+        table.file_ids = state
+        return table
+
+
+# Столбцы ассоциаций, общие для всех разделов
+class AssociationColumns:
+    """Текст и стикер ассоциации по её id: столбцы вместо словаря кортежей
+
+    id записей уникальны во всей таблице, поэтому позиция в столбце - сам id;
+    на удалённые и чужие для процесса id приходится пустое место (12 байт).
+    """
+    __slots__ = ('stickers', 'refs', 'texts')
+
+    def __init__(self, stickers: Optional[StickerTable] = None):
+        self.stickers = stickers if stickers is not None else StickerTable()
+        self.refs = array('I')
+        # None - записи нет (удалена или ещё не загружена)
+        self.texts: List[Optional[str]] = []
+
+    def text(self, row_id: int) -> Optional[str]:
+        return self.texts[row_id] if row_id < len(self.texts) else None
+
+    def set(self, row_id: int, sticker_ref: int, association: Optional[str]):
+        if row_id >= len(self.texts):
+            grow = row_id + 1 - len(self.texts)
+            self.texts.extend([None] * grow)
+            self.refs.frombytes(bytes(self.refs.itemsize * grow))
+        self.refs[row_id] = sticker_ref
+        self.texts[row_id] = association
+
+    def to_state(self) -> tuple:
+        return self.stickers.to_state(), self.refs.tobytes(), self.texts
+
+    @classmethod
+    def from_state(cls, state: tuple) -> 'AssociationColumns':
+        stickers, refs, texts = state
+        columns = cls(StickerTable.from_state(stickers))
+        columns.refs.frombytes(refs)
+        if len(columns.refs) != len(texts):
+            raise ValueError("refs и texts разной длины")
+        columns.texts = texts
+        return columns
+
+
+# Записи индекса ассоциаций одного раздела
+class AssociationRows:
+    """id -> (sticker_id, association) для записей раздела
+
+    Сами значения лежат в общих AssociationColumns, раздел хранит только
+    отсортированный массив своих id. Удалённые id остаются в нём до уплотнения.
+    """
+    __slots__ = ('columns', 'ids', 'count')
+    COMPACT_RATIO = 0.25
+
+    def __init__(self, columns: AssociationColumns):
+        self.columns = columns
+        self.ids = array('I')
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, row_id: int) -> bool:
+        return self.columns.text(row_id) is not None
+
+    def get(self, row_id: int, default=None) -> Optional[Tuple[str, str]]:
+        text = self.columns.text(row_id)
+        if text is None:
+            return default
+        return self.columns.stickers[self.columns.refs[row_id]], text
+
+    def __getitem__(self, row_id: int) -> Tuple[str, str]:
+        row = self.get(row_id)
+        if row is None:
+            raise KeyError(row_id)
+        return row
+
+    def add(self, row_id: int, sticker_ref: int, association: str) -> bool:
+        """False, если запись уже есть"""
+        if self.columns.text(row_id) is not None:
+            return False
+        self.columns.set(row_id, sticker_ref, association)
+        ids = self.ids
+        if not ids or ids[-1] < row_id:
+            # Новые id больше существующих - обычно это добавление в конец
+            ids.append(row_id)
+        else:
+            pos = bisect.bisect_left(ids, row_id)
+            if ids[pos] != row_id:
+                ids.insert(pos, row_id)
+        self.count += 1
+        return True
+
+    def pop(self, row_id: int, default=None) -> Optional[Tuple[str, str]]:
+        row = self.get(row_id)
+        if row is None:
+            return default
+        self.columns.texts[row_id] = None
+        self.count -= 1
+        if len(self.ids) - self.count > max(1000, self.count * self.COMPACT_RATIO):
+            texts = self.columns.texts
+            self.ids = array('I', [row_id for row_id in self.ids if texts[row_id] is not None])
+        return row
+
+    def __iter__(self):
+        texts = self.columns.texts
+        for row_id in self.ids:
+            if texts[row_id] is not None:
+                yield row_id
+
+    def __reversed__(self):
+        texts = self.columns.texts
+        for row_id in reversed(self.ids):
+            if texts[row_id] is not None:
+                yield row_id
+
+    def items(self):
+        stickers, refs, texts = self.columns.stickers, self.columns.refs, self.columns.texts
+        for row_id in self.ids:
+            text = texts[row_id]
+            if text is not None:
+                yield row_id, (stickers[refs[row_id]], text)
+
+    def to_state(self) -> tuple:
+        return self.ids.tobytes(), self.count
+
+    @classmethod
+    def from_state(cls, state: tuple, columns: AssociationColumns) -> 'AssociationRows':
+        ids, count = state
+        rows = cls(columns)
+        rows.ids.frombytes(ids)
+        rows.count = count
+        return rows
+
+
+# In-memory индекс ассоциаций для поиска по подстроке
+class AssociationIndex:
+    """N-gram индекс по ассоциациям: подстрока -> самая новая ассоциация"""
+    GRAM_SIZES = (2, 3)
+
+    def __init__(self, columns: Optional[AssociationColumns] = None):
+        # id -> (sticker_id, association) в порядке id
+        self.rows = AssociationRows(columns if columns is not None else AssociationColumns())
+        # n-грамма -> отсортированный массив id ассоциаций, содержащих её
+        self.grams: Dict[str, array] = {}
+        # Текст ассоциации -> id строк с ним (у разных стикеров)
+        self.by_text: Dict[str, List[int]] = {}
+        # Различные тексты по алфавиту для поиска по префиксу; при массовой загрузке
+        # дописываются в конец и сортируются один раз в sort_texts
+        self._texts: List[str] = []
+        self._texts_sorted = False
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @classmethod
+    def _grams(cls, text: str):
+        """Все n-граммы строки для индексируемых длин"""
+        for n in cls.GRAM_SIZES:
+            for i in range(len(text) - n + 1):
+                yield text[i:i + n]
+
+    def add(self, row_id: int, sticker_ref: int, association: str):
+        """Добавление ассоциации в индекс (sticker_ref - id стикера в таблице stickers)"""
+        # Одинаковые тексты у разных стикеров и разделов - один объект строки
+        association = sys.intern(association)
+        if not self.rows.add(row_id, sticker_ref, association):
+            return
+
+        for gram in set(self._grams(association)):
+            postings = self.grams.get(gram)
+            if postings is None:
+                self.grams[gram] = array('I', (row_id,))
+            elif postings[-1] < row_id:
+                postings.append(row_id)
+            else:
+                bisect.insort(postings, row_id)
+
+        ids = self.by_text.get(association)
+        if ids is None:
+            self.by_text[association] = [row_id]
+            if self._texts_sorted:
+                bisect.insort(self._texts, association)
+            else:
+                self._texts.append(association)
+        else:
+            bisect.insort(ids, row_id)
+
+    def remove(self, row_id: int):
+        """Удаление ассоциации из индекса"""
+        row = self.rows.pop(row_id, None)
+        if row is None:
+            return
+
+        for gram in set(self._grams(row[1])):
+            postings = self.grams.get(gram)
+            if not postings:
+                continue
+            pos = bisect.bisect_left(postings, row_id)
+            if pos < len(postings) and postings[pos] == row_id:
+                del postings[pos]
+            if not postings:
+                del self.grams[gram]
+
+        ids = self.by_text.get(row[1])
+        if ids is not None and row_id in ids:
+            ids.remove(row_id)
+            if not ids:
+                del self.by_text[row[1]]
+                self._remove_text(row[1])
+
+    def _remove_text(self, association: str):
+        if not self._texts_sorted:
+            self._texts.remove(association)
+            return
+        pos = bisect.bisect_left(self._texts, association)
+        if pos < len(self._texts) and self._texts[pos] == association:
+            del self._texts[pos]
+
+    def _candidates(self, query: str):
+        """Кандидаты на совпадение в порядке от новых к старым"""
+        if len(query) < min(self.GRAM_SIZES):
+            return reversed(self.rows)
+
+        n = min(len(query), max(self.GRAM_SIZES))
+        shortest = None
+        for i in range(len(query) - n + 1):
+            postings = self.grams.get(query[i:i + n])
+            if not postings:
+                return ()
+            if shortest is None or len(postings) < len(shortest):
+                shortest = postings
+        return reversed(shortest)
+
+    def lookup(self, query: str, skip: frozenset = frozenset()) -> Optional[Tuple[int, str]]:
+        """Самая новая ассоциация, содержащая query: (id, sticker_id); стикеры из skip пропускаются"""
+        query = query.lower().strip()
+        texts, refs = self.rows.columns.texts, self.rows.columns.refs
+        for row_id in self._candidates(query):
+            if query in texts[row_id] and refs[row_id] not in skip:
+                return row_id, self.rows[row_id][0]
+        return None
+
+    def sort_texts(self):
+        """Сортировка текстов после массовой загрузки; дальше add/remove поддерживают порядок"""
+        if not self._texts_sorted:
+            self._texts.sort()
+            self._texts_sorted = True
+
+    def rank_candidates(self, query: str, scan_limit: int = 2000) -> List[Tuple[int, str]]:
+        """Тексты ассоциаций, подходящие под query, с качеством совпадения
+
+        3 - точное совпадение, 2 - префикс, 1 - префикс слова, 0 - подстрока.
+        Просматривается не больше scan_limit текстов каждого вида.
+        """
+        query = query.lower().strip()
+        found: Dict[str, int] = {}
+        if query in self.by_text:
+            found[query] = 3
+
+        texts = self._texts
+        pos = bisect.bisect_left(texts, query)
+        end = min(len(texts), pos + scan_limit)
+        while pos < end and texts[pos].startswith(query):
+            found.setdefault(texts[pos], 2)
+            pos += 1
+
+        if len(query) >= min(self.GRAM_SIZES):
+            word_prefix = ' ' + query
+            matched = 0
+            texts = self.rows.columns.texts
+            for scanned, row_id in enumerate(self._candidates(query)):
+                if scanned >= scan_limit * 4 or matched >= scan_limit:
+                    break
+                association = texts[row_id]
+                if association in found or query not in association:
+                    continue
+                found[association] = 1 if word_prefix in association else 0
+                matched += 1
+
+        return [(quality, association) for association, quality in found.items()]
+
+    def to_state(self) -> tuple:
+        grams = {gram: postings.tobytes() for gram, postings in self.grams.items()}
+        return self.rows.to_state(), grams, self.by_text, self._texts, self._texts_sorted
+
+    @classmethod
+    def from_state(cls, state: tuple, columns: AssociationColumns) -> 'AssociationIndex':
+        rows, grams, by_text, texts, texts_sorted = state
+        index = cls(columns)
+        index.rows = AssociationRows.from_state(rows, columns)
+        for gram, postings in grams.items():
+            index.grams[gram] = array('I')
+            index.grams[gram].frombytes(postings)
+        index.by_text = by_text
+        index._texts = texts
+        index._texts_sorted = texts_sorted
+        return index
+
+
+# Кэш результатов поиска по подстроке, включая отрицательные
+class LookupCache:
+    """LRU-кэш (scope, запрос) -> (id, sticker_id) или None с точной инвалидацией
+
+    Один кэш на все разделы: размер ограничен общим max_size, а не числом чатов.
+    """
+    _MISSING = object()
+
+    def __init__(self, max_size: int = int(os.getenv("LOOKUP_CACHE_SIZE", "10000"))):
+        self.max_size = max_size
+        self._items: OrderedDict = OrderedDict()
+        # id ассоциации -> ключи (scope, запрос), закэшированные с этим результатом
+        self._by_row: Dict[int, set] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, query: str, scope: int = 0):
+        """Закэшированный результат или LookupCache._MISSING"""
+        key = (scope, query)
+        result = self._items.get(key, self._MISSING)
+        if result is self._MISSING:
+            self.misses += 1
+            return result
+        self._items.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def set(self, query: str, result: Optional[Tuple[int, str]], scope: int = 0):
+        key = (scope, query)
+        self._pop(key)
+        self._items[key] = result
+        if result is not None:
+            self._by_row.setdefault(result[0], set()).add(key)
+        while len(self._items) > self.max_size:
+            self._pop(next(iter(self._items)))
+            self.evictions += 1
+
+    def _pop(self, key: Tuple[int, str]) -> bool:
+        result = self._items.pop(key, self._MISSING)
+        if result is self._MISSING:
+            return False
+        if result is not None:
+            keys = self._by_row.get(result[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_row[result[0]]
+        return True
+
+    def invalidate_substrings(self, association: str, scope: int = 0):
+        """Новая ассоциация меняет ответ на любой запрос её scope, являющийся её подстрокой"""
+        length = len(association)
+        if len(self._items) < length * (length + 1) // 2:
+            stale = [key for key in self._items if key[0] == scope and key[1] in association]
+        else:
+            stale = {(scope, association[i:j]) for i in range(length) for j in range(i + 1, length + 1)}
+        for key in stale:
+            if self._pop(key):
+                self.invalidations += 1
+
+    def invalidate_row(self, row_id: int):
+        """Удаление ассоциации меняет только запросы, которые на неё указывали"""
+        for key in list(self._by_row.get(row_id, ())):
+            if self._pop(key):
+                self.invalidations += 1
+
+    def clear(self, scope: Optional[int] = None):
+        """Очистка всего кэша или только запросов одного scope"""
+        if scope is None:
+            self._items.clear()
+            self._by_row.clear()
+            return
+        for key in [key for key in self._items if key[0] == scope]:
+            self._pop(key)
+
+    def to_state(self) -> list:
+        return list(self._items.items())
+
+    @classmethod
+    def from_state(cls, state: list) -> 'LookupCache':
+        """Кэш из сохранённых записей (счётчики начинаются с нуля)"""
+        cache = cls()
+        for (scope, query), result in state[-cache.max_size:]:
+            cache.set(query, result, scope)
+        return cache
+
+    def stats(self) -> Dict:
+        """Счётчики и доля попаданий"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+
+# Стикеры, которые Telegram перестал принимать
+class DeadStickers:
+    """file_id с ошибками отправки: пропускаются при поиске, пока не истёк backoff"""
+
+    def __init__(self):
+        # file_id -> (id стикера в таблице stickers, unix-время, до которого он пропускается)
+        self.entries: Dict[str, Tuple[int, float]] = {}
+        self._skipped: frozenset = frozenset()
+        self._expires = float('inf')
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self.entries
+
+    def set(self, file_id: str, sticker_ref: int, retry_at: float):
+        self.entries[file_id] = (sticker_ref, retry_at)
+        self._refresh()
+
+    def discard(self, file_id: str):
+        if self.entries.pop(file_id, None) is not None:
+            self._refresh()
+
+    def replace(self, entries: Dict[str, Tuple[int, float]]):
+        self.entries = entries
+        self._refresh()
+
+    def skipped(self) -> frozenset:
+        """id стикеров, которые сейчас не предлагаются"""
+        if time.time() >= self._expires:
+            self._refresh()
+        return self._skipped
+
+    def _refresh(self):
+        now = time.time()
+        active = [(sticker_ref, retry_at) for sticker_ref, retry_at in self.entries.values() if retry_at > now]
+        self._skipped = frozenset(sticker_ref for sticker_ref, _ in active)
+        self._expires = min((retry_at for _, retry_at in active), default=float('inf'))
+
+
+# Автомат для поиска по всем словам сообщения за один проход
+class AssociationMatcher:
+    """Обобщённый суффиксный автомат по всем ассоциациям"""
+    # Доля удалённых ассоциаций, после которой автомат перестраивается
+    REBUILD_RATIO = 0.25
+
+    def __init__(self, index: AssociationIndex, cache: Optional[LookupCache] = None, scope: int = 0):
+        self.index = index
+        # Кэш общий для всех разделов, записи различаются по scope
+        self.cache = cache if cache is not None else LookupCache()
+        self.scope = scope
+        self.rebuild()
+
+    def rebuild(self):
+        """Полная перестройка автомата по текущему индексу"""
+        self.next: List[Dict[str, int]] = [{}]
+        # Числовые поля состояний; построение идёт по спискам (быстрее доступ)
+        self.link = [-1]
+        self.length = [0]
+        # Максимальный id ассоциации, содержащей строки состояния
+        self.best = [0]
+        # Символ -> один общий объект строки для ключей переходов
+        self.chars: Dict[str, str] = {}
+        self.removed = 0
+        self.cache.clear(self.scope)
+        for row_id, (sticker_id, association) in self.index.rows.items():
+            self.add(row_id, association)
+        # Хранятся массивами: 4 байта на значение вместо объекта int в списке
+        self.link = array('i', self.link)
+        self.length = array('i', self.length)
+        self.best = array('I', self.best)
+
+    def _new_state(self, length: int, link: int, best: int, transitions: Dict[str, int]) -> int:
+        self.next.append(transitions)
+        self.link.append(link)
+        self.length.append(length)
+        self.best.append(best)
+        return len(self.next) - 1
+
+    def _split(self, p: int, q: int, ch: str) -> int:
+        """Клонирование состояния q для переходов из p по символу ch"""
+        clone = self._new_state(self.length[p] + 1, self.link[q], self.best[q], dict(self.next[q]))
+        while p != -1 and self.next[p].get(ch) == q:
+            self.next[p][ch] = clone
+            p = self.link[p]
+        self.link[q] = clone
+        return clone
+
+    def _extend(self, last: int, ch: str) -> int:
+        q = self.next[last].get(ch)
+        if q is not None:
+            if self.length[last] + 1 == self.length[q]:
+                return q
+            return self._split(last, q, ch)
+
+        cur = self._new_state(self.length[last] + 1, 0, 0, {})
+        p = last
+        while p != -1 and ch not in self.next[p]:
+            self.next[p][ch] = cur
+            p = self.link[p]
+        if p != -1:
+            q = self.next[p][ch]
+            if self.length[p] + 1 == self.length[q]:
+                self.link[cur] = q
+            else:
+                self.link[cur] = self._split(p, q, ch)
+        return cur
+
+    def add(self, row_id: int, association: str):
+        """Инкрементальное добавление ассоциации"""
+        ends = []
+        last = 0
+        chars = self.chars
+        for ch in association:
+            last = self._extend(last, chars.setdefault(ch, ch))
+            ends.append(last)
+
+        # Помечаем все подстроки ассоциации: идём по суффиксным ссылкам,
+        # пока не встретим состояние, уже помеченное не более старым id
+        for state in [0] + ends:
+            while state != -1 and self.best[state] < row_id:
+                self.best[state] = row_id
+                state = self.link[state]
+        self.cache.invalidate_substrings(association, self.scope)
+
+    def remove(self, row_id: int):
+        """Учёт удаления: устаревшие пометки проверяются по индексу при поиске"""
+        self.cache.invalidate_row(row_id)
+        self.removed += 1
+        if self.removed > max(1000, len(self.index) * self.REBUILD_RATIO):
+            self.rebuild()
+
+    def lookup(self, query: str, skip: frozenset = frozenset()) -> Optional[Tuple[int, str]]:
+        """Самая новая ассоциация, содержащая query: (id, sticker_id); стикеры из skip пропускаются"""
+        result = self.cache.get(query, self.scope)
+        if result is LookupCache._MISSING:
+            result = self._lookup(query)
+            self.cache.set(query, result, self.scope)
+        # В кэше ответ без учёта skip: отметки стикеров не требуют его инвалидации
+        if result is not None and skip and self.index.rows.columns.refs[result[0]] in skip:
+            # Следующая по новизне ассоциация с другим стикером
+            result = self.index.lookup(query, skip)
+        return result
+
+    def _lookup(self, query: str) -> Optional[Tuple[int, str]]:
+        state = 0
+        for ch in query:
+            state = self.next[state].get(ch)
+            if state is None:
+                return None
+
+        row = self.index.rows.get(self.best[state])
+        if row is not None:
+            return self.best[state], row[0]
+        # Помеченная ассоциация удалена - уточняем по n-gram индексу
+        return self.index.lookup(query)
+
+    def match(self, text: str, skip: frozenset = frozenset()) -> Optional[Tuple[str, str]]:
+        """Поиск стикера для сообщения: (sticker_id, совпавший текст)"""
+        text = text.lower().strip()
+
+        # Сначала весь текст, затем слова в порядке следования
+        result = self.lookup(text, skip)
+        if result:
+            return result[1], text
+
+        for word in re.findall(r'\b\w+\b', text):
+            if len(word) >= 2:  # Минимум 2 символа для поиска
+                result = self.lookup(word, skip)
+                if result:
+                    return result[1], word
+        return None
+
+    def to_state(self) -> tuple:
+        return self.next, self.link.tobytes(), self.length.tobytes(), self.best.tobytes(), self.chars, self.removed
+
+    @classmethod
+    def from_state(cls, state: tuple, index: AssociationIndex, cache: LookupCache, scope: int) -> 'AssociationMatcher':
+        """Автомат из сохранённого состояния, без перестройки"""
+        transitions, link, length, best, chars, removed = state
+        matcher = cls.__new__(cls)
+        matcher.index = index
+        matcher.cache = cache
+        matcher.scope = scope
+        matcher.next = transitions
+        matcher.link = array('i')
+        matcher.link.frombytes(link)
+        matcher.length = array('i')
+        matcher.length.frombytes(length)
+        matcher.best = array('I')
+        matcher.best.frombytes(best)
+        if not len(transitions) == len(matcher.link) == len(matcher.length) == len(matcher.best):
+            raise ValueError("состояния автомата разной длины")
+        matcher.chars = chars
+        matcher.removed = removed
+        return matcher
+
+
+# Исправление опечаток в словах сообщения по словарю ассоциаций
+class FuzzyIndex:
+    """Индекс удалений (SymSpell) по словам ассоциаций"""
+    # Удаления считаются только для префикса слова - это ограничивает размер индекса
+    PREFIX_LENGTH = 7
+    CORRECTIONS_CACHE_SIZE = 10000
+
+    def __init__(
+            self,
+            index: AssociationIndex,
+            max_distance: int = FUZZY_MAX_DISTANCE,
+            min_length: int = FUZZY_MIN_LENGTH
+    ):
+        self.index = index
+        self.max_distance = max_distance
+        self.min_length = min_length
+        self.rebuild()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return text.replace('ё', 'е')
+
+    def rebuild(self):
+        """Полная перестройка по текущему индексу ассоциаций"""
+        # Нормализованное слово -> {написание в ассоциациях: количество ассоциаций}
+        self.words: Dict[str, Dict[str, int]] = {}
+        # Префикс с удалёнными символами -> нормализованные слова
+        self.deletes: Dict[str, set] = {}
+        # Исправления слов сообщений, включая "исправить нельзя" (None)
+        self.corrections: OrderedDict = OrderedDict()
+        for association, ids in self.index.by_text.items():
+            self.add(association, len(ids))
+
+    def _words(self, association: str) -> List[str]:
+        return [word for word in re.findall(r'\w+', association) if len(word) >= self.min_length]
+
+    def _variants(self, word: str) -> set:
+        """Префикс слова со всеми вариантами удаления до max_distance символов"""
+        variants = {word[:self.PREFIX_LENGTH]}
+        frontier = variants
+        for _ in range(self.max_distance):
+            frontier = {item[:i] + item[i + 1:] for item in frontier for i in range(len(item))}
+            variants |= frontier
+        return variants
+
+    def add(self, association: str, count: int = 1):
+        words = self._words(association)
+        if words:
+            # Исправление зависит и от числа ассоциаций со словом - кэш устаревает при любом изменении
+            self.corrections.clear()
+        for word in words:
+            normalized = self.normalize(word)
+            spellings = self.words.get(normalized)
+            if spellings is None:
+                spellings = self.words[normalized] = {}
+                for variant in self._variants(normalized):
+                    self.deletes.setdefault(variant, set()).add(normalized)
+            spellings[word] = spellings.get(word, 0) + count
+
+    def remove(self, association: str):
+        for word in self._words(association):
+            normalized = self.normalize(word)
+            spellings = self.words.get(normalized)
+            if spellings is None or word not in spellings:
+                continue
+            self.corrections.clear()
+            spellings[word] -= 1
+            if spellings[word] <= 0:
+                del spellings[word]
+            if spellings:
+                continue
+            del self.words[normalized]
+            for variant in self._variants(normalized):
+                candidates = self.deletes.get(variant)
+                if candidates is not None:
+                    candidates.discard(normalized)
+                    if not candidates:
+                        del self.deletes[variant]
+
+    @staticmethod
+    def distance(a: str, b: str, limit: int) -> int:
+        """Расстояние Дамерау-Левенштейна (OSA) с отсечкой: больше limit -> limit + 1"""
+        if a == b:
+            return 0
+        if abs(len(a) - len(b)) > limit:
+            return limit + 1
+        before = None
+        previous = list(range(len(b) + 1))
+        for i in range(1, len(a) + 1):
+            current = [i] + [0] * len(b)
+            for j in range(1, len(b) + 1):
+                value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+                if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                    value = min(value, before[j - 2] + 1)
+                current[j] = value
+            if min(current) > limit:
+                return limit + 1
+            before, previous = previous, current
+        return previous[-1]
+
+    def correct_word(self, word: str) -> Optional[str]:
+        """Ближайшее слово из ассоциаций в его исходном написании"""
+        if word in self.corrections:
+            self.corrections.move_to_end(word)
+            return self.corrections[word]
+        correction = self._correct_word(word)
+        self.corrections[word] = correction
+        if len(self.corrections) > self.CORRECTIONS_CACHE_SIZE:
+            self.corrections.popitem(last=False)
+        return correction
+
+    def _correct_word(self, word: str) -> Optional[str]:
+        normalized = self.normalize(word)
+        spellings = self.words.get(normalized)
+        if spellings is None:
+            best = None
+            best_key = None
+            for variant in self._variants(normalized):
+                for candidate in self.deletes.get(variant, ()):
+                    distance = self.distance(normalized, candidate, self.max_distance)
+                    if distance > self.max_distance:
+                        continue
+                    # Ближе, затем чаще встречается в ассоциациях
+                    key = (distance, -sum(self.words[candidate].values()), candidate)
+                    if best_key is None or key < best_key:
+                        best, best_key = candidate, key
+            if best is None:
+                return None
+            spellings = self.words[best]
+        return max(spellings, key=spellings.get)
+
+    def correct(self, text: str, budget: float = FUZZY_BUDGET_MS / 1000) -> str:
+        """Текст с исправленными словами; по истечении бюджета остальные слова не трогаются"""
+        deadline = time.perf_counter() + budget
+
+        def replace(match) -> str:
+            word = match.group(0)
+            if len(word) < self.min_length or time.perf_counter() > deadline:
+                return word
+            return self.correct_word(word) or word
+
+        return re.sub(r'\w+', replace, text)
+
+    def to_state(self) -> tuple:
+        return self.max_distance, self.min_length, self.words, self.deletes, list(self.corrections.items())
+
+    @classmethod
+    def from_state(cls, state: tuple, index: AssociationIndex) -> 'FuzzyIndex':
+        """Индекс опечаток из сохранённого состояния, без перестройки"""
+        max_distance, min_length, words, deletes, corrections = state
+        fuzzy = cls.__new__(cls)
+        fuzzy.index = index
+        fuzzy.max_distance = max_distance
+        fuzzy.min_length = min_length
+        fuzzy.words = words
+        fuzzy.deletes = deletes
+        fuzzy.corrections = OrderedDict(corrections)
+        return fuzzy
+
+
+# Ассоциации одного scope: глобальные или одного чата
+class AssociationPartition:
+    """N-gram индекс, автомат и индекс опечаток по ассоциациям одного scope"""
+
+    def __init__(
+            self,
+            fuzzy: bool = FUZZY_MATCHING,
+            columns: Optional[AssociationColumns] = None,
+            cache: Optional[LookupCache] = None,
+            scope: int = 0
+    ):
+        self.index = AssociationIndex(columns)
+        self.cache = cache
+        self.scope = scope
+        self.fuzzy_enabled = fuzzy
+        self.matcher: Optional[AssociationMatcher] = None
+        self.fuzzy: Optional[FuzzyIndex] = None
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def build(self):
+        """Построение автомата и индекса опечаток по заполненному index"""
+        self.index.sort_texts()
+        self.matcher = AssociationMatcher(self.index, self.cache, self.scope)
+        self.fuzzy = FuzzyIndex(self.index) if self.fuzzy_enabled else None
+
+    def add(self, row_id: int, sticker_ref: int, association: str):
+        if row_id in self.index.rows:
+            return
+        self.index.add(row_id, sticker_ref, association)
+        self.matcher.add(row_id, association)
+        if self.fuzzy is not None:
+            self.fuzzy.add(association)
+
+    def remove(self, row_id: int):
+        row = self.index.rows.get(row_id)
+        if row is None:
+            return
+        self.index.remove(row_id)
+        self.matcher.remove(row_id)
+        if self.fuzzy is not None:
+            self.fuzzy.remove(row[1])
+
+    def to_state(self) -> tuple:
+        """Состояние раздела из встроенных типов (для снимка индекса); columns и cache сохраняются отдельно"""
+        fuzzy = self.fuzzy.to_state() if self.fuzzy is not None else None
+        return self.scope, self.fuzzy_enabled, self.index.to_state(), self.matcher.to_state(), fuzzy
+
+    @classmethod
+    def from_state(cls, state: tuple, columns: AssociationColumns, cache: LookupCache) -> 'AssociationPartition':
+        scope, fuzzy_enabled, index, matcher, fuzzy = state
+        partition = cls(fuzzy_enabled, columns, cache, scope)
+        partition.index = AssociationIndex.from_state(index, columns)
+        partition.matcher = AssociationMatcher.from_state(matcher, partition.index, cache, scope)
+        if fuzzy is not None:
+            partition.fuzzy = FuzzyIndex.from_state(fuzzy, partition.index)
+        return partition
+
+
+# Менеджер соединений SQLite
+class SQLiteConnectionManager:
+    """Долгоживущие соединения: читатель на каждый поток и один писатель"""
+    PRAGMAS = (
+        # Действует только для новой базы (до первой таблицы и до перехода в WAL);
+        # существующую переводит python main.py vacuum
+        'PRAGMA auto_vacuum=INCREMENTAL',
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-20000',
+        'PRAGMA mmap_size=268435456',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA busy_timeout=5000',
+    )
+
+    def __init__(self, db_path: str, cached_statements: int = 256):
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие соединения с настроенными pragma"""
+        # isolation_level=None: транзакции открываются явно в writer()
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=self.cached_statements
+        )
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def reader(self) -> sqlite3.Connection:
+        """Соединение для чтения, закреплённое за текущим потоком"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """Транзакция на единственном соединении для записи"""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            cursor = self._writer.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            else:
+                cursor.execute('COMMIT')
+
+    @contextmanager
+    def maintenance(self):
+        """Соединение для записи вне транзакции (VACUUM и подобные команды)"""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            yield self._writer
+
+    def close(self):
+        """Закрытие всех соединений"""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._writer = None
+        self._local = threading.local()
+
+
+# Класс для работы с базой данных
+class StickerDatabase:
+    # sticker_ref - id из таблицы stickers (file_id хранится один раз на стикер);
+    # scope: 0 - глобальные ассоциации, id чата - ассоциации только этого чата
+    ASSOCIATIONS_TABLE = '''
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            sticker_ref INTEGER NOT NULL REFERENCES stickers(id),
+            association TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            scope INTEGER NOT NULL DEFAULT 0,
+            UNIQUE(scope, sticker_ref, association)
+        )
+    '''
+    # file_id стикера строки sticker_associations в запросах без JOIN
+    STICKER_FILE_ID = '(SELECT file_id FROM stickers WHERE stickers.id = sticker_ref)'
+    # PRAGMA user_version: увеличивается при каждом изменении DDL в init_db
+    SCHEMA_VERSION = 3
+    # Формат снимка индекса (save_snapshot): заголовок, затем marshal-данные из встроенных типов
+    SNAPSHOT_VERSION = 5
+    SNAPSHOT_MAGIC = b'STKIDX'
+    SNAPSHOT_HEADER = struct.Struct('<6sI32s')
+
+    def __init__(self, db_path: str = os.getenv("DATABASE_PATH"), fuzzy: bool = FUZZY_MATCHING, warm: bool = True):
+        self.db_path = db_path
+        self.connections = SQLiteConnectionManager(db_path)
+        # Защищает индекс и автомат при обращении из нескольких потоков
+        self.index_lock = threading.RLock()
+        self.fuzzy_enabled = fuzzy
+        # Тексты и стикеры ассоциаций, общие для всех разделов
+        self.columns = AssociationColumns()
+        # Кэш поиска по подстроке, общий для всех разделов
+        self.lookup_cache = LookupCache()
+        # scope -> раздел индекса; раздел 0 (глобальный) есть всегда
+        self.partitions: Dict[int, AssociationPartition] = {
+            0: AssociationPartition(fuzzy, self.columns, self.lookup_cache)
+        }
+        self.partitions[0].build()
+        # id записи -> scope для ассоциаций чатов (глобальные сюда не попадают)
+        self.row_scopes: Dict[int, int] = {}
+        self.changes_seen = 0
+        # Установлен, когда индекс загружен; до этого поиск идёт запросами к базе
+        self.ready = threading.Event()
+        self.dead_stickers = DeadStickers()
+        self._vacuum_warned = False
+        self.init_db()
+        self.load_dead_stickers()
+        if warm:
+            self.warm_up(None)
+
+    @property
+    def index(self) -> AssociationIndex:
+        return self.partitions[0].index
+
+    @property
+    def matcher(self) -> AssociationMatcher:
+        return self.partitions[0].matcher
+
+    @property
+    def fuzzy(self) -> Optional[FuzzyIndex]:
+        return self.partitions[0].fuzzy
+
+    def close(self):
+        """Закрытие соединений с базой данных"""
+        self.connections.close()
+
+    def init_db(self):
+        """Инициализация базы данных: DDL выполняется, только если схема старше SCHEMA_VERSION"""
+        version = self.connections.reader().execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+
+        logger.info(f"Обновление схемы базы данных: {version} -> {self.SCHEMA_VERSION}")
+        with self.connections.writer() as cursor:
+            # Справочник стикеров и ассоциации со ссылкой на него
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS stickers (
+                    id INTEGER PRIMARY KEY,
+                    file_id TEXT NOT NULL UNIQUE
+                )
+            ''')
+            cursor.execute(self.ASSOCIATIONS_TABLE.format(name='sticker_associations'))
+            columns = {row[1] for row in cursor.execute('PRAGMA table_info(sticker_associations)')}
+            migrated = 'sticker_ref' not in columns
+            if migrated:
+                self._migrate_associations(cursor, columns)
+
+            # Таблица для статистики использования
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage_stats (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    sticker_id TEXT NOT NULL,
+                    association TEXT NOT NULL,
+                    used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Индексы для быстрого поиска
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_association ON sticker_associations(association)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sticker ON sticker_associations(sticker_ref)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user ON sticker_associations(user_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_scope_association ON sticker_associations(scope, association)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_usage_used_at ON usage_stats(used_at)')
+            # Состояния FSM (ключ - строка DefaultKeyBuilder, data - JSON)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_fsm_updated_at ON fsm_storage(updated_at)')
+
+            # Журнал изменений ассоциаций для синхронизации индексов между процессами
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS association_changes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    row_id INTEGER NOT NULL,
+                    op TEXT NOT NULL,
+                    changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+                )
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_associations_log_insert AFTER INSERT ON sticker_associations
+                BEGIN
+                    INSERT INTO association_changes (row_id, op) VALUES (NEW.id, '+');
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_associations_log_delete AFTER DELETE ON sticker_associations
+                BEGIN
+                    INSERT INTO association_changes (row_id, op) VALUES (OLD.id, '-');
+                END
+            ''')
+
+            # Keyset-пагинация ассоциаций пользователя
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS idx_user_created ON sticker_associations(user_id, created_at DESC, id DESC)'
+            )
+
+            # Служебные значения бота (хэш команд и т.п.)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            ''')
+
+            # Стикеры, не принятые Telegram: пропускаются при поиске до retry_at (unix-время)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS dead_stickers (
+                    sticker_ref INTEGER PRIMARY KEY REFERENCES stickers(id),
+                    failures INTEGER NOT NULL DEFAULT 1,
+                    error TEXT,
+                    failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    retry_at INTEGER NOT NULL
+                )
+            ''')
+
+            filled = self._init_aggregates(cursor)
+            if migrated and not filled:
+                # sticker_refcounts пересоздана с ключом sticker_ref
+                self._rebuild_sticker_refcounts(cursor)
+            cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+
+    def _migrate_associations(self, cursor: sqlite3.Cursor, columns: set):
+        """Пересоздание sticker_associations по ASSOCIATIONS_TABLE (UNIQUE и типы колонок не изменить через ALTER)
+
+        Старые схемы: sticker_id TEXT вместо sticker_ref, без колонки scope.
+        """
+        logger.info("Миграция sticker_associations: справочник стикеров и scope")
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'sticker_associations'")
+        row = cursor.fetchone()
+        cursor.execute('''
+            INSERT OR IGNORE INTO stickers (file_id)
+            SELECT sticker_id FROM sticker_associations GROUP BY sticker_id ORDER BY MIN(id)
+        ''')
+        scope = 'a.scope' if 'scope' in columns else '0'
+        cursor.execute(self.ASSOCIATIONS_TABLE.format(name='sticker_associations_migrated'))
+        cursor.execute(f'''
+            INSERT INTO sticker_associations_migrated (id, user_id, sticker_ref, association, created_at, scope)
+            SELECT a.id, a.user_id, s.id, a.association, a.created_at, {scope}
+            FROM sticker_associations a JOIN stickers s ON s.file_id = a.sticker_id
+        ''')
+        # Индексы и триггеры удаляются вместе с таблицами и создаются заново в init_db
+        cursor.execute('DROP TABLE sticker_associations')
+        cursor.execute('DROP TABLE IF EXISTS sticker_refcounts')
+        cursor.execute('ALTER TABLE sticker_associations_migrated RENAME TO sticker_associations')
+        if row:
+            # Удалённые id не должны выдаваться повторно: на них ссылается журнал изменений
+            cursor.execute(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'sticker_associations'", (row[0],)
+            )
+
+    def _init_aggregates(self, cursor: sqlite3.Cursor) -> bool:
+        """Таблицы агрегатов статистики и триггеры; True, если агрегаты только что заполнены"""
+        # Счётчики: total_associations, unique_stickers, total_users, total_usages
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sticker_refcounts (
+                sticker_ref INTEGER PRIMARY KEY,
+                associations INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_refcounts (
+                user_id INTEGER PRIMARY KEY,
+                associations INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS association_usage (
+                association TEXT PRIMARY KEY,
+                usage_count INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS usage_daily (
+                day TEXT NOT NULL,
+                association TEXT NOT NULL,
+                usage_count INTEGER NOT NULL,
+                PRIMARY KEY (day, association)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_association_usage_count ON association_usage(usage_count DESC)')
+
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_associations_insert AFTER INSERT ON sticker_associations
+            BEGIN
+                UPDATE stats_counters SET value = value + 1 WHERE name = 'total_associations';
+                INSERT INTO sticker_refcounts (sticker_ref, associations) VALUES (NEW.sticker_ref, 1)
+                    ON CONFLICT(sticker_ref) DO UPDATE SET associations = associations + 1;
+                INSERT INTO user_refcounts (user_id, associations) VALUES (NEW.user_id, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET associations = associations + 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_associations_delete AFTER DELETE ON sticker_associations
+            BEGIN
+                UPDATE stats_counters SET value = value - 1 WHERE name = 'total_associations';
+                UPDATE sticker_refcounts SET associations = associations - 1 WHERE sticker_ref = OLD.sticker_ref;
+                DELETE FROM sticker_refcounts WHERE sticker_ref = OLD.sticker_ref AND associations <= 0;
+                UPDATE user_refcounts SET associations = associations - 1 WHERE user_id = OLD.user_id;
+                DELETE FROM user_refcounts WHERE user_id = OLD.user_id AND associations <= 0;
+            END
+        ''')
+        # Количество различных стикеров и пользователей меняется вместе с refcount-таблицами
+        for table, counter in (('sticker_refcounts', 'unique_stickers'), ('user_refcounts', 'total_users')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_insert AFTER INSERT ON {table}
+                BEGIN
+                    UPDATE stats_counters SET value = value + 1 WHERE name = '{counter}';
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_delete AFTER DELETE ON {table}
+                BEGIN
+                    UPDATE stats_counters SET value = value - 1 WHERE name = '{counter}';
+                END
+            ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_usage_insert AFTER INSERT ON usage_stats
+            BEGIN
+                UPDATE stats_counters SET value = value + 1 WHERE name = 'total_usages';
+                INSERT INTO association_usage (association, usage_count) VALUES (NEW.association, 1)
+                    ON CONFLICT(association) DO UPDATE SET usage_count = usage_count + 1;
+                INSERT INTO usage_daily (day, association, usage_count) VALUES (date(NEW.used_at), NEW.association, 1)
+                    ON CONFLICT(day, association) DO UPDATE SET usage_count = usage_count + 1;
+            END
+        ''')
+
+        # Существующая база без агрегатов - разовое заполнение
+        cursor.execute("SELECT 1 FROM stats_counters WHERE name = 'total_associations'")
+        if cursor.fetchone() is not None:
+            return False
+        self._backfill_usage(cursor)
+        self._backfill_aggregates(cursor)
+        return True
+
+    @staticmethod
+    def _backfill_usage(cursor: sqlite3.Cursor):
+        """Первое заполнение агрегатов использования по usage_stats
+
+        Только при создании агрегатов: до них очистки usage_stats не было.
+        Дальше usage_stats хранит лишь последние события (prune_usage), и
+        пересчёт по нему потерял бы историю - эти агрегаты ведут только триггеры.
+        """
+        logger.info("Заполнение агрегатов использования...")
+        cursor.execute('''
+            INSERT INTO association_usage (association, usage_count)
+            SELECT association, COUNT(*) FROM usage_stats GROUP BY association
+        ''')
+        cursor.execute('''
+            INSERT INTO usage_daily (day, association, usage_count)
+            SELECT date(used_at), association, COUNT(*) FROM usage_stats GROUP BY date(used_at), association
+        ''')
+        cursor.execute('''
+            INSERT OR REPLACE INTO stats_counters (name, value)
+            VALUES ('total_usages', (SELECT COUNT(*) FROM usage_stats))
+        ''')
+
+    @staticmethod
+    def _backfill_aggregates(cursor: sqlite3.Cursor):
+        """Пересчёт агрегатов по ассоциациям (счётчики стикеров и пользователей); использование не трогается"""
+        logger.info("Заполнение агрегатов статистики...")
+        for table in ('sticker_refcounts', 'user_refcounts'):
+            cursor.execute(f'DELETE FROM {table}')
+
+        cursor.execute('''
+            INSERT INTO sticker_refcounts (sticker_ref, associations)
+            SELECT sticker_ref, COUNT(*) FROM sticker_associations GROUP BY sticker_ref
+        ''')
+        cursor.execute('''
+            INSERT INTO user_refcounts (user_id, associations)
+            SELECT user_id, COUNT(*) FROM sticker_associations GROUP BY user_id
+        ''')
+        # Вставки выше уже изменили счётчики через триггеры - перезаписываем их точными значениями
+        cursor.execute('''
+            INSERT OR REPLACE INTO stats_counters (name, value) VALUES
+                ('total_associations', (SELECT COUNT(*) FROM sticker_associations)),
+                ('unique_stickers', (SELECT COUNT(*) FROM sticker_refcounts)),
+                ('total_users', (SELECT COUNT(*) FROM user_refcounts))
+        ''')
+
+    @staticmethod
+    def _rebuild_sticker_refcounts(cursor: sqlite3.Cursor):
+        """Заполнение sticker_refcounts и счётчика unique_stickers после миграции на sticker_ref"""
+        logger.info("Пересчёт счётчиков стикеров...")
+        cursor.execute('DELETE FROM sticker_refcounts')
+        cursor.execute('''
+            INSERT INTO sticker_refcounts (sticker_ref, associations)
+            SELECT sticker_ref, COUNT(*) FROM sticker_associations GROUP BY sticker_ref
+        ''')
+        # Триггер вставки уже изменил unique_stickers - перезаписываем точным значением
+        cursor.execute('''
+            INSERT OR REPLACE INTO stats_counters (name, value)
+            VALUES ('unique_stickers', (SELECT COUNT(*) FROM sticker_refcounts))
+        ''')
+
+    def load_index(self):
+        """Загрузка индекса ассоциаций из базы данных"""
+        conn = self.connections.reader()
+        # Позиция в журнале берётся до чтения: изменения во время загрузки
+        # будут применены повторно, add/remove индекса идемпотентны
+        # (по sqlite_sequence: журнал мог быть полностью очищен prune_association_changes)
+        self.changes_seen = conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'association_changes'"
+        ).fetchone()[0]
+        columns = AssociationColumns()
+        for ref, file_id in conn.execute('SELECT id, file_id FROM stickers ORDER BY id'):
+            columns.stickers.add(ref, file_id)
+        cursor = conn.execute('SELECT id, sticker_ref, association, scope FROM sticker_associations ORDER BY id')
+        # Новый кэш: текущий используется поиском, пока строится индекс
+        cache = LookupCache()
+        partitions = {0: AssociationPartition(self.fuzzy_enabled, columns, cache)}
+        row_scopes = {}
+        for row_id, sticker_ref, association, scope in cursor:
+            partition = partitions.get(scope)
+            if partition is None:
+                partition = partitions[scope] = AssociationPartition(self.fuzzy_enabled, columns, cache, scope)
+            partition.index.add(row_id, sticker_ref, association)
+            if scope:
+                row_scopes[row_id] = scope
+        for partition in partitions.values():
+            partition.build()
+        with self.index_lock:
+            self.columns = columns
+            self.lookup_cache = cache
+            self.partitions = partitions
+            self.row_scopes = row_scopes
+        logger.info(
+            f"Индекс ассоциаций загружен: {sum(len(p) for p in partitions.values())} записей, "
+            f"разделов чатов: {len(partitions) - 1}"
+        )
+
+    def warm_up(self, snapshot_path: Optional[str] = INDEX_SNAPSHOT_PATH) -> str:
+        """Загрузка индекса из снимка (если он актуален) или из базы; возвращает источник"""
+        source = 'snapshot' if snapshot_path and self.load_snapshot(snapshot_path) else 'database'
+        if source == 'database':
+            self.load_index()
+        # Изменения, сделанные во время загрузки
+        self.sync_index()
+        self.ready.set()
+        return source
+
+    def load_snapshot(self, path: str) -> bool:
+        """Восстановление индекса из снимка, если журнал изменений покрывает всё, что было после него
+
+        Снимок - только данные (marshal без объектов Python-классов): заголовок
+        с версией формата и SHA-256 содержимого, идентификатор базы и состояние
+        индекса из встроенных типов. Объекты индекса собираются from_state.
+        """
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning(f"Снимок индекса не прочитан: {e}")
+            return False
+
+        header_size = self.SNAPSHOT_HEADER.size
+        if len(data) < header_size:
+            logger.warning("Снимок индекса повреждён, загрузка из базы")
+            return False
+        magic, version, digest = self.SNAPSHOT_HEADER.unpack_from(data)
+        if magic != self.SNAPSHOT_MAGIC or version != self.SNAPSHOT_VERSION:
+            logger.info("Снимок индекса в другом формате, загрузка из базы")
+            return False
+        body = memoryview(data)[header_size:]
+        if hashlib.sha256(body).digest() != digest:
+            logger.warning("Контрольная сумма снимка индекса не совпадает, загрузка из базы")
+            return False
+
+        try:
+            snapshot = marshal.loads(body)
+            if snapshot['config'] != self._snapshot_config():
+                logger.info("Снимок индекса создан с другими настройками, загрузка из базы")
+                return False
+            if snapshot['database_id'] != self.get_setting('database_id'):
+                logger.info("Снимок индекса создан для другой базы, загрузка из базы")
+                return False
+            cache = LookupCache.from_state(snapshot['lookup_cache'])
+            columns = AssociationColumns.from_state(snapshot['columns'])
+            partitions = {}
+            for state in snapshot['partitions']:
+                partition = AssociationPartition.from_state(state, columns, cache)
+                partitions[partition.scope] = partition
+            row_scopes = dict(snapshot['row_scopes'])
+            if 0 not in partitions:
+                raise ValueError("нет общего раздела")
+        except Exception as e:
+            logger.warning(f"Снимок индекса не прочитан: {e}")
+            return False
+
+        seen = snapshot['changes_seen']
+        conn = self.connections.reader()
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'association_changes'").fetchone()
+        last = row[0] if row else 0
+        # Журнал без пропусков: id AUTOINCREMENT идут подряд, старые записи удаляются с начала
+        kept = conn.execute('SELECT COUNT(*) FROM association_changes WHERE id > ?', (seen,)).fetchone()[0]
+        if last < seen or kept != last - seen:
+            logger.info("Журнал изменений обрезан после снимка индекса, загрузка из базы")
+            return False
+
+        with self.index_lock:
+            self.columns = columns
+            self.lookup_cache = cache
+            self.partitions = partitions
+            self.row_scopes = row_scopes
+            self.changes_seen = seen
+        self.sync_index()
+
+        # Контроль: число записей в индексе совпадает с агрегатом в базе
+        total = conn.execute("SELECT value FROM stats_counters WHERE name = 'total_associations'").fetchone()
+        loaded = sum(len(partition) for partition in self.partitions.values())
+        if total is None or total[0] != loaded:
+            logger.warning(f"Снимок индекса расходится с базой ({loaded} записей), загрузка из базы")
+            return False
+        logger.info(f"Индекс ассоциаций загружен из снимка: {loaded} записей")
+        return True
+
+    def save_snapshot(self, path: str) -> bool:
+        """Сохранение индекса (вместе с кэшами поиска) для следующего запуска"""
+        if not self.ready.is_set():
+            return False
+        started = time.perf_counter()
+        try:
+            database_id = self._database_id()
+            with self.index_lock:
+                # Одинаковые строки разделов и columns marshal сохраняет один раз
+                body = marshal.dumps({
+                    'config': self._snapshot_config(),
+                    'database_id': database_id,
+                    'changes_seen': self.changes_seen,
+                    'columns': self.columns.to_state(),
+                    'lookup_cache': self.lookup_cache.to_state(),
+                    'partitions': [partition.to_state() for partition in self.partitions.values()],
+                    'row_scopes': self.row_scopes
+                })
+            header = self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, hashlib.sha256(body).digest())
+            data_size = len(header) + len(body)
+            # Атомарная замена: оборванная запись не испортит предыдущий снимок
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(header)
+                file.write(body)
+            os.replace(tmp_path, path)
+            logger.info(f"Снимок индекса сохранён: {data_size / 1e6:.1f} МБ за {time.perf_counter() - started:.1f} с")
+            return True
+        except Exception as e:
+            logger.error(f"Error saving index snapshot: {e}")
+            return False
+
+    def _snapshot_config(self) -> tuple:
+        """Настройки, с которыми построен индекс: снимок с другими не используется"""
+        # Формат marshal может меняться между версиями Python
+        return (
+            self.fuzzy_enabled, FUZZY_MAX_DISTANCE, FUZZY_MIN_LENGTH, FuzzyIndex.PREFIX_LENGTH,
+            marshal.version, sys.version_info[:2]
+        )
+
+    def _database_id(self) -> str:
+        """Случайный идентификатор базы, создаётся при первом сохранении снимка"""
+        with self.connections.writer() as cursor:
+            cursor.execute(
+                "INSERT OR IGNORE INTO bot_settings (key, value) VALUES ('database_id', ?)", (os.urandom(16).hex(),)
+            )
+            return cursor.execute("SELECT value FROM bot_settings WHERE key = 'database_id'").fetchone()[0]
+
+    def sync_index(self) -> int:
+        """Применение к индексу изменений, сделанных другими процессами"""
+        try:
+            cursor = self.connections.reader().execute('''
+                SELECT c.id, c.op, c.row_id, a.sticker_ref, s.file_id, a.association, a.scope
+                FROM association_changes c
+                LEFT JOIN sticker_associations a ON a.id = c.row_id
+                LEFT JOIN stickers s ON s.id = a.sticker_ref
+                WHERE c.id > ?
+                ORDER BY c.id
+            ''', (self.changes_seen,))
+            changes = cursor.fetchall()
+            if not changes:
+                return 0
+
+            if changes[0][0] > self.changes_seen + 1 and self.changes_seen:
+                # Часть журнала уже удалена - индекс мог пропустить изменения
+                logger.warning("Журнал изменений ассоциаций отстал, полная перезагрузка индекса")
+                self.load_index()
+                return len(changes)
+
+            # Пачками, чтобы массовый импорт не блокировал поиск на всё время применения
+            for start in range(0, len(changes), 1000):
+                chunk = changes[start:start + 1000]
+                with self.index_lock:
+                    for change_id, op, row_id, sticker_ref, file_id, association, scope in chunk:
+                        if op == '+' and association is not None:
+                            self._index_add(row_id, sticker_ref, file_id, association, scope)
+                        elif op == '-':
+                            self._index_remove(row_id)
+                    self.changes_seen = chunk[-1][0]
+            return len(changes)
+        except Exception as e:
+            logger.error(f"Error syncing association index: {e}")
+            return 0
+
+    def _index_add(self, row_id: int, sticker_ref: int, file_id: str, association: str, scope: int = 0):
+        """Добавление новой ассоциации в раздел её scope (под index_lock)"""
+        self.columns.stickers.add(sticker_ref, file_id)
+        partition = self.partitions.get(scope)
+        if partition is None:
+            partition = self.partitions[scope] = AssociationPartition(
+                self.fuzzy_enabled, self.columns, self.lookup_cache, scope
+            )
+            partition.build()
+        partition.add(row_id, sticker_ref, association)
+        if scope:
+            self.row_scopes[row_id] = scope
+
+    def _index_remove(self, row_id: int):
+        """Удаление ассоциации из раздела её scope (под index_lock)"""
+        scope = self.row_scopes.pop(row_id, 0)
+        partition = self.partitions.get(scope)
+        if partition is None:
+            return
+        partition.remove(row_id)
+        if scope and not len(partition):
+            del self.partitions[scope]
+
+    def _search_partitions(self, scope: int) -> List[AssociationPartition]:
+        """Разделы в порядке поиска: сначала ассоциации чата, затем глобальные"""
+        partition = self.partitions.get(scope) if scope else None
+        return [partition, self.partitions[0]] if partition is not None else [self.partitions[0]]
+
+    def get_setting(self, key: str) -> Optional[str]:
+        try:
+            row = self.connections.reader().execute('SELECT value FROM bot_settings WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Error getting setting {key}: {e}")
+            return None
+
+    def set_setting(self, key: str, value: str):
+        try:
+            with self.connections.writer() as cursor:
+                cursor.execute(
+                    'INSERT INTO bot_settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                    (key, value)
+                )
+        except Exception as e:
+            logger.error(f"Error saving setting {key}: {e}")
+
+    def prune_association_changes(self, max_age: int = 86400) -> int:
+        """Удаление старых записей журнала изменений ассоциаций"""
+        try:
+            with self.connections.writer() as cursor:
+                cursor.execute(
+                    "DELETE FROM association_changes WHERE changed_at < CAST(strftime('%s', 'now') AS INTEGER) - ?",
+                    (max_age,)
+                )
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Error pruning association changes: {e}")
+            return 0
+
+    def add_association(self, user_id: int, sticker_id: str, association: str) -> bool:
+        """Добавление новой ассоциации"""
+        return self.add_associations(user_id, sticker_id, [association])[0]
+
+    def add_associations(
+            self,
+            user_id: int,
+            sticker_id: str,
+            associations: List[str],
+            scope: int = 0
+    ) -> List[bool]:
+        """Добавление нескольких ассоциаций одной транзакцией
+
+        Возвращает по флагу на каждую ассоциацию: True - добавлена,
+        False - уже существует (или повторяется в списке).
+        scope - id чата, в котором действуют ассоциации, 0 - везде.
+        """
+        try:
+            associations = [association.lower().strip() for association in associations]
+            with self.connections.writer() as cursor:
+                # Новые AUTOINCREMENT id всегда больше текущего значения последовательности
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'sticker_associations'")
+                row = cursor.fetchone()
+                last_id = row[0] if row else 0
+
+                sticker_ref = self._sticker_ref(cursor, sticker_id)
+                cursor.executemany(
+                    'INSERT OR IGNORE INTO sticker_associations (user_id, sticker_ref, association, scope) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(user_id, sticker_ref, association, scope) for association in associations]
+                )
+                cursor.execute(
+                    'SELECT id, association FROM sticker_associations '
+                    'WHERE sticker_ref = ? AND scope = ? AND id > ? ORDER BY id',
+                    (sticker_ref, scope, last_id)
+                )
+                inserted = cursor.fetchall()
+
+            inserted_associations = {association for _, association in inserted}
+            results = []
+            seen = set()
+            for association in associations:
+                results.append(association in inserted_associations and association not in seen)
+                seen.add(association)
+
+            with self.index_lock:
+                for row_id, association in inserted:
+                    self._index_add(row_id, sticker_ref, sticker_id, association, scope)
+            return results
+        except Exception as e:
+            logger.error(f"Error adding associations: {e}")
+            return [False] * len(associations)
+
+    @staticmethod
+    def _sticker_ref(cursor: sqlite3.Cursor, file_id: str) -> int:
+        """id стикера в таблице stickers (добавляется при первом упоминании)"""
+        cursor.execute('INSERT OR IGNORE INTO stickers (file_id) VALUES (?)', (file_id,))
+        cursor.execute('SELECT id FROM stickers WHERE file_id = ?', (file_id,))
+        return cursor.fetchone()[0]
+
+    def _lookup_sql(self, queries: List[str], scope: int) -> Optional[Tuple[str, str]]:
+        """Поиск без индекса (пока он загружается): первый из queries, содержащийся в ассоциациях
+
+        Порядок тот же, что в индексе: сначала все запросы по ассоциациям чата,
+        затем по глобальным; среди подходящих - самая новая. Все запросы
+        проверяются за один просмотр таблицы.
+        """
+        queries = [query for query in queries if query]
+        if not queries:
+            return None
+        # Ключ записи: признак ассоциации чата в старших битах, id - в младших
+        chat_flag = 1 << 40
+        best = ', '.join(
+            f'MAX(CASE WHEN instr(association, ?) > 0 THEN (scope != 0) * {chat_flag} + id END)' for _ in queries
+        )
+        conn = self.connections.reader()
+        keys = conn.execute(
+            f'SELECT {best} FROM sticker_associations WHERE scope IN (0, ?) '
+            f'AND sticker_ref NOT IN (SELECT sticker_ref FROM dead_stickers WHERE retry_at > ?)',
+            (*queries, scope, int(time.time()))
+        ).fetchone()
+        # Запрос без совпадений в чате даёт ключ глобальной ассоциации - он во втором проходе
+        for in_chat in (True, False):
+            for query, key in zip(queries, keys):
+                if key is None or (key >= chat_flag) != in_chat:
+                    continue
+                row = conn.execute(
+                    'SELECT s.file_id FROM sticker_associations a JOIN stickers s ON s.id = a.sticker_ref '
+                    'WHERE a.id = ?', (key % chat_flag,)
+                ).fetchone()
+                if row:
+                    return row[0], query
+        return None
+
+    def get_sticker_by_association(self, association: str, scope: int = 0) -> Optional[str]:
+        """Поиск стикера по ассоциации"""
+        try:
+            # Поиск по in-memory индексу вместо LIKE '%...%' по всей таблице
+            query = association.lower().strip()
+            if not self.ready.is_set():
+                result = self._lookup_sql([query], scope)
+                return result[0] if result else None
+            with self.index_lock:
+                partitions = self._search_partitions(scope)
+                skip = self.dead_stickers.skipped()
+                result = None
+                for partition in partitions:
+                    result = partition.matcher.lookup(query, skip)
+                    if result is not None:
+                        break
+                if result is None and self.fuzzy_enabled:
+                    for partition in partitions:
+                        corrected = partition.fuzzy.correct(query)
+                        if corrected != query:
+                            result = partition.matcher.lookup(corrected, skip)
+                            if result is not None:
+                                break
+            return result[1] if result else None
+        except Exception as e:
+            logger.error(f"Error getting sticker: {e}")
+            return None
+
+    def find_sticker(self, text: str, scope: int = 0) -> Optional[Tuple[str, str]]:
+        """Поиск стикера по тексту сообщения: ассоциации чата важнее глобальных"""
+        try:
+            if not self.ready.is_set():
+                # Тот же порядок, что у AssociationMatcher.match, но без опечаток
+                text = text.lower().strip()
+                return self._lookup_sql([text] + [word for word in re.findall(r'\b\w+\b', text) if len(word) >= 2], scope)
+            with self.index_lock:
+                partitions = self._search_partitions(scope)
+                skip = self.dead_stickers.skipped()
+                for partition in partitions:
+                    match = partition.matcher.match(text, skip)
+                    if match is not None:
+                        return match
+                if not self.fuzzy_enabled:
+                    return None
+
+                # Точного совпадения нет - пробуем текст с исправленными опечатками
+                text = text.lower().strip()
+                match = None
+                for partition in partitions:
+                    corrected = partition.fuzzy.correct(text)
+                    if corrected != text:
+                        match = partition.matcher.match(corrected, skip)
+                        if match is not None:
+                            break
+            metrics.inc("stickerbot_fuzzy_total", result="hit" if match else "miss")
+            return match
+        except Exception as e:
+            logger.error(f"Error matching sticker: {e}")
+            return None
+
+    def search_stickers(self, query: str, limit: int = 200) -> List[Tuple[str, str]]:
+        """Стикеры для inline-режима: (sticker_id, ассоциация) по убыванию релевантности"""
+        try:
+            query = query.lower().strip()
+            conn = self.connections.reader()
+            if query:
+                with self.index_lock:
+                    candidates = self.index.rank_candidates(query)
+                usage = {}
+                texts = [association for _, association in candidates]
+                # Частота использования по агрегату association_usage (поиск по первичному ключу)
+                for i in range(0, len(texts), 500):
+                    chunk = texts[i:i + 500]
+                    usage.update(conn.execute(
+                        f'SELECT association, usage_count FROM association_usage '
+                        f'WHERE association IN ({",".join("?" * len(chunk))})',
+                        chunk
+                    ).fetchall())
+                candidates.sort(key=lambda c: (c[0], usage.get(c[1], 0)), reverse=True)
+            else:
+                # Пустой запрос - самые популярные ассоциации
+                cursor = conn.execute(
+                    'SELECT association FROM association_usage ORDER BY usage_count DESC LIMIT ?', (limit,)
+                )
+                candidates = [(0, association) for association, in cursor]
+
+            results = []
+            seen = set()
+            with self.index_lock:
+                skip = self.dead_stickers.skipped()
+                refs = self.index.rows.columns.refs
+                for _, association in candidates:
+                    # У одного текста - сначала самые новые стикеры
+                    for row_id in reversed(self.index.by_text.get(association, ())):
+                        if refs[row_id] in skip:
+                            continue
+                        sticker_id = self.index.rows[row_id][0]
+                        if sticker_id in seen:
+                            continue
+                        seen.add(sticker_id)
+                        results.append((sticker_id, association))
+                        if len(results) >= limit:
+                            return results
+            return results
+        except Exception as e:
+            logger.error(f"Error searching stickers: {e}")
+            return []
+
+    def get_user_associations(self, user_id: int) -> List[tuple]:
+        """Получение всех ассоциаций пользователя"""
+        try:
+            cursor = self.connections.reader().execute(
+                f'SELECT {self.STICKER_FILE_ID}, association, created_at FROM sticker_associations WHERE user_id = ? '
+                'ORDER BY created_at DESC, id DESC',
+                (user_id,)
+            )
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting user associations: {e}")
+            return []
+
+    def get_user_associations_after(self, user_id: int, row_id: int) -> Optional[List[tuple]]:
+        """Ассоциации пользователя с id больше row_id в порядке показа
+
+        None, если новые записи при сортировке по (created_at, id) попадают не
+        только перед старыми (например, часы сервера перевели назад) - тогда их
+        нельзя просто добавить в начало уже загруженного списка.
+        """
+        try:
+            conn = self.connections.reader()
+            rows = conn.execute(
+                f'SELECT id, {self.STICKER_FILE_ID}, association, created_at FROM sticker_associations '
+                'WHERE user_id = ? AND id > ? ORDER BY created_at DESC, id DESC',
+                (user_id, row_id)
+            ).fetchall()
+            if rows:
+                oldest_id, _, _, oldest_created_at = rows[-1]
+                newer_old_row = conn.execute(
+                    'SELECT 1 FROM sticker_associations WHERE user_id = ? AND id <= ? AND (created_at, id) > (?, ?) LIMIT 1',
+                    (user_id, row_id, oldest_created_at, oldest_id)
+                ).fetchone()
+                if newer_old_row is not None:
+                    return None
+            return rows
+        except Exception as e:
+            logger.error(f"Error getting new user associations: {e}")
+            return None
+
+    def get_user_collection_version(self, user_id: int) -> Tuple[int, int]:
+        """Версия коллекции пользователя: (число ассоциаций, максимальный id)
+
+        id не переиспользуются (AUTOINCREMENT), поэтому любое изменение
+        набора записей меняет хотя бы одно из значений.
+        """
+        try:
+            row = self.connections.reader().execute(
+                'SELECT (SELECT associations FROM user_refcounts WHERE user_id = ?), '
+                '(SELECT MAX(id) FROM sticker_associations WHERE user_id = ?)',
+                (user_id, user_id)
+            ).fetchone()
+            return row[0] or 0, row[1] or 0
+        except Exception as e:
+            logger.error(f"Error getting user collection version: {e}")
+            return 0, 0
+
+    def count_user_associations(self, user_id: int) -> Tuple[int, int]:
+        """Размер коллекции пользователя: (число стикеров, число ассоциаций)
+
+        Число ассоциаций - из user_refcounts, стикеры считаются в SQL без
+        выборки самих записей.
+        """
+        try:
+            row = self.connections.reader().execute(
+                'SELECT (SELECT COUNT(DISTINCT sticker_ref) FROM sticker_associations WHERE user_id = ?), '
+                '(SELECT associations FROM user_refcounts WHERE user_id = ?)',
+                (user_id, user_id)
+            ).fetchone()
+            return row[0] or 0, row[1] or 0
+        except Exception as e:
+            logger.error(f"Error counting user associations: {e}")
+            return 0, 0
+
+    def get_user_associations_page(
+            self,
+            user_id: int,
+            anchor: Optional[Tuple[int, int]] = None,
+            direction: str = 'next',
+            limit: int = 8
+    ) -> Tuple[List[tuple], bool, bool]:
+        """Страница ассоциаций пользователя по ключу (created_at, id)
+
+        anchor - (id, unix-время created_at) граничной записи. direction:
+        'next' - записи старше anchor, 'prev' - новее anchor,
+        'from' - начиная с anchor включительно.
+        Возвращает (строки, есть_предыдущая, есть_следующая); строка -
+        (id, sticker_id, association, created_at, unix-время created_at).
+        """
+        columns = f"id, {self.STICKER_FILE_ID}, association, created_at, CAST(strftime('%s', created_at) AS INTEGER)"
+        key = "(created_at, id)"
+        bound = "(datetime(?, 'unixepoch'), ?)"
+        try:
+            cursor = self.connections.reader().cursor()
+            if anchor is None:
+                cursor.execute(
+                    f'SELECT {columns} FROM sticker_associations WHERE user_id = ? '
+                    f'ORDER BY created_at DESC, id DESC LIMIT ?',
+                    (user_id, limit)
+                )
+                rows = cursor.fetchall()
+            elif direction == 'prev':
+                cursor.execute(
+                    f'SELECT {columns} FROM sticker_associations WHERE user_id = ? AND {key} > {bound} '
+                    f'ORDER BY created_at ASC, id ASC LIMIT ?',
+                    (user_id, anchor[1], anchor[0], limit)
+                )
+                rows = cursor.fetchall()[::-1]
+            else:
+                op = '<=' if direction == 'from' else '<'
+                cursor.execute(
+                    f'SELECT {columns} FROM sticker_associations WHERE user_id = ? AND {key} {op} {bound} '
+                    f'ORDER BY created_at DESC, id DESC LIMIT ?',
+                    (user_id, anchor[1], anchor[0], limit)
+                )
+                rows = cursor.fetchall()
+
+            if not rows:
+                return [], False, False
+
+            first, last = rows[0], rows[-1]
+            cursor.execute(
+                f'SELECT EXISTS(SELECT 1 FROM sticker_associations WHERE user_id = ? AND {key} > {bound})',
+                (user_id, first[4], first[0])
+            )
+            has_prev = bool(cursor.fetchone()[0])
+            cursor.execute(
+                f'SELECT EXISTS(SELECT 1 FROM sticker_associations WHERE user_id = ? AND {key} < {bound})',
+                (user_id, last[4], last[0])
+            )
+            has_next = bool(cursor.fetchone()[0])
+            return rows, has_prev, has_next
+        except Exception as e:
+            logger.error(f"Error getting user associations page: {e}")
+            return [], False, False
+
+    def delete_association_by_id(self, user_id: int, row_id: int) -> Optional[Tuple[str, str]]:
+        """Удаление ассоциации по id: (sticker_id, association) удалённой записи"""
+        try:
+            with self.connections.writer() as cursor:
+                cursor.execute(
+                    f'SELECT {self.STICKER_FILE_ID}, association FROM sticker_associations WHERE id = ? AND user_id = ?',
+                    (row_id, user_id)
+                )
+                row = cursor.fetchone()
+                if row:
+                    cursor.execute('DELETE FROM sticker_associations WHERE id = ?', (row_id,))
+            if row:
+                with self.index_lock:
+                    self._index_remove(row_id)
+            return row
+        except Exception as e:
+            logger.error(f"Error deleting association: {e}")
+            return None
+
+    def delete_association(self, user_id: int, sticker_id: str, association: str) -> bool:
+        """Удаление ассоциации"""
+        try:
+            with self.connections.writer() as cursor:
+                cursor.execute(
+                    'SELECT id FROM sticker_associations WHERE user_id = ? AND association = ? '
+                    'AND sticker_ref = (SELECT id FROM stickers WHERE file_id = ?)',
+                    (user_id, association, sticker_id)
+                )
+                row = cursor.fetchone()
+                success = False
+                if row:
+                    cursor.execute('DELETE FROM sticker_associations WHERE id = ?', (row[0],))
+                    success = cursor.rowcount > 0
+            if success:
+                with self.index_lock:
+                    self._index_remove(row[0])
+            return success
+        except Exception as e:
+            logger.error(f"Error deleting association: {e}")
+            return False
+
+    def load_dead_stickers(self) -> int:
+        """Перечитывание отметок недействительных стикеров (их ставят и другие процессы)"""
+        try:
+            rows = self.connections.reader().execute(
+                'SELECT s.file_id, d.sticker_ref, d.retry_at FROM dead_stickers d JOIN stickers s ON s.id = d.sticker_ref'
+            ).fetchall()
+            with self.index_lock:
+                self.dead_stickers.replace({file_id: (sticker_ref, retry_at) for file_id, sticker_ref, retry_at in rows})
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Error loading dead stickers: {e}")
+            return 0
+
+    def mark_sticker_dead(
+            self,
+            file_id: str,
+            error: str,
+            backoff: int = DEAD_STICKER_BACKOFF,
+            max_backoff: int = DEAD_STICKER_MAX_BACKOFF
+    ) -> int:
+        """Учёт отказа Telegram принять file_id: число отказов подряд (0 - стикера нет в базе)
+
+        Стикер пропускается при поиске backoff секунд, каждый следующий отказ
+        удваивает срок, но не больше max_backoff.
+        """
+        try:
+            with self.connections.writer() as cursor:
+                cursor.execute('SELECT id FROM stickers WHERE file_id = ?', (file_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return 0
+                cursor.execute('''
+                    INSERT INTO dead_stickers (sticker_ref, error, retry_at)
+                    VALUES (?, ?, CAST(strftime('%s', 'now') AS INTEGER) + ?)
+                    ON CONFLICT(sticker_ref) DO UPDATE SET
+                        failures = failures + 1,
+                        error = excluded.error,
+                        failed_at = CURRENT_TIMESTAMP,
+                        retry_at = CAST(strftime('%s', 'now') AS INTEGER) + MIN(? << MIN(failures, 30), ?)
+                ''', (row[0], error[:500], min(backoff, max_backoff), backoff, max_backoff))
+                cursor.execute('SELECT failures, retry_at FROM dead_stickers WHERE sticker_ref = ?', (row[0],))
+                failures, retry_at = cursor.fetchone()
+            with self.index_lock:
+                self.dead_stickers.set(file_id, row[0], retry_at)
+            return failures
+        except Exception as e:
+            logger.error(f"Error marking dead sticker: {e}")
+            return 0
+
+    def clear_dead_sticker(self, file_id: str) -> bool:
+        """Снятие отметки: стикер снова принимается Telegram"""
+        try:
+            with self.connections.writer() as cursor:
+                cursor.execute(
+                    'DELETE FROM dead_stickers WHERE sticker_ref = (SELECT id FROM stickers WHERE file_id = ?)',
+                    (file_id,)
+                )
+                cleared = cursor.rowcount > 0
+            with self.index_lock:
+                self.dead_stickers.discard(file_id)
+            return cleared
+        except Exception as e:
+            logger.error(f"Error clearing dead sticker: {e}")
+            return False
+
+    def get_stickers_to_validate(self, after: int, limit: int = 100) -> List[Tuple[int, str, int]]:
+        """Используемые стикеры (id, file_id, отказов подряд) с id больше after, кроме ожидающих повтора"""
+        try:
+            return self.connections.reader().execute('''
+                SELECT s.id, s.file_id, COALESCE(d.failures, 0)
+                FROM sticker_refcounts r
+                JOIN stickers s ON s.id = r.sticker_ref
+                LEFT JOIN dead_stickers d ON d.sticker_ref = r.sticker_ref
+                WHERE r.sticker_ref > ? AND (d.retry_at IS NULL OR d.retry_at <= CAST(strftime('%s', 'now') AS INTEGER))
+                ORDER BY r.sticker_ref
+                LIMIT ?
+            ''', (after, limit)).fetchall()
+        except Exception as e:
+            logger.error(f"Error getting stickers to validate: {e}")
+            return []
+
+    def get_dead_stickers_report(self, limit: int = 10) -> Dict:
+        """Недействительные стикеры для очистки: итоги и самые используемые из них"""
+        try:
+            conn = self.connections.reader()
+            stickers, associations, purgeable = conn.execute('''
+                SELECT COUNT(*), COALESCE(SUM(r.associations), 0),
+                       COALESCE(SUM(CASE WHEN d.failures >= ? THEN r.associations END), 0)
+                FROM dead_stickers d
+                LEFT JOIN sticker_refcounts r ON r.sticker_ref = d.sticker_ref
+            ''', (DEAD_STICKER_PURGE_FAILURES,)).fetchone()
+            top = conn.execute('''
+                SELECT s.file_id, d.failures, COALESCE(r.associations, 0), d.error
+                FROM dead_stickers d
+                JOIN stickers s ON s.id = d.sticker_ref
+                LEFT JOIN sticker_refcounts r ON r.sticker_ref = d.sticker_ref
+                ORDER BY COALESCE(r.associations, 0) DESC, d.failures DESC
+                LIMIT ?
+            ''', (limit,)).fetchall()
+            return {'stickers': stickers, 'associations': associations, 'purgeable': purgeable, 'top': top}
+        except Exception as e:
+            logger.error(f"Error getting dead stickers report: {e}")
+            return {'stickers': 0, 'associations': 0, 'purgeable': 0, 'top': []}
+
+    def purge_dead_stickers(self, min_failures: int = DEAD_STICKER_PURGE_FAILURES) -> Tuple[int, int]:
+        """Удаление ассоциаций стикеров, отклонённых min_failures раз подряд: (стикеров, ассоциаций)"""
+        try:
+            with self.connections.writer() as cursor:
+                cursor.execute('SELECT sticker_ref FROM dead_stickers WHERE failures >= ?', (min_failures,))
+                refs = [row[0] for row in cursor.fetchall()]
+                row_ids = []
+                for i in range(0, len(refs), 500):
+                    chunk = refs[i:i + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    cursor.execute(f'SELECT id FROM sticker_associations WHERE sticker_ref IN ({placeholders})', chunk)
+                    row_ids.extend(row[0] for row in cursor.fetchall())
+                    cursor.execute(f'DELETE FROM sticker_associations WHERE sticker_ref IN ({placeholders})', chunk)
+                    cursor.execute(f'DELETE FROM dead_stickers WHERE sticker_ref IN ({placeholders})', chunk)
+            with self.index_lock:
+                for row_id in row_ids:
+                    self._index_remove(row_id)
+            self.load_dead_stickers()
+            return len(refs), len(row_ids)
+        except Exception as e:
+            logger.error(f"Error purging dead stickers: {e}")
+            return 0, 0
+
+    def import_associations(
+            self,
+            records: Iterable[Optional[tuple]],
+            default_user_id: int = 0,
+            batch_size: int = 5000,
+            progress=None,
+            update_index: bool = True
+    ) -> Dict:
+        """Потоковая загрузка записей (sticker_id, association, user_id, scope) пакетными транзакциями
+
+        Дубликаты по UNIQUE(scope, sticker_ref, association) пропускаются, None и
+        записи без стикера или с ассоциацией короче 3 символов считаются
+        некорректными. progress(stats) вызывается после каждого пакета.
+        update_index=False - не обновлять in-memory индексы этого процесса
+        (CLI: работающий бот подхватит изменения через association_changes).
+        """
+        stats = {'rows': 0, 'inserted': 0, 'duplicates': 0, 'invalid': 0, 'elapsed': 0.0, 'rows_per_sec': 0.0}
+        started = time.perf_counter()
+
+        def flush(batch: List[tuple]):
+            with self.connections.writer() as cursor:
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'sticker_associations'")
+                row = cursor.fetchone()
+                last_id = row[0] if row else 0
+                cursor.executemany(
+                    'INSERT OR IGNORE INTO stickers (file_id) VALUES (?)',
+                    [(sticker_id,) for sticker_id in dict.fromkeys(record[1] for record in batch)]
+                )
+                cursor.executemany(
+                    'INSERT OR IGNORE INTO sticker_associations (user_id, sticker_ref, association, scope) '
+                    'SELECT ?, id, ?, ? FROM stickers WHERE file_id = ?',
+                    [(user_id, association, scope, sticker_id) for user_id, sticker_id, association, scope in batch]
+                )
+                cursor.execute(
+                    'SELECT a.id, a.sticker_ref, s.file_id, a.association, a.scope '
+                    'FROM sticker_associations a JOIN stickers s ON s.id = a.sticker_ref '
+                    'WHERE a.id > ? ORDER BY a.id',
+                    (last_id,)
+                )
+                inserted = cursor.fetchall()
+            if update_index:
+                with self.index_lock:
+                    for row_id, sticker_ref, sticker_id, association, scope in inserted:
+                        self._index_add(row_id, sticker_ref, sticker_id, association, scope)
+
+            stats['inserted'] += len(inserted)
+            stats['duplicates'] += len(batch) - len(inserted)
+            stats['elapsed'] = time.perf_counter() - started
+            stats['rows_per_sec'] = stats['rows'] / stats['elapsed'] if stats['elapsed'] else 0.0
+            if progress is not None:
+                progress(dict(stats))
+
+        batch = []
+        for record in records:
+            stats['rows'] += 1
+            try:
+                sticker_id, association, user_id, scope = record
+                sticker_id = str(sticker_id or '').strip()
+                association = str(association or '').lower().strip()
+                user_id = int(user_id) if user_id not in (None, '') else default_user_id
+                # Файлы без колонки scope - глобальные ассоциации
+                scope = int(scope) if scope not in (None, '') else 0
+            except (TypeError, ValueError):
+                stats['invalid'] += 1
+                continue
+            if not sticker_id or len(association) < 3:
+                stats['invalid'] += 1
+                continue
+            batch.append((user_id, sticker_id, association, scope))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+        stats['elapsed'] = time.perf_counter() - started
+        stats['rows_per_sec'] = stats['rows'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        return stats
+
+    def iter_associations(self, batch_size: int = 5000):
+        """Потоковое чтение всех ассоциаций: (sticker_id, association, user_id, scope) в порядке id"""
+        cursor = self.connections.reader().execute(
+            'SELECT s.file_id, a.association, a.user_id, a.scope '
+            'FROM sticker_associations a JOIN stickers s ON s.id = a.sticker_ref ORDER BY a.id'
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def import_file(self, path: str, default_user_id: int = 0, progress=None, update_index: bool = True) -> Dict:
+        """Импорт ассоциаций из JSONL или CSV файла"""
+        with open(path, newline='', encoding='utf-8') as file:
+            return self.import_associations(
+                read_association_records(file, transfer_format(path)),
+                default_user_id,
+                progress=progress,
+                update_index=update_index
+            )
+
+    def export_file(self, path: str, progress=None) -> int:
+        """Экспорт всех ассоциаций в JSONL или CSV файл"""
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            return write_association_records(file, self.iter_associations(), transfer_format(path), progress)
+
+    def log_usage(self, user_id: int, sticker_id: str, association: str):
+        """Логирование использования стикера"""
+        try:
+            with self.connections.writer() as cursor:
+                cursor.execute(
+                    'INSERT INTO usage_stats (user_id, sticker_id, association) VALUES (?, ?, ?)',
+                    (user_id, sticker_id, association)
+                )
+        except Exception as e:
+            logger.error(f"Error logging usage: {e}")
+
+    def log_usage_batch(self, events: List[Tuple[int, str, str]]):
+        """Пакетное логирование использования одной транзакцией"""
+        try:
+            with self.connections.writer() as cursor:
+                cursor.executemany(
+                    'INSERT INTO usage_stats (user_id, sticker_id, association) VALUES (?, ?, ?)',
+                    events
+                )
+        except Exception as e:
+            logger.error(f"Error logging usage batch: {e}")
+
+    def prune_usage(self, retention_days: int, archive_path: Optional[str] = None, batch_size: int = 10000) -> int:
+        """Удаление событий старше retention_days с опциональной выгрузкой в архив"""
+        # Дневные агрегаты в usage_daily уже заполнены триггером при вставке,
+        # поэтому старые сырые события можно просто удалить
+        cutoff = f'-{int(retention_days)} days'
+        archive = gzip.open(archive_path, 'at', encoding='utf-8') if archive_path else None
+        removed = 0
+        try:
+            while True:
+                with self.connections.writer() as cursor:
+                    cursor.execute(
+                        "SELECT id, user_id, sticker_id, association, used_at FROM usage_stats "
+                        "WHERE used_at < datetime('now', ?) ORDER BY id LIMIT ?",
+                        (cutoff, batch_size)
+                    )
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    cursor.executemany('DELETE FROM usage_stats WHERE id = ?', ((row[0],) for row in rows))
+                # В архив - только после фиксации удаления: откат пачки не оставит в нём дублей
+                if archive:
+                    for row_id, user_id, sticker_id, association, used_at in rows:
+                        archive.write(json.dumps({
+                            'id': row_id,
+                            'user_id': user_id,
+                            'sticker_id': sticker_id,
+                            'association': association,
+                            'used_at': used_at
+                        }, ensure_ascii=False) + '\n')
+                removed += len(rows)
+        except Exception as e:
+            logger.error(f"Error pruning usage stats: {e}")
+        finally:
+            if archive:
+                archive.close()
+        return removed
+
+    def load_fsm(self, since: float) -> List[tuple]:
+        """Состояния FSM, изменённые не раньше since: (key, state, data, updated_at)"""
+        try:
+            cursor = self.connections.reader().execute(
+                'SELECT key, state, data, updated_at FROM fsm_storage WHERE updated_at >= ?',
+                (since,)
+            )
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error loading FSM storage: {e}")
+            return []
+
+    def save_fsm(self, upserts: List[tuple], deletes: List[str]):
+        """Пакетная запись изменённых состояний FSM одной транзакцией"""
+        with self.connections.writer() as cursor:
+            if upserts:
+                cursor.executemany(
+                    'INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, '
+                    'updated_at = excluded.updated_at',
+                    upserts
+                )
+            if deletes:
+                cursor.executemany('DELETE FROM fsm_storage WHERE key = ?', ((key,) for key in deletes))
+
+    def expire_fsm(self, before: float) -> int:
+        """Удаление брошенных сценариев FSM"""
+        try:
+            with self.connections.writer() as cursor:
+                cursor.execute('DELETE FROM fsm_storage WHERE updated_at < ?', (before,))
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Error expiring FSM storage: {e}")
+            return 0
+
+    def vacuum(self, pages: int = 0):
+        """Инкрементальное освобождение места в файле базы данных (только в режиме auto_vacuum=INCREMENTAL)"""
+        try:
+            with self.connections.maintenance() as conn:
+                if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                    # Перевод режима требует полного VACUUM, блокирующего запись, - только вручную
+                    if not self._vacuum_warned:
+                        logger.warning(
+                            "База не в режиме auto_vacuum=INCREMENTAL, место не освобождается; "
+                            "остановите бота и выполните: python main.py vacuum"
+                        )
+                        self._vacuum_warned = True
+                    return
+                conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+        except Exception as e:
+            logger.error(f"Error vacuuming database: {e}")
+
+    def enable_incremental_vacuum(self) -> bool:
+        """Перевод базы в режим auto_vacuum=INCREMENTAL полным VACUUM (при остановленном боте)"""
+        with self.connections.maintenance() as conn:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                return False
+            logger.info("Перевод базы данных в режим auto_vacuum=INCREMENTAL...")
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+            return True
+
+    def get_stats(self) -> Dict:
+        """Получение статистики"""
+        try:
+            cursor = self.connections.reader().cursor()
+
+            # Счётчики поддерживаются триггерами при записи
+            cursor.execute('SELECT name, value FROM stats_counters')
+            counters = dict(cursor.fetchall())
+
+            # Топ ассоциаций по предагрегированным счётчикам
+            cursor.execute(
+                'SELECT association, usage_count FROM association_usage ORDER BY usage_count DESC LIMIT 10'
+            )
+            top_associations = cursor.fetchall()
+
+            return {
+                'total_associations': counters.get('total_associations', 0),
+                'unique_stickers': counters.get('unique_stickers', 0),
+                'total_users': counters.get('total_users', 0),
+                'total_usages': counters.get('total_usages', 0),
+                'top_associations': top_associations
+            }
+        except Exception as e:
+            logger.error(f"Error getting stats: {e}")
+            return {}
+
+
+# Формат файлов импорта и экспорта ассоциаций
+TRANSFER_FIELDS = ('sticker_id', 'association', 'user_id', 'scope')
+
+
+def transfer_format(path: str) -> str:
+    """csv для *.csv, иначе JSONL"""
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def read_association_records(file, fmt: str = 'jsonl'):
+    """Записи (sticker_id, association, user_id, scope) из файла; None для нечитаемых строк"""
+    if fmt == 'csv':
+        for record in csv.DictReader(file):
+            yield tuple(record.get(field) for field in TRANSFER_FIELDS)
+        return
+
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            yield tuple(record.get(field) for field in TRANSFER_FIELDS)
+        except (ValueError, AttributeError):
+            yield None
+
+
+def write_association_records(file, records, fmt: str = 'jsonl', progress=None, progress_every: int = 50000) -> int:
+    """Запись потока (sticker_id, association, user_id, scope) в файл, возвращает количество строк"""
+    writer = csv.writer(file) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(TRANSFER_FIELDS)
+
+    count = 0
+    for record in records:
+        if writer is not None:
+            writer.writerow(record)
+        else:
+            file.write(json.dumps(dict(zip(TRANSFER_FIELDS, record)), ensure_ascii=False) + '\n')
+        count += 1
+        if progress is not None and count % progress_every == 0:
+            progress(count)
+    return count
+
+
+# Асинхронный доступ к базе данных для хендлеров
+class AsyncStickerDatabase:
+    """Выполнение методов StickerDatabase в пуле потоков, не блокируя event loop"""
+
+    def __init__(self, database: StickerDatabase, max_workers: int = int(os.getenv("DB_THREADS", "4"))):
+        self.db = database
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sticker-db")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        if not metrics.sampled():
+            return await loop.run_in_executor(self.executor, func, *args)
+        return await loop.run_in_executor(self.executor, self._timed, func, time.perf_counter(), *args)
+
+    @staticmethod
+    def _timed(func, queued_at: float, *args):
+        """Замер ожидания в очереди пула и выполнения метода базы"""
+        started = time.perf_counter()
+        metrics.observe("stickerbot_db_wait_seconds", started - queued_at)
+        try:
+            return func(*args)
+        finally:
+            metrics.observe("stickerbot_db_seconds", time.perf_counter() - started, method=func.__name__)
+
+    async def add_association(self, user_id: int, sticker_id: str, association: str) -> bool:
+        return await self._run(self.db.add_association, user_id, sticker_id, association)
+
+    async def add_associations(
+            self,
+            user_id: int,
+            sticker_id: str,
+            associations: List[str],
+            scope: int = 0
+    ) -> List[bool]:
+        return await self._run(self.db.add_associations, user_id, sticker_id, associations, scope)
+
+    async def get_sticker_by_association(self, association: str, scope: int = 0) -> Optional[str]:
+        return await self._run(self.db.get_sticker_by_association, association, scope)
+
+    async def find_sticker(self, text: str, scope: int = 0) -> Optional[Tuple[str, str]]:
+        return await self._run(self.db.find_sticker, text, scope)
+
+    async def search_stickers(self, query: str, limit: int = 200) -> List[Tuple[str, str]]:
+        return await self._run(self.db.search_stickers, query, limit)
+
+    async def get_user_associations(self, user_id: int) -> List[tuple]:
+        return await self._run(self.db.get_user_associations, user_id)
+
+    async def get_user_associations_after(self, user_id: int, row_id: int) -> Optional[List[tuple]]:
+        return await self._run(self.db.get_user_associations_after, user_id, row_id)
+
+    async def get_user_collection_version(self, user_id: int) -> Tuple[int, int]:
+        return await self._run(self.db.get_user_collection_version, user_id)
+
+    async def count_user_associations(self, user_id: int) -> Tuple[int, int]:
+        return await self._run(self.db.count_user_associations, user_id)
+
+    async def get_user_associations_page(
+            self,
+            user_id: int,
+            anchor: Optional[Tuple[int, int]] = None,
+            direction: str = 'next',
+            limit: int = 8
+    ) -> Tuple[List[tuple], bool, bool]:
+        return await self._run(self.db.get_user_associations_page, user_id, anchor, direction, limit)
+
+    async def delete_association(self, user_id: int, sticker_id: str, association: str) -> bool:
+        return await self._run(self.db.delete_association, user_id, sticker_id, association)
+
+    async def delete_association_by_id(self, user_id: int, row_id: int) -> Optional[Tuple[str, str]]:
+        return await self._run(self.db.delete_association_by_id, user_id, row_id)
+
+    async def load_dead_stickers(self) -> int:
+        return await self._run(self.db.load_dead_stickers)
+
+    async def mark_sticker_dead(self, file_id: str, error: str) -> int:
+        return await self._run(self.db.mark_sticker_dead, file_id, error)
+
+    async def clear_dead_sticker(self, file_id: str) -> bool:
+        return await self._run(self.db.clear_dead_sticker, file_id)
+
+    async def get_stickers_to_validate(self, after: int, limit: int = 100) -> List[Tuple[int, str, int]]:
+        return await self._run(self.db.get_stickers_to_validate, after, limit)
+
+    async def get_dead_stickers_report(self, limit: int = 10) -> Dict:
+        return await self._run(self.db.get_dead_stickers_report, limit)
+
+    async def purge_dead_stickers(self, min_failures: int = DEAD_STICKER_PURGE_FAILURES) -> Tuple[int, int]:
+        return await self._run(self.db.purge_dead_stickers, min_failures)
+
+    async def log_usage(self, user_id: int, sticker_id: str, association: str):
+        return await self._run(self.db.log_usage, user_id, sticker_id, association)
+
+    async def log_usage_batch(self, events: List[Tuple[int, str, str]]):
+        return await self._run(self.db.log_usage_batch, events)
+
+    async def get_stats(self) -> Dict:
+        return await self._run(self.db.get_stats)
+
+    async def prune_usage(self, retention_days: int, archive_path: Optional[str] = None) -> int:
+        return await self._run(self.db.prune_usage, retention_days, archive_path)
+
+    async def vacuum(self, pages: int = 0):
+        return await self._run(self.db.vacuum, pages)
+
+    async def import_file(self, path: str, default_user_id: int = 0, progress=None) -> Dict:
+        return await self._run(self.db.import_file, path, default_user_id, progress)
+
+    async def export_file(self, path: str) -> int:
+        return await self._run(self.db.export_file, path)
+
+    async def sync_index(self) -> int:
+        return await self._run(self.db.sync_index)
+
+    async def prune_association_changes(self, max_age: int = 86400) -> int:
+        return await self._run(self.db.prune_association_changes, max_age)
+
+    async def get_setting(self, key: str) -> Optional[str]:
+        return await self._run(self.db.get_setting, key)
+
+    async def set_setting(self, key: str, value: str):
+        return await self._run(self.db.set_setting, key, value)
+
+    async def load_fsm(self, since: float) -> List[tuple]:
+        return await self._run(self.db.load_fsm, since)
+
+    async def save_fsm(self, upserts: List[tuple], deletes: List[str]):
+        return await self._run(self.db.save_fsm, upserts, deletes)
+
+    async def expire_fsm(self, before: float) -> int:
+        return await self._run(self.db.expire_fsm, before)
+
+    def close(self):
+        """Ожидание текущих запросов и закрытие соединений"""
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+
+# Буферизованная запись статистики использования
+class UsageLogger:
+    """Очередь событий использования с пакетной записью в базу"""
+
+    def __init__(
+            self,
+            database: AsyncStickerDatabase,
+            batch_size: int = int(os.getenv("USAGE_BATCH_SIZE", "200")),
+            flush_interval: float = float(os.getenv("USAGE_FLUSH_INTERVAL", "2")),
+            max_queue_size: int = int(os.getenv("USAGE_QUEUE_SIZE", "10000"))
+    ):
+        self.db = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Ограниченная очередь: при переполнении log() ждёт освобождения места
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск фоновой записи"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def log(self, user_id: int, sticker_id: str, association: str):
+        """Постановка события использования в очередь"""
+        await self.queue.put((user_id, sticker_id, association))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            event = await self.queue.get()
+            if event is None:
+                break
+
+            # Копим пакет до batch_size событий или flush_interval секунд
+            batch = [event]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+
+            await self.db.log_usage_batch(batch)
+
+    async def stop(self):
+        """Остановка с гарантированной записью накопленных событий"""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+
+
+# Политика хранения статистики использования
+class UsageRetention:
+    """Фоновая очистка старых событий usage_stats с архивированием и VACUUM"""
+
+    def __init__(
+            self,
+            database: AsyncStickerDatabase,
+            retention_days: int = int(os.getenv("USAGE_RETENTION_DAYS", "90")),
+            archive_dir: Optional[str] = os.getenv("USAGE_ARCHIVE_DIR"),
+            interval: float = float(os.getenv("USAGE_RETENTION_INTERVAL", "3600"))
+    ):
+        self.db = database
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск фоновой задачи (0 дней хранения - политика отключена)"""
+        if self._task is None and self.retention_days > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def run_once(self) -> int:
+        """Один проход очистки"""
+        archive_path = None
+        if self.archive_dir:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            archive_path = os.path.join(self.archive_dir, f"usage_{datetime.now():%Y%m%d}.jsonl.gz")
+
+        removed = await self.db.prune_usage(self.retention_days, archive_path)
+        if removed:
+            logger.info(f"Удалено событий статистики старше {self.retention_days} дн.: {removed}")
+        await self.db.prune_association_changes()
+        await self.db.vacuum()
+        return removed
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Error in usage retention: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        """Остановка фоновой задачи"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+# Синхронизация in-memory индекса с другими процессами
+class IndexSync:
+    """Периодическое применение журнала изменений ассоциаций к индексу и перечитывание отметок стикеров"""
+
+    def __init__(
+            self,
+            database: AsyncStickerDatabase,
+            interval: float = float(os.getenv("INDEX_SYNC_INTERVAL", "1")),
+            dead_interval: float = float(os.getenv("DEAD_STICKER_SYNC_INTERVAL", "30"))
+    ):
+        self.db = database
+        self.interval = interval
+        self.dead_interval = dead_interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        dead_loaded = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.db.sync_index()
+            if time.monotonic() - dead_loaded >= self.dead_interval:
+                await self.db.load_dead_stickers()
+                dead_loaded = time.monotonic()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
 
-# Глобальное хранилище для текущих сессий просмотра ассоциаций
-user_sessions = {}
 
+# Ошибки Bot API, означающие, что file_id больше не действителен
+DEAD_FILE_ERRORS = ('file identifier', 'file_id', 'file reference', 'file_reference')
 
-# Состояния для FSM
-class StickerStates(StatesGroup):
-    waiting_for_associations = State()
-    waiting_for_sticker = State()
-    editing_associations = State()
 
+def is_dead_file_error(error: Exception) -> bool:
+    """Telegram не принимает file_id (в отличие от сетевых ошибок, лимитов и прав в чате)"""
+    return isinstance(error, TelegramBadRequest) and any(part in error.message.lower() for part in DEAD_FILE_ERRORS)
 
-# Класс для работы с базой данных
-class StickerDatabase:
-    def __init__(self, db_path: str = os.getenv("DATABASE_PATH")):
-        self.db_path = db_path
-        self.init_db()
 
-    def init_db(self):
-        """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+# Проверка сохранённых file_id
+class StickerValidator:
+    """Фоновая проверка стикеров через getFile пачками с ограничением частоты
 
-        # Таблица для стикеров и ассоциаций
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sticker_associations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                sticker_id TEXT NOT NULL,
-                association TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(sticker_id, association)
-            )
-        ''')
+    Недействительные file_id отмечаются так же, как при ошибке отправки,
+    итог прохода с новыми находками отправляется админам для очистки.
+    """
 
-        # Таблица для статистики использования
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usage_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                sticker_id TEXT NOT NULL,
-                association TEXT NOT NULL,
-                used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    def __init__(
+            self,
+            database: AsyncStickerDatabase,
+            interval: float = STICKER_VALIDATION_INTERVAL,
+            rate: float = STICKER_VALIDATION_RATE,
+            batch_size: int = 100
+    ):
+        self.db = database
+        self.interval = interval
+        self.rate = rate
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot: Bot):
+        """Запуск фоновой задачи (интервал 0 - проверка отключена)"""
+        if self._task is None and self.interval > 0 and self.rate > 0:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def run_once(self, bot: Bot) -> Dict:
+        """Один проход по всем стикерам; позиция сохраняется, прерванный проход продолжается"""
+        stats = {'checked': 0, 'dead': 0, 'restored': 0, 'complete': False}
+        after = int(await self.db.get_setting('sticker_validation_cursor') or 0)
+        while True:
+            batch = await self.db.get_stickers_to_validate(after, self.batch_size)
+            if not batch:
+                break
+            for sticker_ref, file_id, failures in batch:
+                if not await self._check(bot, file_id, failures, stats):
+                    # Сеть или Bot API недоступны - продолжим со следующего прохода
+                    await self.db.set_setting('sticker_validation_cursor', str(after))
+                    return stats
+                after = sticker_ref
+                await asyncio.sleep(1 / self.rate)
+            await self.db.set_setting('sticker_validation_cursor', str(after))
+        await self.db.set_setting('sticker_validation_cursor', '0')
+        stats['complete'] = True
+        return stats
+
+    async def _check(self, bot: Bot, file_id: str, failures: int, stats: Dict) -> bool:
+        """Проверка одного file_id; False - проверить не удалось"""
+        while True:
+            try:
+                await bot.get_file(file_id)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                if not is_dead_file_error(e):
+                    logger.warning(f"Проверка стикеров прервана: {e}")
+                    return False
+                await self.db.mark_sticker_dead(file_id, str(e))
+                metrics.inc("stickerbot_dead_stickers_total", source="validator")
+                stats['dead'] += 1
+            else:
+                if failures and await self.db.clear_dead_sticker(file_id):
+                    stats['restored'] += 1
+            stats['checked'] += 1
+            return True
+
+    async def _report(self, bot: Bot, stats: Dict):
+        """Итог прохода в лог и админам, если найдены новые недействительные стикеры"""
+        logger.info(
+            f"Проверка стикеров: проверено {stats['checked']}, недействительных {stats['dead']}, "
+            f"восстановлено {stats['restored']}"
+        )
+        if not stats['dead']:
+            return
+        report = await self.db.get_dead_stickers_report()
+        text = (
+            f"🧟 Проверка стикеров: новых недействительных {stats['dead']} из {stats['checked']}.\n"
+            f"Всего отмечено {report['stickers']} стикеров, у них {report['associations']} ассоциаций. "
+            f"Подробнее: /deadstickers"
+        )
+        for admin_id in ADMIN_USER_IDS:
+            try:
+                await bot.send_message(admin_id, text)
+            except Exception as e:
+                logger.error(f"Error sending validation report to {admin_id}: {e}")
+
+    async def _run(self, bot: Bot):
+        while True:
+            try:
+                stats = await self.run_once(bot)
+                if stats['complete']:
+                    await self._report(bot, stats)
+            except Exception as e:
+                logger.error(f"Error validating stickers: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        """Остановка фоновой задачи"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+# Хранилище FSM в SQLite
+class SQLiteStorage(BaseStorage):
+    """Постоянное хранилище FSM: активные сценарии в памяти, пакетная запись в базу"""
+
+    def __init__(
+            self,
+            database: AsyncStickerDatabase,
+            ttl: float = float(os.getenv("FSM_TTL", "86400")),
+            flush_interval: float = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5")),
+            key_builder: Optional[KeyBuilder] = None
+    ):
+        self.db = database
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        # Все незавершённые сценарии: key -> (state, data, updated_at).
+        # Ключа нет - состояния нет, так что get_state не ходит в базу
+        self._records: Dict[str, Tuple[Optional[str], dict, float]] = {}
+        self._dirty = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Загрузка незавершённых сценариев и запуск фоновой записи"""
+        since = time.time() - self.ttl
+        for key, state, data, updated_at in await self.db.load_fsm(since):
+            self._records[key] = (state, json.loads(data), updated_at)
+        await self.db.expire_fsm(since)
+        logger.info(f"Загружено состояний FSM: {len(self._records)}")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _get(self, key: StorageKey) -> Tuple[str, Optional[tuple]]:
+        name = self.key_builder.build(key)
+        record = self._records.get(name)
+        if record is not None and record[2] < time.time() - self.ttl:
+            # Брошенный сценарий
+            del self._records[name]
+            self._dirty.add(name)
+            record = None
+        return name, record
+
+    def _put(self, name: str, state: Optional[str], data: dict):
+        if state is None and not data:
+            self._records.pop(name, None)
+        else:
+            self._records[name] = (state, data, time.time())
+        self._dirty.add(name)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name, record = self._get(key)
+        state = state.state if isinstance(state, State) else state
+        self._put(name, state, record[1] if record else {})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, record = self._get(key)
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        name, record = self._get(key)
+        self._put(name, record[0] if record else None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, record = self._get(key)
+        return record[1].copy() if record else {}
+
+    async def flush(self):
+        """Запись накопленных изменений одной транзакцией"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for name in dirty:
+            record = self._records.get(name)
+            if record is None:
+                deletes.append(name)
+            else:
+                state, data, updated_at = record
+                upserts.append((name, state, json.dumps(data, ensure_ascii=False), updated_at))
+        try:
+            await self.db.save_fsm(upserts, deletes)
+        except Exception as e:
+            logger.error(f"Error saving FSM storage: {e}")
+            # Повторим при следующей записи
+            self._dirty |= dirty
+
+    async def _run(self):
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - last_sweep > 600:
+                last_sweep = time.monotonic()
+                threshold = time.time() - self.ttl
+                for name in [name for name, record in self._records.items() if record[2] < threshold]:
+                    del self._records[name]
+                await self.db.expire_fsm(threshold)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+# Кэш сессий просмотра ассоциаций
+class SessionCache:
+    """LRU-кэш с ограничением размера и временем жизни записей"""
+
+    def __init__(
+            self,
+            max_size: int = int(os.getenv("SESSION_CACHE_SIZE", "1000")),
+            ttl: float = float(os.getenv("SESSION_CACHE_TTL", "600"))
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (момент истечения, значение); порядок - от давно использованных к недавним
+        self._items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key):
+        """Значение по ключу или None, если его нет или оно устарело"""
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
 
-        # Индексы для быстрого поиска
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_association ON sticker_associations(association)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sticker ON sticker_associations(sticker_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user ON sticker_associations(user_id)')
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._items[key]
+            self.evictions += 1
+            self.misses += 1
+            return None
 
-        conn.commit()
-        conn.close()
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Сохранение значения с вытеснением самых давних записей"""
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Сброс записи после изменения данных"""
+        self._items.pop(key, None)
+
+    def clear(self):
+        """Сброс всех записей после массового изменения данных"""
+        self._items.clear()
+
+    def stats(self) -> Dict:
+        """Счётчики попаданий, промахов и вытеснений"""
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+# Страницы "Мои стикеры"
+class StickerListRenderer:
+    """Текст и клавиатура страницы коллекции с кэшем по (пользователь, страница, версия коллекции)"""
+    # Лимит длины сообщения Telegram
+    MAX_TEXT_LENGTH = 4096
+    MAX_ASSOCIATION_LENGTH = 64
+
+    def __init__(self, database: AsyncStickerDatabase, sessions: SessionCache, page_size: int = ITEMS_PER_PAGE):
+        self.db = database
+        # user_id -> (версия, sticker_id -> ассоциации в порядке показа, sticker_id -> номер)
+        self.sessions = sessions
+        self.page_size = page_size
+        # (user_id, anchor, direction, версия) -> (текст, клавиатура)
+        self.pages = SessionCache()
+
+    async def _summary(self, user_id: int, version: Tuple[int, int]) -> Tuple[Dict[str, List[str]], Dict[str, int]]:
+        """Группировка коллекции по стикерам
+
+        Полностью загружается один раз; если с тех пор записи только
+        добавлялись, дочитываются лишь новые (см. get_user_associations_after).
+        """
+        entry = self.sessions.get(user_id)
+        if entry is not None and entry[0] == version:
+            return entry[1], entry[2]
+
+        if entry is not None and version[1] > entry[0][1]:
+            (count, max_id), old_groups, _ = entry
+            rows = await self.db.get_user_associations_after(user_id, max_id)
+            # Число записей сходится - старые не удалялись, новые идут первыми
+            if rows is not None and count + len(rows) == version[0]:
+                groups: Dict[str, List[str]] = {}
+                for _, sticker_id, association, _ in rows:
+                    groups.setdefault(sticker_id, []).append(association)
+                for sticker_id, assocs in old_groups.items():
+                    groups.setdefault(sticker_id, []).extend(assocs)
+                numbers = {sticker_id: i for i, sticker_id in enumerate(groups, 1)}
+                self.sessions.set(user_id, (version, groups, numbers))
+                return groups, numbers
+
+        groups = {}
+        for sticker_id, association, _ in await self.db.get_user_associations(user_id):
+            groups.setdefault(sticker_id, []).append(association)
+        numbers = {sticker_id: i for i, sticker_id in enumerate(groups, 1)}
+        self.sessions.set(user_id, (version, groups, numbers))
+        return groups, numbers
+
+    async def forget(self, user_id: int, sticker_id: str, association: str):
+        """Удаление ассоциации из сводки без перезагрузки всей коллекции"""
+        entry = self.sessions.get(user_id)
+        if entry is None:
+            return
+        (count, max_id), groups, numbers = entry
+        version = await self.db.get_user_collection_version(user_id)
+        assocs = groups.get(sticker_id)
+        # Новых записей нет и удалена ровно одна - иначе сводку придётся перечитать
+        if version[0] != count - 1 or version[1] > max_id or assocs is None or association not in assocs:
+            self.sessions.invalidate(user_id)
+            return
+        # Место стикера задаёт его самая новая ассоциация - без неё он может сместиться
+        if assocs[0] == association and len(assocs) > 1:
+            self.sessions.invalidate(user_id)
+            return
 
-    def add_association(self, user_id: int, sticker_id: str, association: str) -> bool:
-        """Добавление новой ассоциации"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT OR IGNORE INTO sticker_associations (user_id, sticker_id, association) VALUES (?, ?, ?)',
-                (user_id, sticker_id, association.lower().strip())
+        assocs.remove(association)
+        if not assocs:
+            del groups[sticker_id]
+            numbers = {sid: i for i, sid in enumerate(groups, 1)}
+        self.sessions.set(user_id, (version, groups, numbers))
+
+    def _text(self, groups: Dict[str, List[str]], numbers: Dict[str, int], page_rows: List[tuple]) -> str:
+        """Текст страницы: стикеры, ассоциации которых видны на клавиатуре"""
+        text = f"📋 <b>Ваши стикеры ({len(groups)} шт.)</b>\n\n"
+        footer = "\n💡 Нажмите на ассоциацию ниже, чтобы удалить её:"
+
+        for sticker_id in dict.fromkeys(row[1] for row in page_rows):
+            assocs = groups.get(sticker_id)
+            if not assocs:
+                continue
+            assocs_text = ', '.join(
+                association[:self.MAX_ASSOCIATION_LENGTH] + "..."
+                if len(association) > self.MAX_ASSOCIATION_LENGTH else association
+                for association in assocs[:5]
             )
-            conn.commit()
-            success = cursor.rowcount > 0
-            conn.close()
-            return success
-        except Exception as e:
-            logger.error(f"Error adding association: {e}")
-            return False
+            if len(assocs) > 5:
+                assocs_text += f" и еще {len(assocs) - 5}..."
+            line = f"{numbers[sticker_id]}. <code>{html.escape(assocs_text)}</code>\n"
+            if len(text) + len(line) + len(footer) > self.MAX_TEXT_LENGTH:
+                text += "...\n"
+                break
+            text += line
+
+        return text + footer
+
+    async def render(
+            self,
+            user_id: int,
+            anchor: Optional[Tuple[int, int]] = None,
+            direction: str = 'next'
+    ) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+        """Страница коллекции (см. get_user_associations_page) или None, если коллекция пуста"""
+        version = await self.db.get_user_collection_version(user_id)
+        if not version[0]:
+            return None
 
-    def get_sticker_by_association(self, association: str) -> Optional[str]:
-        """Поиск стикера по ассоциации"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                'SELECT sticker_id FROM sticker_associations WHERE association LIKE ? ORDER BY id DESC LIMIT 1',
-                (f'%{association.lower().strip()}%',)
+        key = (user_id, anchor, direction, version)
+        page = self.pages.get(key)
+        if page is not None:
+            return page
+
+        page_rows, has_prev, has_next = await self.db.get_user_associations_page(
+            user_id, anchor, direction, self.page_size
+        )
+        if not page_rows and direction == 'from':
+            # Страница опустела после удаления - предыдущая
+            page_rows, has_prev, has_next = await self.db.get_user_associations_page(
+                user_id, anchor, 'prev', self.page_size
             )
-            result = cursor.fetchone()
-            conn.close()
-            return result[0] if result else None
-        except Exception as e:
-            logger.error(f"Error getting sticker: {e}")
+        if not page_rows and anchor is not None:
+            page_rows, has_prev, has_next = await self.db.get_user_associations_page(user_id, limit=self.page_size)
+        if not page_rows:
             return None
 
-    def get_user_associations(self, user_id: int) -> List[tuple]:
-        """Получение всех ассоциаций пользователя"""
+        groups, numbers = await self._summary(user_id, version)
+        page = (
+            self._text(groups, numbers, page_rows),
+            create_inline_keyboard_for_associations(page_rows, has_prev, has_next)
+        )
+        self.pages.set(key, page)
+        return page
+
+    def stats(self) -> Dict:
+        return self.pages.stats()
+
+
+# Планировщик исходящих запросов к Bot API
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не более capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """Через сколько секунд будет доступен очередной токен"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class ChatOutbox:
+    """Состояние исходящей очереди одного чата"""
+    __slots__ = ('bucket', 'waiters', 'busy', 'timer', 'pending', 'last_used', 'recent_stickers')
+
+    def __init__(self, rate: float, burst: float):
+        self.bucket = TokenBucket(rate, burst)
+        # Ожидающие очереди в чате: (приоритет, порядковый номер, future)
+        self.waiters: List[tuple] = []
+        # Идёт отправка: запросы в чат выполняются по одному
+        self.busy = False
+        # Отложенная выдача очереди, пока нет токена чата
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.pending = 0
+        self.last_used = time.monotonic()
+        # file_id стикера -> момент последней постановки в очередь
+        self.recent_stickers: Dict[str, float] = {}
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Middleware сессии бота: лимиты на чат и глобально, приоритеты и повтор после 429"""
+    PRIORITY_HIGH = 0
+    PRIORITY_LOW = 1
+    # Реже всего нужные пользователю ответы - стикеры в группах
+    LOW_PRIORITY_METHODS = (SendSticker,)
+
+    def __init__(
+            self,
+            global_rate: float = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30")),
+            chat_rate: float = float(os.getenv("OUTBOUND_CHAT_RATE", "1")),
+            chat_burst: float = float(os.getenv("OUTBOUND_CHAT_BURST", "3")),
+            chat_backlog: int = int(os.getenv("OUTBOUND_CHAT_BACKLOG", "20")),
+            dedupe_window: float = float(os.getenv("OUTBOUND_DEDUPE_WINDOW", "0")),
+            max_retries: int = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_backlog = chat_backlog
+        self.dedupe_window = dedupe_window
+        self.max_retries = max_retries
+        self.chats: Dict[object, ChatOutbox] = {}
+        # Ожидающие глобального токена: (приоритет, порядковый номер, future)
+        self._waiters: List[tuple] = []
+        self._sequence = itertools.count()
+        self._granter: Optional[asyncio.Task] = None
+        self._calls = 0
+        self.sent = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # getUpdates, setMyCommands, answerCallbackQuery и т.п. не ограничиваем
+            return await self._request(make_request, bot, method)
+
+        low_priority = isinstance(method, self.LOW_PRIORITY_METHODS)
+        chat = self._chat(chat_id)
+
+        if low_priority:
+            if self._is_duplicate(chat, method):
+                self.coalesced += 1
+                return None
+            if chat.pending >= self.chat_backlog:
+                # Чат завален стикерами - лишние не ставим в очередь
+                self.dropped += 1
+                return None
+
+        priority = self.PRIORITY_LOW if low_priority else self.PRIORITY_HIGH
+        chat.pending += 1
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                'SELECT sticker_id, association, created_at FROM sticker_associations WHERE user_id = ? ORDER BY created_at DESC',
-                (user_id,)
-            )
-            result = cursor.fetchall()
-            conn.close()
-            return result
-        except Exception as e:
-            logger.error(f"Error getting user associations: {e}")
-            return []
+            await self._acquire_chat(chat, priority)
+            try:
+                return await self._send(make_request, bot, method, priority)
+            finally:
+                self._release_chat(chat)
+        finally:
+            chat.pending -= 1
+            chat.last_used = time.monotonic()
+
+    def _chat(self, chat_id) -> ChatOutbox:
+        self._calls += 1
+        if self._calls % 1024 == 0:
+            self._prune()
+
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatOutbox(self.chat_rate, self.chat_burst)
+        return chat
+
+    def _prune(self, idle: float = 60):
+        """Удаление состояния давно неактивных чатов"""
+        threshold = time.monotonic() - idle
+        for chat_id in [key for key, chat in self.chats.items() if not chat.pending and chat.last_used < threshold]:
+            del self.chats[chat_id]
+
+    def _is_duplicate(self, chat: ChatOutbox, method) -> bool:
+        """Тот же стикер в этот чат уже отправлялся в пределах окна"""
+        sticker = getattr(method, 'sticker', None)
+        if self.dedupe_window <= 0 or not isinstance(sticker, str):
+            return False
 
-    def delete_association(self, user_id: int, sticker_id: str, association: str) -> bool:
-        """Удаление ассоциации"""
+        now = time.monotonic()
+        last = chat.recent_stickers.get(sticker)
+        if last is not None and now - last < self.dedupe_window:
+            return True
+
+        chat.recent_stickers[sticker] = now
+        if len(chat.recent_stickers) > 64:
+            chat.recent_stickers = {
+                key: value for key, value in chat.recent_stickers.items() if now - value < self.dedupe_window
+            }
+        return False
+
+    async def _acquire_chat(self, chat: ChatOutbox, priority: int):
+        """Очередь чата: по приоритету, затем по порядку постановки; токен чата выдаётся вместе с очередью"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(chat.waiters, (priority, next(self._sequence), future))
+        self._grant_chat(chat)
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                'DELETE FROM sticker_associations WHERE user_id = ? AND sticker_id = ? AND association = ?',
-                (user_id, sticker_id, association)
-            )
-            conn.commit()
-            success = cursor.rowcount > 0
-            conn.close()
-            return success
-        except Exception as e:
-            logger.error(f"Error deleting association: {e}")
-            return False
+            await future
+        except asyncio.CancelledError:
+            # Очередь уже выдана, но отправка отменена - передаём её следующему
+            if future.done() and not future.cancelled():
+                self._release_chat(chat)
+            raise
+
+    def _release_chat(self, chat: ChatOutbox):
+        chat.busy = False
+        self._grant_chat(chat)
+
+    def _grant_chat(self, chat: ChatOutbox):
+        """Выдача очереди лучшему ожидающему, когда чат свободен и есть токен"""
+        if chat.busy or chat.timer is not None:
+            return
+        while chat.waiters and chat.waiters[0][2].done():
+            heapq.heappop(chat.waiters)
+        if not chat.waiters:
+            return
 
-    def log_usage(self, user_id: int, sticker_id: str, association: str):
-        """Логирование использования стикера"""
+        delay = chat.bucket.delay()
+        if delay > 0:
+            # Выбор откладывается до появления токена: пришедший за это время ответ UI обгонит стикеры
+            chat.timer = asyncio.get_running_loop().call_later(delay, self._on_chat_timer, chat)
+            return
+        _, _, future = heapq.heappop(chat.waiters)
+        chat.bucket.consume()
+        chat.busy = True
+        future.set_result(None)
+
+    def _on_chat_timer(self, chat: ChatOutbox):
+        chat.timer = None
+        self._grant_chat(chat)
+
+    async def _send(self, make_request, bot: Bot, method, priority: int):
+        attempt = 0
+        while True:
+            await self._acquire_global(priority)
+
+            try:
+                result = await self._request(make_request, bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retried += 1
+                logger.warning(f"Flood control в чате {method.chat_id}, повтор через {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+                continue
+
+            self.sent += 1
+            return result
+
+    @staticmethod
+    async def _request(make_request, bot: Bot, method):
+        """Вызов Bot API с замером длительности и подсчётом ошибок"""
+        name = method.__api_method__
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO usage_stats (user_id, sticker_id, association) VALUES (?, ?, ?)',
-                (user_id, sticker_id, association)
-            )
-            conn.commit()
-            conn.close()
+            with metrics.timer("stickerbot_telegram_seconds", method=name):
+                return await make_request(bot, method)
         except Exception as e:
-            logger.error(f"Error logging usage: {e}")
+            metrics.inc("stickerbot_telegram_errors_total", method=name, error=type(e).__name__)
+            raise
 
-    def get_stats(self) -> Dict:
-        """Получение статистики"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+    async def _acquire_global(self, priority: int):
+        """Ожидание глобального токена в порядке приоритета"""
+        if not self._waiters and self.global_bucket.delay() == 0:
+            self.global_bucket.consume()
+            return
 
-            # Общее количество ассоциаций
-            cursor.execute('SELECT COUNT(*) FROM sticker_associations')
-            total_associations = cursor.fetchone()[0]
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.create_task(self._grant())
+        await future
+
+    async def _grant(self):
+        while self._waiters:
+            delay = self.global_bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.global_bucket.consume()
+            future.set_result(None)
+
+    def stats(self) -> Dict:
+        """Счётчики планировщика"""
+        return {
+            'chats': len(self.chats),
+            'waiting': len(self._waiters),
+            'sent': self.sent,
+            'retried': self.retried,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped
+        }
+
+
+# Метрики задержек
+class Histogram:
+    """Гистограмма длительностей с фиксированными границами корзин"""
+    # От 10 мкс до ~15 с с шагом в √2
+    BUCKETS = tuple(0.00001 * 2 ** (i / 2) for i in range(42))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля с линейной интерполяцией внутри корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.BUCKETS):
+                    return self.BUCKETS[-1]
+                lower = self.BUCKETS[i - 1] if i else 0.0
+                return lower + (self.BUCKETS[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.BUCKETS[-1]
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics: 'Metrics', name: str, labels: tuple):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics._observe(self.name, self.labels, time.perf_counter() - self.started)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Metrics:
+    """Гистограммы задержек и счётчики в формате Prometheus"""
+    _NULL_TIMER = _NullTimer()
+
+    def __init__(self, sample_rate: float = float(os.getenv("METRICS_SAMPLE_RATE", "1"))):
+        # 0 - замеры выключены, 1 - замеряется каждый вызов
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        # (имя, ((метка, значение), ...)) -> гистограмма / значение счётчика
+        self.histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self.counters: Dict[Tuple[str, tuple], int] = {}
+        # Префикс -> функция, возвращающая словарь текущих значений
+        self.collectors: Dict[str, Any] = {}
+
+    def sampled(self) -> bool:
+        if self.sample_rate >= 1:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def timer(self, name: str, **labels):
+        """Контекстный менеджер замера длительности блока"""
+        if not self.sampled():
+            return self._NULL_TIMER
+        return _Timer(self, name, tuple(labels.items()))
+
+    def observe(self, name: str, seconds: float, **labels):
+        self._observe(name, tuple(labels.items()), seconds)
+
+    def _observe(self, name: str, labels: tuple, seconds: float):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name: str, value: int = 1, **labels):
+        if self.sample_rate <= 0:
+            return
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register(self, prefix: str, collector):
+        """Экспорт значений stats() компонента как gauge-метрик"""
+        self.collectors[prefix] = collector
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: str = '') -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        with self._lock:
+            histograms = [(key, list(h.counts), h.count, h.sum) for key, h in sorted(self.histograms.items())]
+            counters = sorted(self.counters.items())
+
+        lines = []
+        declared = set()
+        for (name, labels), counts, count, total in histograms:
+            if name not in declared:
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(Histogram.BUCKETS, counts):
+                cumulative += bucket_count
+                le = 'le="%.6g"' % bound
+                lines.append(f"{name}_bucket{self._format_labels(labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{name}_bucket{self._format_labels(labels, le)} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+
+        for prefix, collector in self.collectors.items():
+            try:
+                values = collector()
+            except Exception as e:
+                logger.error(f"Error collecting {prefix} metrics: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {prefix}_{key} gauge")
+                    lines.append(f"{prefix}_{key} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> List[tuple]:
+        """Строки (метрика, метки, количество, p50, p99) по всем гистограммам"""
+        with self._lock:
+            return [
+                (name, labels, h.count, h.quantile(0.5), h.quantile(0.99))
+                for (name, labels), h in sorted(self.histograms.items())
+            ]
+
+
+class MetricsServer:
+    """HTTP-эндпоинт /metrics для Prometheus"""
+
+    def __init__(self, metrics: Metrics, host: str = WEBAPP_HOST, port: int = METRICS_PORT):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=self.metrics.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
 
-            # Количество уникальных стикеров
-            cursor.execute('SELECT COUNT(DISTINCT sticker_id) FROM sticker_associations')
-            unique_stickers = cursor.fetchone()[0]
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"📈 Метрики доступны на {self.host}:{self.port}/metrics")
 
-            # Количество пользователей
-            cursor.execute('SELECT COUNT(DISTINCT user_id) FROM sticker_associations')
-            total_users = cursor.fetchone()[0]
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
 
-            # Топ ассоциаций
-            cursor.execute('''
-                SELECT association, COUNT(*) as usage_count 
-                FROM usage_stats 
-                GROUP BY association 
-                ORDER BY usage_count DESC 
-                LIMIT 10
-            ''')
-            top_associations = cursor.fetchall()
 
-            conn.close()
+# Замер этапов запуска
+class StartupTimer:
+    """Длительность этапов запуска: в лог и гистограмму stickerbot_startup_seconds"""
 
-            return {
-                'total_associations': total_associations,
-                'unique_stickers': unique_stickers,
-                'total_users': total_users,
-                'top_associations': top_associations
-            }
-        except Exception as e:
-            logger.error(f"Error getting stats: {e}")
-            return {}
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        # Отсчёт от загрузки модулей (время импорта aiogram сюда не входит)
+        self.started = time.perf_counter()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            self.metrics.observe("stickerbot_startup_seconds", duration, stage=name)
+            logger.info(f"⏱ Этап запуска {name}: {duration * 1000:.0f} мс (с начала {self.elapsed() * 1000:.0f} мс)")
 
 
 # Инициализация базы данных
-db = StickerDatabase()
+metrics = Metrics()
+startup = StartupTimer(metrics)
+# Индекс ассоциаций загружается в фоне после старта (warm_up_index)
+with startup.stage("schema"):
+    db = StickerDatabase(warm=False)
+async_db = AsyncStickerDatabase(db)
+usage_logger = UsageLogger(async_db)
+usage_retention = UsageRetention(async_db)
+sticker_validator = StickerValidator(async_db)
+index_sync = IndexSync(async_db)
+
+# Сессии просмотра ассоциаций: user_id -> сводка коллекции (см. StickerListRenderer)
+user_sessions = SessionCache()
+sticker_pages = StickerListRenderer(async_db, user_sessions)
+# Результаты inline-поиска: нормализованный запрос -> список (sticker_id, ассоциация)
+inline_cache = SessionCache(ttl=INLINE_CACHE_TTL)
+
+# Все исходящие запросы бота проходят через планировщик (см. create_bot)
+outbound = OutboundScheduler()
+metrics.register("stickerbot_outbound", outbound.stats)
+metrics.register("stickerbot_sessions", user_sessions.stats)
+metrics.register("stickerbot_page_cache", sticker_pages.stats)
+metrics.register("stickerbot_inline_cache", inline_cache.stats)
+# Автомат пересоздаётся при полной перезагрузке индекса - берём текущий
+metrics.register("stickerbot_lookup_cache", lambda: db.lookup_cache.stats())
+
+# Постоянное хранилище FSM; хендлеры регистрируются в router
+storage = SQLiteStorage(async_db)
+router = Router()
+
+
+def create_bot() -> Bot:
+    """Бот с сессией через планировщик; создаётся при запуске, а не при импорте - CLI токен не нужен"""
+    bot = Bot(
+        token=API_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    )
+    bot.session.middleware(outbound)
+    return bot
+
+
+def create_dispatcher() -> Dispatcher:
+    """Диспетчер с постоянным хранилищем FSM и хендлерами бота"""
+    dispatcher = Dispatcher(storage=storage)
+    dispatcher.include_router(router)
+    return dispatcher
 
 
 def create_main_keyboard():
@@ -219,21 +3693,23 @@ def create_main_keyboard():
     return keyboard
 
 
-def create_inline_keyboard_for_associations(associations: List[tuple], page: int = 0):
+def create_inline_keyboard_for_associations(page_rows: List[tuple], has_prev: bool, has_next: bool):
     """Создание inline-клавиатуры для просмотра ассоциаций"""
     keyboard = []
-    items_per_page = 8  # Уменьшил количество элементов на странице
-    start_idx = page * items_per_page
-    end_idx = start_idx + items_per_page
+    if not page_rows:
+        return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-    page_associations = associations[start_idx:end_idx]
+    # Страница задаётся ключом (id, время) первой записи - он остаётся
+    # валидным, даже если саму запись удалят
+    first_id, first_ts = page_rows[0][0], page_rows[0][4]
+    last_id, last_ts = page_rows[-1][0], page_rows[-1][4]
 
-    for i, (sticker_id, association, created_at) in enumerate(page_associations):
+    for row_id, sticker_id, association, created_at, created_ts in page_rows:
         # Ограничиваем длину текста кнопки и callback_data
         display_text = association[:20] + "..." if len(association) > 20 else association
 
-        # Создаем короткий идентификатор для callback_data
-        callback_data = f"del_{i + start_idx}_{page}"
+        # В callback_data передаём id записи, а не индекс в списке
+        callback_data = f"del_{row_id}_{first_id}_{first_ts}"
 
         keyboard.append([
             InlineKeyboardButton(
@@ -244,10 +3720,10 @@ def create_inline_keyboard_for_associations(associations: List[tuple], page: int
 
     # Навигация
     nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"page_{page - 1}"))
-    if end_idx < len(associations):
-        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"page_{page + 1}"))
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"page_prev_{first_id}_{first_ts}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"page_next_{last_id}_{last_ts}"))
 
     if nav_buttons:
         keyboard.append(nav_buttons)
@@ -255,7 +3731,7 @@ def create_inline_keyboard_for_associations(associations: List[tuple], page: int
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-@dp.message(Command("start"))
+@router.message(Command("start"))
 async def start_command(message: types.Message):
     if message.chat.type != "private":
         return
@@ -280,7 +3756,7 @@ async def start_command(message: types.Message):
     )
 
 
-@dp.message(Command("help"))
+@router.message(Command("help"))
 async def help_command(message: types.Message):
 
     """Обработчик команды помощи"""
@@ -299,6 +3775,10 @@ async def help_command(message: types.Message):
 • Бот автоматически отправит соответствующий стикер
 • Работает поиск по части слова!
 
+<b>Ассоциации для группы:</b>
+• Ответьте на стикер командой <code>/add смех, радость</code>
+• В группе ассоциации действуют только в ней и важнее общих (нужны права администратора)
+
 <b>Управление:</b>
 • "📋 Мои стикеры" - просмотр и удаление
 • "📊 Статистика" - информация о боте
@@ -318,7 +3798,7 @@ async def help_command(message: types.Message):
     await message.answer(help_text, parse_mode="HTML")
 
 
-@dp.message(F.text == "❓ Помощь")
+@router.message(F.text == "❓ Помощь")
 async def help_button(message: types.Message):
     if message.chat.type != "private":
         return
@@ -326,7 +3806,7 @@ async def help_button(message: types.Message):
     await help_command(message)
 
 
-@dp.message(F.text == "➕ Добавить стикер")
+@router.message(F.text == "➕ Добавить стикер")
 async def add_sticker_start(message: types.Message, state: FSMContext):
     if message.chat.type != "private":
         return
@@ -349,30 +3829,38 @@ async def add_sticker_start(message: types.Message, state: FSMContext):
     await message.answer(instruction, parse_mode="HTML")
 
 
-@dp.message(StateFilter(StickerStates.waiting_for_associations), F.text)
-async def process_associations(message: types.Message, state: FSMContext):
-    if message.chat.type != "private":
-
-        return
-    """Обработка введенных ассоциаций"""
-    associations_text = message.text.strip()
-
-    if not associations_text:
-        await message.answer("❌ Пожалуйста, введите хотя бы одну ассоциацию!")
-        return
+def parse_associations(text: str) -> Tuple[List[str], Optional[str]]:
+    """Ассоциации из текста через запятую и сообщение об ошибке, если они некорректны"""
+    text = text.strip()
+    if not text:
+        return [], "❌ Пожалуйста, введите хотя бы одну ассоциацию!"
 
-    # Парсинг ассоциаций
-    associations = [assoc.strip().lower() for assoc in associations_text.split(',') if assoc.strip()]
+    associations = [assoc.strip().lower() for assoc in text.split(',') if assoc.strip()]
 
     if not associations:
-        await message.answer("❌ Некорректный формат! Введите ассоциации через запятую.")
-        return
+        return [], "❌ Некорректный формат! Введите ассоциации через запятую."
     for association in associations:
         if len(association) < 3:
-            await message.answer("слишком короткая ассоциация")
-            return
+            return [], "слишком короткая ассоциация"
     if len(associations) > 20:
-        await message.answer("❌ Слишком много ассоциаций! Максимум 20.")
+        return [], "❌ Слишком много ассоциаций! Максимум 20."
+    return associations, None
+
+
+def chat_scope(chat: types.Chat) -> int:
+    """scope ассоциаций для чата: в группах свои ассоциации, в личке - только глобальные"""
+    return chat.id if chat.type != "private" else 0
+
+
+@router.message(StateFilter(StickerStates.waiting_for_associations), F.text)
+async def process_associations(message: types.Message, state: FSMContext):
+    if message.chat.type != "private":
+
+        return
+    """Обработка введенных ассоциаций"""
+    associations, error = parse_associations(message.text)
+    if error:
+        await message.answer(error)
         return
 
     # Сохранение в состоянии
@@ -390,7 +3878,7 @@ async def process_associations(message: types.Message, state: FSMContext):
     )
 
 
-@dp.message(StateFilter(StickerStates.waiting_for_sticker), F.sticker)
+@router.message(StateFilter(StickerStates.waiting_for_sticker), F.sticker)
 async def process_sticker(message: types.Message, state: FSMContext):
     """Обработка отправленного стикера"""
     if message.chat.type != "private":
@@ -406,13 +3894,12 @@ async def process_sticker(message: types.Message, state: FSMContext):
     sticker_id = message.sticker.file_id
     user_id = message.from_user.id
 
-    # Сохранение ассоциаций в базу данных
-    success_count = 0
-    for association in associations:
-        if db.add_association(user_id, sticker_id, association):
-            success_count += 1
+    # Сохранение ассоциаций в базу данных одной транзакцией
+    results = await async_db.add_associations(user_id, sticker_id, associations)
+    success_count = sum(results)
 
     await state.clear()
+    user_sessions.invalidate(user_id)
 
     if success_count > 0:
         await message.answer(
@@ -430,7 +3917,7 @@ async def process_sticker(message: types.Message, state: FSMContext):
         )
 
 
-@dp.message(StateFilter(StickerStates.waiting_for_sticker))
+@router.message(StateFilter(StickerStates.waiting_for_sticker))
 async def wrong_content_for_sticker(message: types.Message, state: FSMContext):
     if message.chat.type != "private":
         return
@@ -441,15 +3928,14 @@ async def wrong_content_for_sticker(message: types.Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, отправьте именно стикер!")
 
 
-@dp.message(F.text == "📋 Мои стикеры")
+@router.message(F.text == "📋 Мои стикеры")
 async def show_user_stickers(message: types.Message):
     if message.chat.type != "private":
         return
     """Показать стикеры пользователя"""
-    user_id = message.from_user.id
-    associations = db.get_user_associations(user_id)
+    page = await sticker_pages.render(message.from_user.id)
 
-    if not associations:
+    if page is None:
         await message.answer(
             "📭 У вас пока нет сохраненных стикеров!\n\n"
             "Нажмите \"➕ Добавить стикер\" чтобы начать.",
@@ -457,38 +3943,17 @@ async def show_user_stickers(message: types.Message):
         )
         return
 
-    # Сохраняем ассоциации в сессии пользователя
-    user_sessions[user_id] = associations
-
-    # Группировка по стикерам
-    sticker_groups = {}
-    for sticker_id, association, created_at in associations:
-        if sticker_id not in sticker_groups:
-            sticker_groups[sticker_id] = []
-        sticker_groups[sticker_id].append(association)
-
-    text = f"📋 <b>Ваши стикеры ({len(sticker_groups)} шт.)</b>\n\n"
-
-    for i, (sticker_id, assocs) in enumerate(sticker_groups.items(), 1):
-        assocs_text = ', '.join(assocs[:5])
-        if len(assocs) > 5:
-            assocs_text += f" и еще {len(assocs) - 5}..."
-        text += f"{i}. <code>{assocs_text}</code>\n"
-
-    text += "\n💡 Нажмите на ассоциацию ниже, чтобы удалить её:"
-
-    keyboard = create_inline_keyboard_for_associations(associations)
-
+    text, keyboard = page
     await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
 
 
-@dp.message(F.text == "📊 Статистика")
+@router.message(F.text == "📊 Статистика")
 async def show_stats(message: types.Message):
     if message.chat.type != "private":
         return
     """Показать статистику"""
-    stats = db.get_stats()
-    user_associations = db.get_user_associations(message.from_user.id)
+    stats = await async_db.get_stats()
+    user_stickers, user_associations = await async_db.count_user_associations(message.from_user.id)
 
     if not stats:
         await message.answer("❌ Ошибка получения статистики!")
@@ -498,8 +3963,8 @@ async def show_stats(message: types.Message):
 📊 <b>Статистика бота</b>
 
 👤 <b>Ваша статистика:</b>
-• Стикеров добавлено: {len(set(assoc[0] for assoc in user_associations))}
-• Ассоциаций создано: {len(user_associations)}
+• Стикеров добавлено: {user_stickers}
+• Ассоциаций создано: {user_associations}
 
 🌐 <b>Общая статистика:</b>/ы
 • Всего пользователей: {stats.get('total_users', 0)}
@@ -516,69 +3981,43 @@ async def show_stats(message: types.Message):
     await message.answer(text, parse_mode="HTML")
 
 
-@dp.callback_query(F.data.startswith("del_"))
+@router.callback_query(F.data.startswith("del_"))
 async def delete_association_callback(callback: types.CallbackQuery):
-    if callback.chat.type != "private":
+    if callback.message.chat.type != "private":
         return
     """Обработка удаления ассоциации"""
     try:
         data_parts = callback.data.split("_")
-        if len(data_parts) != 3:
+        if len(data_parts) != 4:
             await callback.answer("❌ Ошибка данных!")
             return
 
-        association_index = int(data_parts[1])
-        page = int(data_parts[2])
+        row_id = int(data_parts[1])
+        anchor = (int(data_parts[2]), int(data_parts[3]))
         user_id = callback.from_user.id
 
-        # Получаем актуальные ассоциации пользователя
-        if user_id not in user_sessions:
-            user_sessions[user_id] = db.get_user_associations(user_id)
-
-        associations = user_sessions[user_id]
-
-        if association_index >= len(associations):
-            await callback.answer("❌ Ассоциация не найдена!")
-            return
-
-        sticker_id, association, created_at = associations[association_index]
-
-        success = db.delete_association(user_id, sticker_id, association)
+        deleted = await async_db.delete_association_by_id(user_id, row_id)
 
-        if success:
+        if deleted:
+            sticker_id, association = deleted
             await callback.answer(f"✅ Ассоциация '{association}' удалена!")
 
-            # Обновляем сессию
-            user_sessions[user_id] = db.get_user_associations(user_id)
-            updated_associations = user_sessions[user_id]
-
-            if updated_associations:
-                keyboard = create_inline_keyboard_for_associations(updated_associations, page)
-
-                # Обновляем текст с новой статистикой
-                sticker_groups = {}
-                for sid, assoc, _ in updated_associations:
-                    if sid not in sticker_groups:
-                        sticker_groups[sid] = []
-                    sticker_groups[sid].append(assoc)
-
-                text = f"📋 <b>Ваши стикеры ({len(sticker_groups)} шт.)</b>\n\n"
-                for i, (sid, assocs) in enumerate(sticker_groups.items(), 1):
-                    assocs_text = ', '.join(assocs[:5])
-                    if len(assocs) > 5:
-                        assocs_text += f" и еще {len(assocs) - 5}..."
-                    text += f"{i}. <code>{assocs_text}</code>\n"
-                text += "\n💡 Нажмите на ассоциацию ниже, чтобы удалить её:"
-
-                await callback.message.edit_text(text, parse_mode="HTML")
-                await callback.message.edit_reply_markup(reply_markup=keyboard)
+            # Обновляем сводку без повторной загрузки всей коллекции
+            await sticker_pages.forget(user_id, sticker_id, association)
+
+            # Та же страница; если она опустела - предыдущая
+            page = await sticker_pages.render(user_id, anchor, 'from')
+            if page is not None:
+                text, keyboard = page
+                # Текст и клавиатура одним запросом
+                await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
             else:
                 await callback.message.edit_text(
                     "📭 Все стикеры удалены!\n\n"
                     "Нажмите \"➕ Добавить стикер\" чтобы добавить новые."
                 )
         else:
-            await callback.answer("❌ Ошибка удаления!")
+            await callback.answer("❌ Ассоциация не найдена!")
 
     except (ValueError, IndexError) as e:
         logger.error(f"Error in delete callback: {e}")
@@ -588,23 +4027,22 @@ async def delete_association_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Произошла ошибка!")
 
 
-@dp.callback_query(F.data.startswith("page_"))
+@router.callback_query(F.data.startswith("page_"))
 async def pagination_callback(callback: types.CallbackQuery):
-    if callback.chat.type != "private":
+    if callback.message.chat.type != "private":
         return
     """Обработка пагинации"""
     try:
-        page = int(callback.data.split("_")[1])
+        _, direction, row_id, created_ts = callback.data.split("_")
+        if direction not in ("next", "prev"):
+            raise ValueError(f"unknown direction {direction}")
         user_id = callback.from_user.id
 
-        # Получаем актуальные ассоциации
-        if user_id not in user_sessions:
-            user_sessions[user_id] = db.get_user_associations(user_id)
-
-        associations = user_sessions[user_id]
-        keyboard = create_inline_keyboard_for_associations(associations, page)
-
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
+        # Отрисовываем только запрошенную страницу
+        page = await sticker_pages.render(user_id, (int(row_id), int(created_ts)), direction)
+        if page is not None:
+            text, keyboard = page
+            await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
         await callback.answer()
 
     except (ValueError, IndexError) as e:
@@ -615,13 +4053,169 @@ async def pagination_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Произошла ошибка!")
 
 
+@router.message(Command("export"))
+async def export_command(message: types.Message):
+    """Выгрузка всех ассоциаций файлом JSONL (/export csv - CSV) для админов"""
+    if message.chat.type != "private" or message.from_user.id not in ADMIN_USER_IDS:
+        return
+
+    fmt = 'csv' if 'csv' in message.text.lower() else 'jsonl'
+    workdir = tempfile.mkdtemp(prefix="stickers-export-")
+    path = os.path.join(workdir, f"associations.{fmt}")
+    try:
+        started = time.perf_counter()
+        count = await async_db.export_file(path)
+        elapsed = max(time.perf_counter() - started, 1e-6)
+        await message.answer_document(
+            FSInputFile(path),
+            caption=f"📦 Ассоциаций: {count} ({count / elapsed:.0f} строк/с)"
+        )
+    except Exception as e:
+        logger.error(f"Error exporting associations: {e}")
+        await message.answer("❌ Ошибка экспорта!")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@router.message(F.document, F.caption.startswith("/import"))
+async def import_document(message: types.Message, bot: Bot):
+    """Загрузка ассоциаций из присланного JSONL/CSV файла для админов"""
+    if message.chat.type != "private" or message.from_user.id not in ADMIN_USER_IDS:
+        return
+
+    workdir = tempfile.mkdtemp(prefix="stickers-import-")
+    path = os.path.join(workdir, os.path.basename(message.document.file_name or "import.jsonl"))
+    status = await message.answer("⏳ Загрузка файла...")
+    try:
+        await bot.download(message.document, destination=path)
+
+        # Счётчики обновляются из потока базы данных после каждого пакета
+        progress: Dict = {}
+        task = asyncio.create_task(async_db.import_file(path, message.from_user.id, progress.update))
+        shown = None
+        while not task.done():
+            await asyncio.wait([task], timeout=3)
+            if progress and not task.done() and progress['rows'] != shown:
+                shown = progress['rows']
+                await status.edit_text(f"⏳ Обработано строк: {shown} ({progress['rows_per_sec']:.0f} строк/с)")
+        stats = task.result()
+
+        user_sessions.clear()
+        inline_cache.clear()
+        await status.edit_text(
+            f"✅ Импорт завершён за {stats['elapsed']:.1f} с ({stats['rows_per_sec']:.0f} строк/с)\n"
+            f"• Строк: {stats['rows']}\n"
+            f"• Добавлено: {stats['inserted']}\n"
+            f"• Уже были: {stats['duplicates']}\n"
+            f"• Некорректных: {stats['invalid']}"
+        )
+    except Exception as e:
+        logger.error(f"Error importing associations: {e}")
+        await status.edit_text("❌ Ошибка импорта!")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@router.message(Command("add"), F.reply_to_message.sticker)
+async def add_command(message: types.Message, command: CommandObject, bot: Bot):
+    """Ассоциации для стикера из ответа: в группе действуют только в этом чате"""
+    scope = chat_scope(message.chat)
+    if scope:
+        member = await bot.get_chat_member(message.chat.id, message.from_user.id)
+        if member.status not in ("creator", "administrator"):
+            await message.reply("❌ Ассоциации чата могут добавлять только администраторы")
+            return
+
+    associations, error = parse_associations(command.args or "")
+    if error:
+        await message.reply(error)
+        return
+
+    user_id = message.from_user.id
+    results = await async_db.add_associations(
+        user_id, message.reply_to_message.sticker.file_id, associations, scope
+    )
+    user_sessions.invalidate(user_id)
+
+    where = "в этом чате" if scope else "во всех чатах"
+    await message.reply(
+        f"✅ Сохранено ассоциаций: {sum(results)}/{len(associations)}, действуют {where}"
+    )
+
+
+@router.message(Command("perf"))
+async def perf_command(message: types.Message):
+    """Задержки по этапам обработки для админов"""
+    if message.chat.type != "private" or message.from_user.id not in ADMIN_USER_IDS:
+        return
+
+    rows = metrics.summary()
+    if not rows:
+        await message.answer("⏱ Замеров пока нет (METRICS_SAMPLE_RATE=0?)")
+        return
+
+    lines = []
+    for name, labels, count, p50, p99 in rows:
+        title = name.replace("stickerbot_", "").replace("_seconds", "")
+        if labels:
+            title += " " + ",".join(str(value) for _, value in labels)
+        lines.append(f"{title:<32} {count:>7} {p50 * 1000:>8.2f} {p99 * 1000:>8.2f}")
+
+    text = "⏱ <b>Задержки, мс</b>\n<pre>" + f"{'этап':<32} {'n':>7} {'p50':>8} {'p99':>8}\n"
+    for line in lines:
+        # Укладываемся в лимит длины сообщения Telegram
+        if len(text) + len(line) > 4000:
+            break
+        text += line + "\n"
+    text += "</pre>"
+    await message.answer(text, parse_mode="HTML")
+
+
+@router.message(Command("deadstickers"))
+async def dead_stickers_command(message: types.Message, command: CommandObject):
+    """Недействительные стикеры для админов; /deadstickers purge - удаление их ассоциаций"""
+    if message.chat.type != "private" or message.from_user.id not in ADMIN_USER_IDS:
+        return
+
+    if (command.args or "").strip().lower() == "purge":
+        stickers, associations = await async_db.purge_dead_stickers()
+        await message.answer(f"🧹 Удалено ассоциаций: {associations} у {stickers} стикеров")
+        return
+
+    report = await async_db.get_dead_stickers_report()
+    if not report['stickers']:
+        await message.answer("✅ Недействительных стикеров нет")
+        return
+
+    text = (
+        f"🧟 <b>Недействительные стикеры</b>\n"
+        f"Стикеров: {report['stickers']}, ассоциаций у них: {report['associations']}\n\n"
+    )
+    for file_id, failures, associations, error in report['top']:
+        text += (
+            f"<code>{html.escape(file_id[:24])}…</code> отказов: {failures}, ассоциаций: {associations}\n"
+            f"<i>{html.escape((error or '')[:100])}</i>\n"
+        )
+    text += (
+        f"\n/deadstickers purge удалит {report['purgeable']} ассоциаций стикеров, "
+        f"отклонённых {DEAD_STICKER_PURGE_FAILURES}+ раз подряд"
+    )
+    await message.answer(text, parse_mode="HTML")
+
+
 # Основной обработчик текстовых сообщений для поиска стикеров
-@dp.message(F.text)
+@router.message(F.text)
 async def search_sticker(message: types.Message, state: FSMContext):
-    logger.info(message.chat.id)
     """Поиск и отправка стикера по тексту"""
+    with metrics.timer("stickerbot_search_seconds", stage="total"):
+        await _search_sticker(message, state)
+
+
+async def _search_sticker(message: types.Message, state: FSMContext):
+    logger.debug(message.chat.id)
     # Проверяем, не находимся ли мы в состоянии ввода данных
-    current_state = await state.get_state()
+    with metrics.timer("stickerbot_search_seconds", stage="fsm_state"):
+        current_state = await state.get_state()
     if current_state is not None:
         return  # Если в состоянии, пропускаем поиск стикеров
 
@@ -631,35 +4225,41 @@ async def search_sticker(message: types.Message, state: FSMContext):
     if text.startswith('/') or text in ["➕ Добавить стикер", "📋 Мои стикеры", "📊 Статистика", "❓ Помощь"]:
         return
 
-    # Поиск по всему тексту и отдельным словам
-    sticker_id = None
-    matched_association = None
-
-    # Сначала ищем точное совпадение
-    sticker_id = db.get_sticker_by_association(text)
-    if sticker_id:
-        matched_association = text
-    else:
-        # Поиск по словам
-        words = re.findall(r'\b\w+\b', text)
-        for word in words:
-            if len(word) >= 2:  # Минимум 2 символа для поиска
-                sticker_id = db.get_sticker_by_association(word)
-                if sticker_id:
-                    matched_association = word
-                    break
+    # Поиск по всему тексту и отдельным словам; недействительный стикер отмечается,
+    # и поиск повторяется - найдётся следующий по новизне стикер той же ассоциации
+    for attempt in range(SEARCH_SEND_ATTEMPTS):
+        with metrics.timer("stickerbot_search_seconds", stage="lookup"):
+            match = await async_db.find_sticker(text, chat_scope(message.chat))
+        if attempt == 0:
+            metrics.inc("stickerbot_search_total", result="hit" if match else "miss")
+        if not match:
+            return
+        sticker_id, matched_association = match
 
-    if sticker_id:
         try:
-            await message.answer_sticker(sticker_id)
-            # Логирование использования
-            db.log_usage(message.from_user.id, sticker_id, matched_association)
+            with metrics.timer("stickerbot_search_seconds", stage="send"):
+                sent = await message.answer_sticker(sticker_id)
         except Exception as e:
+            if is_dead_file_error(e):
+                failures = await async_db.mark_sticker_dead(sticker_id, str(e))
+                metrics.inc("stickerbot_dead_stickers_total", source="send")
+                logger.warning(f"Стикер не принят Telegram ({failures} раз подряд), ищем замену: {e}")
+                continue
             logger.error(f"Error sending sticker: {e}")
             await message.answer("❌ Ошибка отправки стикера. Возможно, стикер недоступен.")
+            return
+
+        # Стикер снова принимается после истечения backoff
+        if sticker_id in db.dead_stickers:
+            await async_db.clear_dead_sticker(sticker_id)
+        # Логирование использования (повтор стикера мог быть схлопнут планировщиком)
+        if sent is not None:
+            with metrics.timer("stickerbot_search_seconds", stage="log"):
+                await usage_logger.log(message.from_user.id, sticker_id, matched_association)
+        return
 
 
-@dp.message(Command("stats"))
+@router.message(Command("stats"))
 async def stats_command(message: types.Message):
     if message.chat.type != "private":
         return
@@ -668,7 +4268,7 @@ async def stats_command(message: types.Message):
         await show_stats(message)
         return
 
-    stats = db.get_stats()
+    stats = await async_db.get_stats()
     text = f"""
 🔧 <b>Административная статистика</b>
 
@@ -686,7 +4286,7 @@ async def stats_command(message: types.Message):
     await message.answer(text, parse_mode="HTML")
 
 
-@dp.message(Command("mystickers"))
+@router.message(Command("mystickers"))
 async def mystickers_command(message: types.Message):
 
     """Команда для показа стикеров пользователя"""
@@ -695,8 +4295,36 @@ async def mystickers_command(message: types.Message):
     await show_user_stickers(message)
 
 
+@router.inline_query()
+async def inline_search(inline_query: types.InlineQuery):
+    """Inline-поиск стикеров: @bot запрос"""
+    query = inline_query.query.lower().strip()
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+
+    # Пока индекс загружается, результаты неполные - их не кэшируем
+    ready = db.ready.is_set()
+    with metrics.timer("stickerbot_inline_seconds", stage="search"):
+        results = inline_cache.get(query)
+        if results is None:
+            results = await async_db.search_stickers(query, INLINE_MAX_RESULTS)
+            if ready:
+                inline_cache.set(query, results)
+
+    page = results[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = offset + INLINE_PAGE_SIZE
+    await inline_query.answer(
+        [
+            types.InlineQueryResultCachedSticker(id=str(offset + i), sticker_file_id=sticker_id)
+            for i, (sticker_id, _) in enumerate(page)
+        ],
+        cache_time=INLINE_CACHE_TIME if ready else 0,
+        is_personal=False,
+        next_offset=str(next_offset) if next_offset < len(results) else ""
+    )
+
+
 # Обработка ошибок
-@dp.error()
+@router.error()
 async def error_handler(event, exception):
     if event.chat.type != "private":
         return
@@ -716,32 +4344,432 @@ async def error_handler(event, exception):
     return True
 
 
+# Очередь обновлений по чатам
+class ChatQueue:
+    """Очередь обновлений, в которой чат занимает не более одного обработчика
+
+    Обновления чата выполняются по порядку; чаты с ожидающими обновлениями
+    обслуживаются по кругу, так что завал в одном чате (например, ожидание
+    лимита отправки) не занимает обработчики остальных чатов.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        # Чат -> его ожидающие обновления; чат остаётся здесь, пока обрабатывается
+        self.chats: Dict[int, deque] = {}
+        # Чаты, готовые к обработке
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.size = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._space = asyncio.Event()
+        self._space.set()
+
+    def qsize(self) -> int:
+        return self.size
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.size
+
+    def put_nowait(self, key: int, item):
+        if self.full():
+            raise asyncio.QueueFull
+        pending = self.chats.get(key)
+        if pending is None:
+            pending = self.chats[key] = deque()
+            self.ready.put_nowait(key)
+        pending.append(item)
+        self.size += 1
+        self._idle.clear()
+        if self.full():
+            self._space.clear()
+
+    async def put(self, key: int, item):
+        """Постановка с ожиданием места в очереди"""
+        while self.full():
+            await self._space.wait()
+        self.put_nowait(key, item)
+
+    async def get(self) -> Tuple[int, Any]:
+        """Следующее обновление чата, который сейчас никто не обрабатывает"""
+        key = await self.ready.get()
+        return key, self.chats[key].popleft()
+
+    def task_done(self, key: int):
+        """Обработка обновления чата закончена: чат снова в очередь или удаляется"""
+        self.size -= 1
+        if self.chats[key]:
+            self.ready.put_nowait(key)
+        else:
+            del self.chats[key]
+        if not self.full():
+            self._space.set()
+        if not self.size:
+            self._idle.set()
+
+    async def join(self):
+        await self._idle.wait()
+
+
+# Приём обновлений через webhook
+class WebhookServer:
+    """Встроенный aiohttp-сервер для webhook с ограниченным пулом обработчиков
+
+    Обновления одного чата обрабатываются по порядку и занимают не более одного обработчика.
+    """
+
+    def __init__(
+            self,
+            bot: Bot,
+            dispatcher: Dispatcher,
+            path: str = WEBHOOK_PATH,
+            secret: str = WEBHOOK_SECRET,
+            host: str = WEBAPP_HOST,
+            port: int = WEBAPP_PORT,
+            workers: int = WEBHOOK_WORKERS,
+            queue_size: int = WEBHOOK_QUEUE_SIZE
+    ):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.queue = ChatQueue(maxsize=queue_size)
+        self._runner: Optional[web.AppRunner] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Приём обновления: проверка секрета и постановка в очередь"""
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=401)
+
+        try:
+            raw = await request.json()
+            update = types.Update.model_validate(raw, context={"bot": self.bot})
+        except Exception as e:
+            logger.error(f"Invalid webhook update: {e}")
+            return web.Response(status=400)
+
+        try:
+            self.queue.put_nowait(update_shard_key(raw), update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            chat_id, update = await self.queue.get()
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self.queue.task_done(chat_id)
+
+    async def start(self):
+        """Запуск HTTP-сервера и обработчиков"""
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        metrics.register("stickerbot_webhook", lambda: {'queued': self.queue.qsize()})
+        logger.info(f"🌐 Webhook-сервер слушает {self.host}:{self.port}{self.path}")
+
+    async def stop(self, timeout: float = 10):
+        """Остановка приёма и обработка уже принятых обновлений"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не обработано обновлений при остановке: {self.queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+async def wait_for_shutdown():
+    """Ожидание SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+
+
+async def run_webhook(bot: Bot, dispatcher, workers: int = WEBHOOK_WORKERS):
+    """Работа в режиме webhook до сигнала остановки"""
+    server = WebhookServer(bot, dispatcher, workers=workers)
+    await server.start()
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        drop_pending_updates=True
+    )
+    try:
+        await wait_for_shutdown()
+    finally:
+        await server.stop()
+
+
+def update_shard_key(update: Dict) -> int:
+    """Ключ шардирования обновления: id чата, иначе id пользователя"""
+    for event in update.values():
+        if not isinstance(event, dict):
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = event.get('from')
+        if user:
+            return user['id']
+    return update.get('update_id', 0)
+
+
+# Супервизор: получение обновлений и раздача процессам-обработчикам
+class UpdateSupervisor:
+    """Распределение обновлений по процессам по хэшу чата"""
+
+    def __init__(self, workers: int = BOT_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(workers)]
+        # Номера процессов, готовых принимать обновления
+        self.ready = context.Queue()
+        self.processes = [
+            context.Process(
+                target=run_worker,
+                args=(number, workers, update_queue, self.ready),
+                name=f"sticker-worker-{number}"
+            )
+            for number, update_queue in enumerate(self.queues)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info(f"👷 Запущено процессов-обработчиков: {len(self.processes)}")
+
+    async def wait_ready(self, timeout: float = 120):
+        """Ожидание готовности всех процессов: до этого обновления копились бы в их очередях"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        for _ in self.processes:
+            remaining = max(0.0, timeout - (time.perf_counter() - started))
+            try:
+                await loop.run_in_executor(None, self.ready.get, True, remaining)
+            except queue.Empty:
+                logger.warning(f"Процессы-обработчики не готовы за {timeout:.0f} с, начинаем приём")
+                return
+        logger.info(f"👷 Процессы-обработчики готовы за {time.perf_counter() - started:.2f} с")
+
+    async def feed_update(self, bot: Bot, update: types.Update):
+        """Передача обновления процессу его чата (интерфейс как у Dispatcher)"""
+        raw = update.model_dump(mode='json', by_alias=True, exclude_none=True)
+        update_queue = self.queues[update_shard_key(raw) % len(self.queues)]
+        # put_nowait из одной корутины сохраняет порядок обновлений чата
+        while True:
+            try:
+                update_queue.put_nowait(raw)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.01)
+
+    async def poll(self, bot: Bot, dispatcher: Dispatcher):
+        """Long polling с раздачей обновлений процессам"""
+        offset = None
+        allowed_updates = dispatcher.resolve_used_update_types()
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except Exception as e:
+                logger.error(f"Error getting updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.feed_update(bot, update)
+                offset = update.update_id + 1
+
+    def stop(self, timeout: float = 30):
+        """Остановка обработчиков после обработки очередей"""
+        for update_queue in self.queues:
+            update_queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+async def run_supervisor(bot: Bot, dispatcher: Dispatcher):
+    """Режим нескольких процессов: приём здесь, обработка в воркерах"""
+    supervisor = UpdateSupervisor()
+    supervisor.start()
+    try:
+        await supervisor.wait_ready()
+        if BOT_MODE == "webhook":
+            # Один обработчик webhook-очереди сохраняет порядок обновлений
+            await run_webhook(bot, supervisor, workers=1)
+        else:
+            polling = asyncio.create_task(supervisor.poll(bot, dispatcher))
+            try:
+                await wait_for_shutdown()
+            finally:
+                polling.cancel()
+    finally:
+        await asyncio.get_running_loop().run_in_executor(None, supervisor.stop)
+
+
+def run_worker(number: int, workers: int, updates, ready=None):
+    """Точка входа процесса-обработчика"""
+    # Сигналы обрабатывает супервизор, воркер завершается по None в очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_main(number, workers, updates, ready))
+
+
+async def worker_main(number: int, workers: int, updates, ready=None):
+    """Обработка обновлений своей доли чатов"""
+    # Глобальный лимит Bot API делится между процессами
+    rate = outbound.global_bucket.rate / workers
+    outbound.global_bucket = TokenBucket(rate, rate)
+    bot = create_bot()
+    dispatcher = create_dispatcher()
+
+    usage_logger.start()
+    warm_up = asyncio.create_task(warm_up_index())
+    await storage.start()
+    metrics_server = MetricsServer(metrics, port=METRICS_PORT + number + 1) if METRICS_PORT else None
+    if metrics_server:
+        await metrics_server.start()
+
+    loop = asyncio.get_running_loop()
+    # Чат занимает один обработчик, пока у него есть обновления: порядок сохраняется,
+    # а ожидающие своей очереди обновления не отнимают обработчики у других чатов
+    chat_queue = ChatQueue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+    async def process():
+        while True:
+            chat_id, raw = await chat_queue.get()
+            try:
+                await dispatcher.feed_raw_update(bot, raw)
+            except Exception as e:
+                logger.error(f"Error processing update {raw.get('update_id')}: {e}")
+            finally:
+                chat_queue.task_done(chat_id)
+
+    handlers = [asyncio.create_task(process()) for _ in range(WORKER_CONCURRENCY)]
+    logger.info(f"Процесс-обработчик {number} готов")
+    if ready is not None:
+        ready.put(number)
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, updates.get)
+            if raw is None:
+                break
+            await chat_queue.put(update_shard_key(raw), raw)
+        await chat_queue.join()
+    finally:
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        warm_up.cancel()
+        if metrics_server:
+            await metrics_server.stop()
+        await index_sync.stop()
+        # Индексы процессов одинаковы - снимок сохраняет первый
+        if number == 0:
+            await save_index_snapshot()
+        await storage.close()
+        await usage_logger.stop()
+        await bot.session.close()
+        async_db.close()
+
+
+BOT_COMMANDS = [
+    types.BotCommand(command="start", description="🚀 Начать работу с ботом"),
+    types.BotCommand(command="help", description="❓ Помощь и инструкции"),
+    types.BotCommand(command="mystickers", description="📋 Мои стикеры"),
+    types.BotCommand(command="add", description="➕ Ассоциации для стикера (ответом на стикер)"),
+    types.BotCommand(command="stats", description="📊 Статистика")
+]
+
+
+async def sync_bot_commands(bot: Bot, bot_id: int):
+    """set_my_commands, только если список команд изменился с прошлого запуска"""
+    payload = json.dumps([command.model_dump() for command in BOT_COMMANDS], ensure_ascii=False, sort_keys=True)
+    digest = hashlib.sha256(payload.encode()).hexdigest()
+    key = f"bot_commands:{bot_id}"
+    if await async_db.get_setting(key) == digest:
+        logger.info("Команды бота не изменились")
+        return
+    await bot.set_my_commands(BOT_COMMANDS)
+    await async_db.set_setting(key, digest)
+    logger.info("Команды бота обновлены")
+
+
+async def warm_up_index():
+    """Фоновая загрузка индекса ассоциаций; до её окончания поиск идёт запросами к базе"""
+    try:
+        with startup.stage("index"):
+            source = await asyncio.get_running_loop().run_in_executor(None, db.warm_up)
+        logger.info(f"🔥 Индекс ассоциаций готов (источник: {source})")
+        index_sync.start()
+    except Exception as e:
+        logger.error(f"Error warming up index: {e}")
+
+
+async def save_index_snapshot():
+    """Снимок индекса для быстрого следующего запуска"""
+    if INDEX_SNAPSHOT_PATH and db.ready.is_set():
+        await asyncio.get_running_loop().run_in_executor(None, db.save_snapshot, INDEX_SNAPSHOT_PATH)
+
+
 async def main():
     """Основная функция запуска бота"""
     # Проверка токена
-    if API_TOKEN == '123' or len(API_TOKEN) < 10:
+    if not API_TOKEN or API_TOKEN == '123' or len(API_TOKEN) < 10:
         logger.error("❌ ОШИБКА: Не установлен правильный токен бота!")
         logger.error("📝 Получите токен у @BotFather в Telegram")
         logger.error("🔧 Замените API_TOKEN = '123' на ваш реальный токен")
         return
 
     logger.info("🚀 Запуск StickerBot...")
+    bot = create_bot()
+    dispatcher = create_dispatcher()
+    # В режиме супервизора поиском занимаются процессы-обработчики - индекс здесь не нужен
+    warm_up = asyncio.create_task(warm_up_index()) if BOT_WORKERS <= 1 else None
+    usage_logger.start()
+    usage_retention.start()
+    await storage.start()
+    metrics_server = MetricsServer(metrics) if METRICS_PORT else None
 
     try:
+        if metrics_server:
+            await metrics_server.start()
+
         # Проверка токена
-        bot_info = await bot.get_me()
+        with startup.stage("auth"):
+            bot_info = await bot.get_me()
         logger.info(f"✅ Бот авторизован: @{bot_info.username}")
 
         # Установка команд бота
-        await bot.set_my_commands([
-            types.BotCommand(command="start", description="🚀 Начать работу с ботом"),
-            types.BotCommand(command="help", description="❓ Помощь и инструкции"),
-            types.BotCommand(command="mystickers", description="📋 Мои стикеры"),
-            types.BotCommand(command="stats", description="📊 Статистика")
-        ])
-
-        logger.info("🎯 Бот готов к работе!")
-        await dp.start_polling(bot, skip_updates=True)
+        with startup.stage("commands"):
+            await sync_bot_commands(bot, bot_info.id)
+        sticker_validator.start(bot)
+
+        logger.info(f"🎯 Бот готов к работе! Запуск: {startup.elapsed():.2f} с")
+        if BOT_WORKERS > 1:
+            await run_supervisor(bot, dispatcher)
+        elif BOT_MODE == "webhook":
+            await run_webhook(bot, dispatcher)
+        else:
+            await dispatcher.start_polling(bot, skip_updates=True)
 
     except Exception as e:
         if "Unauthorized" in str(e):
@@ -752,12 +4780,69 @@ async def main():
         else:
             logger.error(f"❌ Ошибка запуска бота: {e}")
     finally:
+        if warm_up is not None:
+            warm_up.cancel()
+        if metrics_server:
+            await metrics_server.stop()
+        await usage_retention.stop()
+        await sticker_validator.stop()
+        await index_sync.stop()
+        await save_index_snapshot()
+        await storage.close()
+        await usage_logger.stop()
         await bot.session.close()
+        async_db.close()
+
+
+def run_cli(argv: List[str]) -> int:
+    """Импорт и экспорт ассоциаций и обслуживание базы из командной строки"""
+    parser = argparse.ArgumentParser(
+        prog="main.py",
+        description="Импорт и экспорт ассоциаций (JSONL или CSV), обслуживание базы"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="загрузить файл в базу")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--user-id", type=int, default=0, help="user_id для строк без него")
+    export_parser = commands.add_parser("export", help="выгрузить все ассоциации в файл")
+    export_parser.add_argument("path")
+    commands.add_parser("vacuum", help="перевести базу в auto_vacuum=INCREMENTAL (бот должен быть остановлен)")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "import":
+            def progress(stats: Dict):
+                print(
+                    f"\rстрок: {stats['rows']}, добавлено: {stats['inserted']}, {stats['rows_per_sec']:.0f} строк/с",
+                    end="", file=sys.stderr, flush=True
+                )
+
+            result = db.import_file(args.path, args.user_id, progress, update_index=False)
+        elif args.command == "vacuum":
+            started = time.perf_counter()
+            result = {'converted': db.enable_incremental_vacuum(), 'elapsed': time.perf_counter() - started}
+        else:
+            started = time.perf_counter()
+            count = db.export_file(
+                args.path,
+                lambda count: print(f"\rстрок: {count}", end="", file=sys.stderr, flush=True)
+            )
+            elapsed = max(time.perf_counter() - started, 1e-6)
+            result = {'rows': count, 'elapsed': elapsed, 'rows_per_sec': count / elapsed}
+        print(file=sys.stderr)
+        print(json.dumps(result, ensure_ascii=False))
+        return 0
+    finally:
+        async_db.close()
 
 
 if __name__ == '__main__':
+    # python main.py import|export <файл>, python main.py vacuum
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+
     # Инструкция по получению токена
-    if API_TOKEN == '123':
+    if not API_TOKEN or API_TOKEN == '123':
         print("=" * 60)
         print("⚠️  ВНИМАНИЕ: Токен бота не настроен!")
         print("=" * 60)
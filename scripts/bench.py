@@ -0,0 +1,455 @@
+"""Бенчмарк поиска, записи и статистики на синтетических данных
+
+Генерирует базу с sticker_associations/usage_stats нужного размера
+(русские и английские ассоциации с распределением Ципфа), прогоняет
+методы StickerDatabase (включая inline-поиск) и хендлер search_sticker с фейковой сессией Bot API
+и печатает пропускную способность и p50/p99 в JSON. Сеть не нужна.
+
+    python scripts/bench.py --rows 10k --out before.json
+    python scripts/bench.py --rows 1m --baseline before.json
+
+Сгенерированные базы кэшируются в --data-dir и переиспользуются между
+прогонами с тем же --rows/--seed; каждый прогон работает на копии.
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+from fake_telegram import FakeTelegramAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456789:AAFakeTokenForLocalLoadTesting000000"
+SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+
+RU_WORDS = [
+    "привет", "пока", "кот", "котик", "ахаха", "лол", "грусть", "печаль", "радость", "ура",
+    "спасибо", "да", "нет", "ок", "окей", "блин", "жесть", "капец", "огонь", "класс",
+    "люблю", "обнимаю", "доброе утро", "спокойной ночи", "мяу", "гав", "ору", "плачу", "злой", "устал",
+    "работа", "пятница", "понедельник", "кофе", "чай", "пицца", "еда", "сон", "деньги", "котлета",
+    "бесит", "красота", "шок", "страшно", "смешно", "круто", "норм", "фу", "эх", "вау",
+]
+EN_WORDS = [
+    "hello", "hi", "bye", "lol", "cat", "dog", "sad", "happy", "yes", "no",
+    "ok", "wow", "omg", "love", "thanks", "coffee", "pizza", "friday", "monday", "sleep",
+    "fire", "nice", "cool", "angry", "tired", "hug", "good morning", "good night", "meme", "bruh",
+]
+RU_SYLLABLES = ["ка", "ло", "ми", "ра", "то", "ше", "ну", "ба", "за", "ви", "ко", "да", "ры", "жу", "пе"]
+EN_SYLLABLES = ["ka", "lo", "mi", "ra", "to", "she", "nu", "ba", "za", "vi", "ko", "da", "ry", "pe"]
+FILLER = ["ну", "да", "это", "что", "там", "вообще", "короче", "so", "the", "just"]
+
+
+def parse_size(value: str) -> int:
+    value = value.lower()
+    return SIZES[value] if value in SIZES else int(value)
+
+
+class Vocabulary:
+    """Словарь слов с весами Ципфа: реальные слова частые, сгенерированные - хвост"""
+
+    def __init__(self, rng: random.Random, size: int, ru_share: float = 0.75):
+        words = list(dict.fromkeys(RU_WORDS + EN_WORDS))
+        seen = set(words)
+        while len(words) < size:
+            syllables = RU_SYLLABLES if rng.random() < ru_share else EN_SYLLABLES
+            word = "".join(rng.choices(syllables, k=rng.randint(2, 4)))
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        self.words = words
+        self.cum_weights = list(itertools.accumulate(1 / rank ** 1.1 for rank in range(1, len(words) + 1)))
+
+    def word(self, rng: random.Random) -> str:
+        return self.words[bisect.bisect(self.cum_weights, rng.random() * self.cum_weights[-1])]
+
+    def phrase(self, rng: random.Random) -> str:
+        roll = rng.random()
+        count = 1 if roll < 0.7 else 2 if roll < 0.95 else 3
+        return " ".join(self.word(rng) for _ in range(count))
+
+
+def zipf_index(rng: random.Random, n: int, s: float = 1.2) -> int:
+    """Индекс 0..n-1 с приблизительно степенным распределением"""
+    return min(n - 1, int(n * rng.random() ** (1 + s * 2)))
+
+
+def sticker_id(number: int) -> str:
+    return f"CAACAgIAAxkBAAE{number:012d}AAFake"
+
+
+def generate_dataset(path: str, rows: int, usage_rows: int, seed: int):
+    """Создание схемы через StickerDatabase и заполнение синтетическими данными"""
+    # Выполняется в отдельном процессе: импорт main открывает базу из DATABASE_PATH
+    os.environ.setdefault("TOKEN", TOKEN)
+    os.environ["DATABASE_PATH"] = path
+    sys.path.insert(0, ROOT)
+    import main
+
+    main.async_db.close()
+
+    rng = random.Random(seed)
+    vocabulary = Vocabulary(rng, max(1000, rows // 20))
+    stickers = max(1, rows // 3)
+    users = max(1, rows // 20)
+    started = datetime.now() - timedelta(days=90)
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    batch_size = 50_000
+
+    inserted = 0
+    while inserted < rows:
+        batch = []
+        for _ in range(min(batch_size, rows - inserted)):
+            created_at = started + timedelta(seconds=rng.randint(0, 90 * 86400))
+            batch.append((
+                zipf_index(rng, users) + 1,
+                sticker_id(zipf_index(rng, stickers)),
+                vocabulary.phrase(rng),
+                created_at.strftime("%Y-%m-%d %H:%M:%S")
+            ))
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO stickers (file_id) VALUES (?)", [(row[1],) for row in batch])
+            conn.executemany(
+                "INSERT OR IGNORE INTO sticker_associations (user_id, sticker_ref, association, created_at) "
+                "SELECT ?, id, ?, ? FROM stickers WHERE file_id = ?",
+                [(user_id, association, created_at, sticker) for user_id, sticker, association, created_at in batch]
+            )
+        inserted += len(batch)
+        print(f"\rsticker_associations: {inserted}/{rows}", end="", file=sys.stderr)
+    print(file=sys.stderr)
+
+    associations = [row for row in conn.execute(
+        "SELECT a.user_id, s.file_id, a.association FROM sticker_associations a JOIN stickers s ON s.id = a.sticker_ref"
+    )]
+    inserted = 0
+    while inserted < usage_rows:
+        batch = []
+        for _ in range(min(batch_size, usage_rows - inserted)):
+            user_id, sticker, association = associations[zipf_index(rng, len(associations))]
+            used_at = started + timedelta(seconds=rng.randint(0, 90 * 86400))
+            batch.append((user_id, sticker, association, used_at.strftime("%Y-%m-%d %H:%M:%S")))
+        with conn:
+            conn.executemany(
+                "INSERT INTO usage_stats (user_id, sticker_id, association, used_at) VALUES (?, ?, ?, ?)",
+                batch
+            )
+        inserted += len(batch)
+        print(f"\rusage_stats: {inserted}/{usage_rows}", end="", file=sys.stderr)
+    print(file=sys.stderr)
+
+    # Журнал изменений нужен только для синхронизации процессов
+    with conn:
+        conn.execute("DELETE FROM association_changes")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+    with open(path + ".json", "w") as meta:
+        json.dump({"rows": rows, "usage_rows": usage_rows, "seed": seed, "vocabulary": vocabulary.words}, meta)
+
+
+def dataset_path(args) -> str:
+    path = os.path.join(args.data_dir, f"bench-{args.rows}-{args.usage_rows}-{args.seed}.db")
+    if not os.path.exists(path + ".json"):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        print(f"Генерация набора данных {path}", file=sys.stderr)
+        started = time.perf_counter()
+        process = multiprocessing.get_context("spawn").Process(
+            target=generate_dataset, args=(path, args.rows, args.usage_rows, args.seed)
+        )
+        process.start()
+        process.join()
+        if process.exitcode:
+            raise SystemExit(f"Не удалось сгенерировать набор данных (код {process.exitcode})")
+        print(f"Готово за {time.perf_counter() - started:.1f} с", file=sys.stderr)
+    return path
+
+
+def summarize(latencies, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "ops": count,
+        "ops_per_sec": count / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p50_ms": latencies[int(count * 0.5)] * 1000,
+        "p99_ms": latencies[min(count - 1, int(count * 0.99))] * 1000,
+        "max_ms": latencies[-1] * 1000
+    }
+
+
+def measure(func, inputs, warmup: int = 50) -> dict:
+    for item in inputs[:warmup]:
+        func(*item)
+    latencies = []
+    started = time.perf_counter()
+    for item in inputs:
+        call_started = time.perf_counter()
+        func(*item)
+        latencies.append(time.perf_counter() - call_started)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+async def measure_async(func, inputs, warmup: int = 50) -> dict:
+    for item in inputs[:warmup]:
+        await func(*item)
+    latencies = []
+    started = time.perf_counter()
+    for item in inputs:
+        call_started = time.perf_counter()
+        await func(*item)
+        latencies.append(time.perf_counter() - call_started)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def make_fake_bot(main):
+    """Bot с сессией без сети: ответы фейкового Bot API проходят обычную валидацию"""
+    from aiogram.client.session.base import BaseSession
+
+    api = FakeTelegramAPI()
+
+    class FakeSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+
+        async def make_request(self, bot, method, timeout=None):
+            name = method.__api_method__
+            self.calls[name] += 1
+            content = json.dumps({"ok": True, "result": api.result(name, method.model_dump(exclude_none=True))})
+            return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return main.Bot(token=TOKEN, session=FakeSession())
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    chat_id = -1000000000 - user_id % 50
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": text
+        }
+    }
+
+
+async def run_benchmarks(args, main, meta: dict) -> dict:
+    rng = random.Random(args.seed + 1)
+    database = main.db
+
+    # Запуск: индекс из базы, затем из снимка, сохранённого при остановке
+    results = {}
+    snapshot_path = os.path.join(os.path.dirname(database.db_path), "index.snapshot")
+    started = time.perf_counter()
+    database.warm_up(None)
+    elapsed = time.perf_counter() - started
+    results["warm_up_database"] = summarize([elapsed], elapsed)
+    database.save_snapshot(snapshot_path)
+    started = time.perf_counter()
+    database.warm_up(snapshot_path)
+    elapsed = time.perf_counter() - started
+    results["warm_up_snapshot"] = summarize([elapsed], elapsed)
+
+    vocabulary = meta["vocabulary"]
+    conn = database.connections.reader()
+    users = [row[0] for row in conn.execute("SELECT user_id FROM user_refcounts ORDER BY associations DESC")]
+    associations = [row[0] for row in conn.execute("SELECT DISTINCT association FROM association_usage")]
+    if not associations:
+        associations = vocabulary[:100]
+
+    def query():
+        # Треть запросов - промахи по словам, которых нет в ассоциациях
+        if rng.random() < args.miss_ratio:
+            return "".join(rng.choices("абвгдежзиклмнопрстуфхцчшщэюя", k=8))
+        return rng.choice(associations)
+
+    def message_text():
+        words = rng.choices(FILLER, k=rng.randint(1, 8))
+        if rng.random() >= args.miss_ratio:
+            words.insert(rng.randint(0, len(words)), rng.choice(associations))
+        return " ".join(words)
+
+    ops = args.ops
+
+    results["get_sticker_by_association"] = measure(
+        database.get_sticker_by_association, [(query(),) for _ in range(ops)]
+    )
+    results["find_sticker"] = measure(database.find_sticker, [(message_text(),) for _ in range(ops)])
+    # Inline-режим: запросы приходят на каждое нажатие, поэтому берём префиксы ассоциаций
+    keystrokes = []
+    while len(keystrokes) < ops:
+        association = rng.choice(associations)
+        keystrokes.extend((association[:length],) for length in range(1, len(association) + 1))
+    results["search_stickers"] = measure(database.search_stickers, keystrokes[:ops])
+    results["get_user_associations"] = measure(
+        database.get_user_associations, [(users[zipf_index(rng, len(users))],) for _ in range(ops)]
+    )
+    results["get_stats"] = measure(database.get_stats, [() for _ in range(max(10, ops // 10))], warmup=5)
+    results["add_association"] = measure(
+        database.add_association,
+        [(rng.randint(1, 10 ** 9), f"BENCH_STICKER_{i}", f"bench {i} {rng.choice(vocabulary)}") for i in range(ops)],
+        warmup=0
+    )
+
+    # Полный путь хендлера: Update -> Dispatcher -> search_sticker -> Bot API
+    bot = make_fake_bot(main)
+    dispatcher = main.create_dispatcher()
+    main.usage_logger.start()
+    await main.storage.start()
+    update_ids = itertools.count(1)
+
+    async def feed(user_id: int, text: str):
+        update = main.types.Update.model_validate(message_update(next(update_ids), user_id, text), context={"bot": bot})
+        await dispatcher.feed_update(bot, update)
+
+    results["search_sticker"] = await measure_async(
+        feed, [(rng.randint(1, 10 ** 6), message_text()) for _ in range(ops)]
+    )
+    results["search_sticker"]["stickers_sent"] = bot.session.calls["sendSticker"]
+
+    await main.storage.close()
+    await main.usage_logger.stop()
+    return results
+
+
+def measure_index_memory(database, snapshot_path: str) -> dict:
+    """Память, занимаемая загруженным индексом ассоциаций, и размер его снимка"""
+    tracemalloc.start()
+    try:
+        # Старый индекс освобождается после замены, учитываются только новые блоки
+        database.load_index()
+        index_bytes = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    rows = sum(len(partition) for partition in database.partitions.values())
+    return {
+        "index_rows": rows,
+        "index_mb": index_bytes / 1e6,
+        "bytes_per_row": index_bytes / rows if rows else 0.0,
+        "snapshot_mb": os.path.getsize(snapshot_path) / 1e6 if os.path.exists(snapshot_path) else 0.0
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+
+def compare(results: dict, baseline: dict, memory: dict):
+    """Отношение к базовому прогону: >1 - быстрее (для памяти - меньше)"""
+    print(f"{'benchmark':<28} {'ops/s':>12} {'base':>12} {'speedup':>8} {'p99 ms':>9} {'base':>9}", file=sys.stderr)
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        speedup = result["ops_per_sec"] / base["ops_per_sec"] if base["ops_per_sec"] else 0.0
+        print(
+            f"{name:<28} {result['ops_per_sec']:>12.0f} {base['ops_per_sec']:>12.0f} {speedup:>8.2f} "
+            f"{result['p99_ms']:>9.3f} {base['p99_ms']:>9.3f}",
+            file=sys.stderr
+        )
+    base = baseline.get("memory", {})
+    for name in ("index_mb", "snapshot_mb"):
+        if base.get(name) and memory.get(name):
+            print(f"{name:<28} {memory[name]:>12.1f} {base[name]:>12.1f} {base[name] / memory[name]:>8.2f}", file=sys.stderr)
+
+
+def main_cli(args):
+    os.makedirs(args.data_dir, exist_ok=True)
+    source = dataset_path(args)
+    with open(source + ".json") as f:
+        meta = json.load(f)
+
+    # Прогон на копии, чтобы вставки не меняли закэшированный набор
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    db_path = os.path.join(workdir, "stickers.db")
+    shutil.copyfile(source, db_path)
+
+    os.environ.setdefault("TOKEN", TOKEN)
+    os.environ["DATABASE_PATH"] = db_path
+    # Замеры самого бота не нужны: меряем снаружи
+    os.environ.setdefault("METRICS_SAMPLE_RATE", "0")
+    sys.path.insert(0, ROOT)
+    import main
+
+    try:
+        results = asyncio.run(run_benchmarks(args, main, meta))
+        memory = measure_index_memory(main.db, os.path.join(workdir, "index.snapshot"))
+    finally:
+        main.async_db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "rows": args.rows,
+            "usage_rows": args.usage_rows,
+            "ops": args.ops,
+            "seed": args.seed,
+            "revision": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version
+        },
+        "results": results,
+        "memory": memory
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f), memory)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=parse_size, default="10k", help="ассоциаций: 10k, 1m, 10m или число")
+    parser.add_argument("--usage-rows", type=parse_size, default=None, help="записей usage_stats (по умолчанию = --rows)")
+    parser.add_argument("--ops", type=int, default=2000, help="операций на каждый бенчмарк")
+    parser.add_argument("--miss-ratio", type=float, default=0.3, help="доля запросов без совпадения")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "stickerbot-bench"))
+    parser.add_argument("--out", help="файл для JSON-результата")
+    parser.add_argument("--baseline", help="JSON предыдущего прогона для сравнения")
+    return parser
+
+
+if __name__ == "__main__":
+    cli_args = build_parser().parse_args()
+    if cli_args.usage_rows is None:
+        cli_args.usage_rows = cli_args.rows
+    main_cli(cli_args)
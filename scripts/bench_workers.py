@@ -0,0 +1,35 @@
+"""Бенчмарк масштабирования по числу процессов-обработчиков
+
+Прогоняет webhook_load для каждого значения BOT_WORKERS и печатает
+пропускную способность обработки в виде таблицы и JSON. Отсчёт начинается
+после готовности всех процессов; прирост возможен, только если ядер больше одного.
+
+    python scripts/bench_workers.py --bot-workers 1 2 4 --updates 5000
+"""
+import asyncio
+import json
+import os
+
+from webhook_load import build_parser, run_load
+
+
+async def run(args):
+    print(f"cpu cores: {os.cpu_count()}")
+    results = []
+    for bot_workers in args.bot_workers:
+        result = await run_load(args, bot_workers)
+        results.append(result)
+        print(f"workers={bot_workers:<3} processed {result['processed_per_sec']:8.0f} updates/s, "
+              f"accept p99 {result['accept_p99_ms']:.2f} ms "
+              f"({result['stickers_sent']}/{result['stickers_expected']} stickers)")
+
+    base = results[0]["processed_per_sec"]
+    for result in results:
+        result["speedup"] = result["processed_per_sec"] / base
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    parser.set_defaults(updates=5000, concurrency=100, bot_workers=[1, 2, 4])
+    asyncio.run(run(parser.parse_args()))
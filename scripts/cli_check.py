@@ -0,0 +1,95 @@
+"""Проверка: команды main.py import/export/vacuum работают без TOKEN
+
+Запускает main.py отдельным процессом на временной базе с окружением без
+TOKEN: импорт файла, экспорт обратно (JSONL и CSV) и перевод базы в
+auto_vacuum=INCREMENTAL. Каждая команда должна завершиться с кодом 0, а
+экспорт - вернуть импортированные записи.
+
+    python scripts/cli_check.py --rows 1000
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_main(env: dict, *args) -> dict:
+    """python main.py <args>; итог команды - JSON в последней строке stdout"""
+    process = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "main.py"), *args],
+        env=env, capture_output=True, text=True, timeout=300
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"main.py {' '.join(args)}: exit {process.returncode}\n{process.stderr[-2000:]}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def run_check(workdir: str, rows: int) -> bool:
+    env = {key: value for key, value in os.environ.items() if key != "TOKEN"}
+    env["DATABASE_PATH"] = os.path.join(workdir, "stickers.db")
+    env["INDEX_SNAPSHOT_PATH"] = ""
+    env["METRICS_SAMPLE_RATE"] = "0"
+
+    records = [
+        {"sticker_id": f"CLI_STICKER_{i % 97}", "association": f"ассоциация {i}", "user_id": i % 13, "scope": 0}
+        for i in range(rows)
+    ]
+    source = os.path.join(workdir, "source.jsonl")
+    with open(source, "w", encoding="utf-8") as file:
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    expected = {(r["sticker_id"], r["association"], r["user_id"]) for r in records}
+
+    ok = True
+    imported = run_main(env, "import", source)
+    print(f"import:  {imported}")
+    ok &= imported.get("inserted") == rows
+
+    exported_jsonl = os.path.join(workdir, "export.jsonl")
+    result = run_main(env, "export", exported_jsonl)
+    print(f"export:  {result}")
+    with open(exported_jsonl, encoding="utf-8") as file:
+        got = {(r["sticker_id"], r["association"], r["user_id"]) for r in map(json.loads, file)}
+    ok &= result.get("rows") == rows and got == expected
+
+    exported_csv = os.path.join(workdir, "export.csv")
+    result = run_main(env, "export", exported_csv)
+    with open(exported_csv, newline="", encoding="utf-8") as file:
+        got = {(r["sticker_id"], r["association"], int(r["user_id"])) for r in csv.DictReader(file)}
+    print(f"csv:     {result}")
+    ok &= result.get("rows") == rows and got == expected
+
+    result = run_main(env, "vacuum")
+    print(f"vacuum:  {result}")
+    ok &= "converted" in result
+
+    print("OK" if ok else "FAIL: CLI output differs from the imported records")
+    return ok
+
+
+def main_cli(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="cli-check-")
+    try:
+        ok = run_check(workdir, args.rows)
+    except RuntimeError as e:
+        print(f"FAIL: {e}")
+        ok = False
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if ok else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="записей в импортируемом файле")
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli(build_parser().parse_args()))
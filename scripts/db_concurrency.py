@@ -0,0 +1,97 @@
+"""Проверка: медленный запрос к базе не останавливает обработку других обновлений
+
+Запускает хендлеры на временной базе с фейковой сессией Bot API.
+find_sticker для одного сообщения подменяется блокирующим sleep (как долгое
+ожидание диска), и в это время в диспетчер подаются обновления из других чатов.
+Все они должны получить ответ раньше, чем вернётся медленный запрос.
+
+    python scripts/db_concurrency.py --delay 2 --updates 20
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bench import TOKEN, make_fake_bot, message_update
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SLOW_TEXT = "медленный запрос"
+MATCHING = ["привет", "кот", "ахаха", "hello"]
+
+
+async def run_check(main, delay: float, updates: int) -> bool:
+    database = main.db
+    for i, association in enumerate(MATCHING):
+        database.add_associations(1, f"FAKE_STICKER_{i}", [association])
+    database.add_associations(1, "FAKE_STICKER_SLOW", [SLOW_TEXT])
+
+    # Блокирующая задержка в потоке базы - как запрос, ждущий диск
+    find_sticker = database.find_sticker
+    slow_finished = []
+
+    def slow_find_sticker(text: str, scope: int = 0):
+        if text == SLOW_TEXT:
+            time.sleep(delay)
+            slow_finished.append(time.perf_counter())
+        return find_sticker(text, scope)
+
+    database.find_sticker = slow_find_sticker
+
+    bot = make_fake_bot(main)
+    dispatcher = main.create_dispatcher()
+    await main.storage.start()
+    update_ids = iter(range(1, updates + 2))
+    done = {}
+
+    async def feed(user_id: int, text: str):
+        update = main.types.Update.model_validate(message_update(next(update_ids), user_id, text), context={"bot": bot})
+        await dispatcher.feed_update(bot, update)
+        done[user_id] = time.perf_counter()
+
+    started = time.perf_counter()
+    slow = asyncio.create_task(feed(0, SLOW_TEXT))
+    # Медленный запрос уже занял поток базы
+    await asyncio.sleep(0.05)
+    await asyncio.gather(*(feed(user_id, MATCHING[user_id % len(MATCHING)]) for user_id in range(1, updates + 1)))
+    others_done = time.perf_counter()
+    await slow
+    await main.storage.close()
+
+    database.find_sticker = find_sticker
+    sent = bot.session.calls["sendSticker"]
+    print(f"slow query:     {slow_finished[0] - started:.3f} s")
+    print(f"other updates:  {len(done) - 1} handled in {others_done - started:.3f} s")
+    print(f"stickers sent:  {sent}")
+    ok = others_done < slow_finished[0] and sent == updates + 1
+    print("OK" if ok else "FAIL: updates waited for the slow query")
+    return ok
+
+
+def main_cli(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="db-concurrency-")
+    os.environ.setdefault("TOKEN", TOKEN)
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "stickers.db")
+    os.environ.setdefault("METRICS_SAMPLE_RATE", "0")
+    sys.path.insert(0, ROOT)
+    import main
+
+    try:
+        ok = asyncio.run(run_check(main, args.delay, args.updates))
+    finally:
+        main.async_db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if ok else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delay", type=float, default=2.0, help="длительность медленного запроса, с")
+    parser.add_argument("--updates", type=int, default=20, help="обновлений из других чатов")
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli(build_parser().parse_args()))
@@ -0,0 +1,99 @@
+"""Фейковый Telegram Bot API для локальных нагрузочных стендов
+
+Отвечает на любые методы Bot API успешным ответом и считает вызовы,
+поэтому бота можно гонять без реального Telegram:
+
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+"""
+import asyncio
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeTelegramAPI:
+    """Минимальный Bot API: getMe, send*/edit* и True для остальных методов"""
+
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 8081,
+            flood_every: int = 0,
+            retry_after: int = 1,
+            dead_file_ids=()
+    ):
+        self.host = host
+        self.port = port
+        # Каждый flood_every-й вызов send* отвечает 429 Too Many Requests
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        # file_id, на которые sendSticker и getFile отвечают 400 Bad Request
+        self.dead_file_ids = set(dead_file_ids)
+        self.calls = Counter()
+        self.events = {}
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def wait_for(self, method: str) -> asyncio.Event:
+        """Событие, которое выставится при первом вызове метода"""
+        return self.events.setdefault(method, asyncio.Event())
+
+    @staticmethod
+    def _message(data) -> dict:
+        chat_id = int(data.get("chat_id", 1))
+        return {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        }
+
+    def result(self, method: str, data):
+        """Результат вызова метода"""
+        name = method.lower()
+        if name == "getme":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if name.startswith("send") or name.startswith("edit"):
+            return self._message(data)
+        if name == "getfile":
+            return {"file_id": data.get("file_id"), "file_unique_id": "fake", "file_size": 1}
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] += 1
+        if method in self.events:
+            self.events[method].set()
+
+        if self.flood_every and method.startswith("send") and self.calls[method] % self.flood_every == 0:
+            self.calls["429"] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            })
+        if data.get("sticker", data.get("file_id")) in self.dead_file_ids:
+            self.calls["400"] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 400,
+                "description": "Bad Request: wrong file identifier/HTTP URL specified"
+            }, status=400)
+        return web.json_response({"ok": True, "result": self.result(method, data)})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
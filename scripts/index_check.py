@@ -0,0 +1,369 @@
+"""Рандомизированная проверка индекса ассоциаций против перебора
+
+На временной базе выполняются случайные добавления и удаления ассоциаций в
+нескольких scope (глобальные и двух чатов). После каждого шага ответы поиска
+сравниваются с перебором всех строк sticker_associations:
+
+- find_sticker экземпляра, который пишет (индекс обновляется сразу);
+- find_sticker второго экземпляра StickerDatabase, получающего изменения
+  через журнал (sync_index), как другой процесс;
+- find_sticker без индекса (запросы к SQLite до окончания загрузки);
+- исправление опечаток (FUZZY_MATCHING): correct_word каждого раздела против
+  ближайшего по расстоянию Дамерау-Левенштейна слова из всех ассоциаций
+  scope, find_sticker с опечатками, состояние индекса опечаток после
+  добавлений и удалений против построенного заново;
+- кэш поиска (LookupCache): одни и те же частые и ничего не находящие запросы
+  повторяются после каждого изменения, ответы из кэша должны совпадать с
+  перебором; маленький LOOKUP_CACHE_SIZE заставляет кэш вытеснять записи.
+
+    python scripts/index_check.py --rows 1500 --ops 400 --seed 1
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+
+from collections import Counter
+
+from bench import TOKEN, Vocabulary
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 0 - глобальные ассоциации, остальные - id чатов; -300 без своих ассоциаций
+SCOPES = (0, 0, -100, -200)
+SEARCH_SCOPES = (0, -100, -200, -300)
+# Слова с ё: опечатка е/ё исправляется нормализацией
+YO_WORDS = ["ёжик", "ёлка", "зелёный", "тёплый", "всё равно", "ещё раз"]
+
+
+def load_rows(database) -> list:
+    """Все ассоциации: (id, file_id, текст, scope)"""
+    return database.connections.reader().execute(
+        'SELECT a.id, s.file_id, a.association, a.scope FROM sticker_associations a '
+        'JOIN stickers s ON s.id = a.sticker_ref'
+    ).fetchall()
+
+
+def brute_lookup(rows: list, query: str, scope: int) -> tuple:
+    """Самая новая ассоциация scope, содержащая query: (id, file_id) или None"""
+    best = None
+    for row_id, file_id, association, row_scope in rows:
+        if row_scope == scope and query in association and (best is None or row_id > best[0]):
+            best = (row_id, file_id)
+    return best
+
+
+def brute_match(rows: list, text: str, scope: int) -> tuple:
+    """Совпадение в одном scope: весь текст, затем слова по порядку"""
+    for query in [text] + [word for word in re.findall(r'\b\w+\b', text) if len(word) >= 2]:
+        found = brute_lookup(rows, query, scope)
+        if found is not None:
+            return found[1], query
+    return None
+
+
+def brute_find(rows: list, text: str, scope: int) -> tuple:
+    """find_sticker перебором: сначала ассоциации чата, затем глобальные"""
+    text = text.lower().strip()
+    for search_scope in ([scope, 0] if scope else [0]):
+        found = brute_match(rows, text, search_scope)
+        if found is not None:
+            return found
+    return None
+
+
+def normalize(word: str) -> str:
+    return word.replace('ё', 'е')
+
+
+def osa_distance(a: str, b: str) -> int:
+    """Расстояние Дамерау-Левенштейна (OSA) без отсечек"""
+    d = [[i + j if i * j == 0 else 0 for j in range(len(b) + 1)] for i in range(len(a) + 1)]
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            d[i][j] = min(d[i - 1][j] + 1, d[i][j - 1] + 1, d[i - 1][j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d[i][j] = min(d[i][j], d[i - 2][j - 2] + 1)
+    return d[-1][-1]
+
+
+def brute_words(rows: list, scope: int, min_length: int) -> dict:
+    """Нормализованное слово -> Counter написаний по всем ассоциациям scope"""
+    words = {}
+    for _, _, association, row_scope in rows:
+        if row_scope != scope:
+            continue
+        for word in re.findall(r'\w+', association):
+            if len(word) >= min_length:
+                words.setdefault(normalize(word), Counter())[word] += 1
+    return words
+
+
+def brute_corrections(words: dict, word: str, max_distance: int) -> set:
+    """Допустимые исправления слова: написания ближайшего слова с наибольшим числом ассоциаций"""
+    normalized = normalize(word)
+    best = normalized if normalized in words else None
+    if best is None:
+        candidates = [
+            (osa_distance(normalized, candidate), -sum(spellings.values()), candidate)
+            for candidate, spellings in words.items()
+            if abs(len(candidate) - len(normalized)) <= max_distance
+        ]
+        candidates = [key for key in candidates if key[0] <= max_distance]
+        if not candidates:
+            return set()
+        best = min(candidates)[2]
+    top = max(words[best].values())
+    return {spelling for spelling, count in words[best].items() if count == top}
+
+
+class Workload:
+    """Случайные ассоциации и сообщения из общего словаря"""
+
+    def __init__(self, rng: random.Random, words: int):
+        self.rng = rng
+        self.words = Vocabulary(rng, words).words + YO_WORDS
+
+    def association(self) -> str:
+        return ' '.join(self.rng.choice(self.words) for _ in range(self.rng.randint(1, 3)))
+
+    def message(self, rows: list) -> str:
+        rng = self.rng
+        kind = rng.random()
+        if rows and kind < 0.3:
+            # Подстрока существующей ассоциации
+            text = rng.choice(rows)[2]
+            start = rng.randint(0, max(0, len(text) - 2))
+            return text[start:start + rng.randint(2, 10)]
+        if rows and kind < 0.4:
+            return rng.choice(rows)[2].upper()
+        # Сообщение из нескольких слов, часть - не из словаря
+        return ' '.join(
+            rng.choice(self.words) if rng.random() < 0.7 else f"zz{rng.randint(0, 99)}"
+            for _ in range(rng.randint(1, 5))
+        )
+
+    def typo(self, rows: list, min_length: int) -> str:
+        """Слово из ассоциаций с одной случайной правкой (или заменой е/ё)"""
+        rng = self.rng
+        words = [word for word in re.findall(r'\w+', rng.choice(rows)[2]) if len(word) >= min_length] if rows else []
+        word = rng.choice(words) if words else rng.choice(self.words)
+        i = rng.randrange(len(word))
+        letter = rng.choice('абвгдеёжзиклмнопрстуabcdefgh')
+        edit = rng.randrange(5)
+        if edit == 0:
+            return word[:i] + word[i + 1:]
+        if edit == 1:
+            return word[:i] + letter + word[i:]
+        if edit == 2:
+            return word[:i] + letter + word[i + 1:]
+        if edit == 3 and i + 1 < len(word):
+            return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+        return word.replace('е', 'ё') if 'е' in word else word.replace('ё', 'е')
+
+
+def mutate(database, workload: Workload, rng: random.Random, rows: list):
+    """Случайное добавление или удаление ассоциаций"""
+    if rows and rng.random() < 0.4:
+        row_id = rng.choice(rows)[0]
+        user_id = database.connections.reader().execute(
+            'SELECT user_id FROM sticker_associations WHERE id = ?', (row_id,)
+        ).fetchone()[0]
+        database.delete_association_by_id(user_id, row_id)
+    else:
+        database.add_associations(
+            rng.randint(1, 20),
+            f"CHECK_STICKER_{rng.randint(0, 199)}",
+            [workload.association() for _ in range(rng.randint(1, 3))],
+            rng.choice(SCOPES)
+        )
+
+
+def check_lookups(databases: dict, rows: list, messages: list) -> list:
+    """Расхождения find_sticker с перебором: (источник, scope, сообщение, ответ, ожидание)"""
+    mismatches = []
+    for text in messages:
+        for scope in SEARCH_SCOPES:
+            expected = brute_find(rows, text, scope)
+            for name, find in databases.items():
+                got = find(text, scope)
+                if got != expected:
+                    mismatches.append((name, scope, text, got, expected))
+    return mismatches
+
+
+def check_fuzzy(main, database, rows: list, typos: list) -> list:
+    """Расхождения исправления опечаток с перебором: (проверка, scope, текст, ответ, ожидание)"""
+    mismatches = []
+    min_length = main.FUZZY_MIN_LENGTH
+    words = {scope: brute_words(rows, scope, min_length) for scope in SEARCH_SCOPES}
+    for typo in typos:
+        if len(typo) < min_length:
+            continue
+        for scope in SEARCH_SCOPES:
+            partition = database.partitions.get(scope)
+            if partition is None:
+                continue
+            expected = brute_corrections(words[scope], typo, main.FUZZY_MAX_DISTANCE)
+            got = partition.fuzzy.correct_word(typo)
+            if got not in (expected or {None}):
+                mismatches.append(('correct_word', scope, typo, got, expected))
+
+    # Сообщение с опечаткой: точное совпадение, иначе исправленный текст в том же разделе
+    for typo in typos:
+        text = f"{typo} zz{len(typo)}"
+        for scope in SEARCH_SCOPES:
+            expected = brute_find(rows, text, scope) or fuzzy_find(database, rows, text, scope, min_length)
+            got = database.find_sticker(text, scope)
+            if got != expected:
+                mismatches.append(('find_sticker', scope, text, got, expected))
+    return mismatches
+
+
+def fuzzy_find(database, rows: list, text: str, scope: int, min_length: int) -> tuple:
+    """Совпадение текста с исправленными словами (исправления проверены check_fuzzy)"""
+    for search_scope in ([scope, 0] if scope else [0]):
+        partition = database.partitions.get(search_scope)
+        if partition is None:
+            continue
+
+        def correct(match) -> str:
+            word = match.group(0)
+            return (partition.fuzzy.correct_word(word) or word) if len(word) >= min_length else word
+
+        corrected = re.sub(r'\w+', correct, text)
+        if corrected != text:
+            found = brute_match(rows, corrected, search_scope)
+            if found is not None:
+                return found
+    return None
+
+
+def check_fuzzy_state(main, database) -> list:
+    """Индекс опечаток после добавлений и удалений совпадает с построенным заново"""
+    mismatches = []
+    for scope, partition in database.partitions.items():
+        rebuilt = main.FuzzyIndex(partition.index)
+        if partition.fuzzy.words != rebuilt.words or partition.fuzzy.deletes != rebuilt.deletes:
+            mismatches.append(('fuzzy state', scope, '', len(partition.fuzzy.words), len(rebuilt.words)))
+    return mismatches
+
+
+def check_cache(databases: dict, rows: list, queries: list) -> list:
+    """Расхождения get_sticker_by_association (через кэш поиска) с перебором"""
+    mismatches = []
+    for query in queries:
+        for scope in SEARCH_SCOPES:
+            expected = None
+            for search_scope in ([scope, 0] if scope else [0]):
+                found = brute_lookup(rows, query, search_scope)
+                if found is not None:
+                    expected = found[1]
+                    break
+            for name, database in databases.items():
+                got = database.get_sticker_by_association(query, scope)
+                if got != expected:
+                    mismatches.append((f'cache {name}', scope, query, got, expected))
+    return mismatches
+
+
+def sql_find(database):
+    """find_sticker так, как он работает до загрузки индекса"""
+    def find(text: str, scope: int):
+        database.ready.clear()
+        try:
+            return database.find_sticker(text, scope)
+        finally:
+            database.ready.set()
+    return find
+
+
+def run_check(main, path: str, args) -> bool:
+    rng = random.Random(args.seed)
+    workload = Workload(rng, args.words)
+    writer = main.StickerDatabase(path, fuzzy=False)
+    for _ in range(args.rows // 2):
+        writer.add_associations(
+            rng.randint(1, 20), f"CHECK_STICKER_{rng.randint(0, 199)}",
+            [workload.association(), workload.association()], rng.choice(SCOPES)
+        )
+    # Второй экземпляр загружает индекс из базы и дальше видит только журнал изменений
+    follower = main.StickerDatabase(path, fuzzy=False)
+    fuzzy = main.StickerDatabase(path, fuzzy=True)
+    databases = {'writer': writer.find_sticker, 'follower': follower.find_sticker, 'sql': sql_find(writer)}
+    # Частые запросы: слова и их части, плюс запросы без ответа
+    hot = rng.sample(workload.words, 20) + [word[:2] for word in rng.sample(workload.words, 10)]
+    hot += [f"zz{i}" for i in range(10)]
+
+    failures = []
+    for step in range(args.ops):
+        rows = load_rows(writer)
+        mutate(writer, workload, rng, rows)
+        follower.sync_index()
+        fuzzy.sync_index()
+        rows = load_rows(writer)
+        messages = [workload.message(rows) for _ in range(args.queries)]
+        failures += [(step,) + mismatch for mismatch in check_lookups(databases, rows, messages)]
+        typos = [workload.typo(rows, main.FUZZY_MIN_LENGTH) for _ in range(args.queries)]
+        failures += [(step,) + mismatch for mismatch in check_fuzzy(main, fuzzy, rows, typos)]
+        failures += [(step,) + mismatch for mismatch in check_cache({'writer': writer, 'follower': follower}, rows, hot)]
+        if step % 100 == 99:
+            failures += [(step,) + mismatch for mismatch in check_fuzzy_state(main, fuzzy)]
+        if len(failures) >= 10:
+            break
+
+    rows = load_rows(writer)
+    print(f"rows:        {len(rows)} in {len({row[3] for row in rows})} scopes after {args.ops} operations")
+    print(f"lookups:     {args.ops * args.queries * len(SEARCH_SCOPES)} per source ({', '.join(databases)})")
+    print(f"typos:       {args.ops * args.queries} words, {len(fuzzy.partitions)} fuzzy partitions")
+    for name, database in (('writer', writer), ('follower', follower)):
+        stats = database.lookup_cache.stats()
+        print(
+            f"cache {name + ':':<9} size {stats['size']}/{args.cache_size}, hit rate {stats['hit_rate']:.2f}, "
+            f"evictions {stats['evictions']}, invalidations {stats['invalidations']}"
+        )
+        if not (stats['hits'] and stats['evictions'] and stats['invalidations'] and stats['size'] <= args.cache_size):
+            failures.append((args.ops, f'cache {name}', 0, '', stats, 'hits, evictions and invalidations'))
+    for step, name, scope, text, got, expected in failures[:10]:
+        print(f"MISMATCH step {step} [{name}] scope {scope} {text!r}: {got} != {expected}")
+    writer.close()
+    follower.close()
+    fuzzy.close()
+    print("OK" if not failures else "FAIL: index answers differ from brute force")
+    return not failures
+
+
+def main_cli(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="index-check-")
+    os.environ.setdefault("TOKEN", TOKEN)
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "stickers.db")
+    os.environ["METRICS_SAMPLE_RATE"] = "0"
+    # Без бюджета времени: исправление не должно зависеть от загрузки машины
+    os.environ["FUZZY_BUDGET_MS"] = "60000"
+    os.environ["LOOKUP_CACHE_SIZE"] = str(args.cache_size)
+    sys.path.insert(0, ROOT)
+    import main
+
+    try:
+        ok = run_check(main, os.environ["DATABASE_PATH"], args)
+    finally:
+        main.async_db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if ok else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1500, help="ассоциаций в начальной базе")
+    parser.add_argument("--ops", type=int, default=400, help="случайных добавлений и удалений")
+    parser.add_argument("--queries", type=int, default=8, help="сообщений на проверку после каждой операции")
+    parser.add_argument("--words", type=int, default=300, help="размер словаря")
+    parser.add_argument("--cache-size", type=int, default=200, help="LOOKUP_CACHE_SIZE")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli(build_parser().parse_args()))
@@ -0,0 +1,217 @@
+"""Проверка OutboundScheduler: лимиты на чат и глобально, приоритеты, 429
+
+Запросы бота идут через OutboundScheduler в фейковую сессию Bot API, которая
+запоминает момент каждого вызова и по заданным текстам отвечает 429 с
+retry_after. Проверяется:
+
+- запросы в один чат не чаще chat_rate, другие чаты при этом не ждут;
+- все запросы вместе не чаще global_rate (после начального запаса);
+- ответы (sendMessage) обгоняют стикеры, ждущие токена чата и глобального;
+- после 429 запрос повторяется через retry_after, не задерживая другие чаты,
+  а после max_retries ошибка доходит до вызывающего.
+
+    python scripts/scheduler_check.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bench import TOKEN
+from fake_telegram import FakeTelegramAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Допуск на неточность таймеров event loop
+TOLERANCE = 0.9
+
+
+def make_bot(main, scheduler, retry_after: int = 1):
+    """Bot с сессией без сети: журнал вызовов и 429 для текстов из session.flood"""
+    from aiogram.client.session.base import BaseSession
+
+    api = FakeTelegramAPI()
+
+    class RecordingSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            # (момент, метод, чат, текст или стикер)
+            self.log = []
+            # текст -> сколько раз ответить 429
+            self.flood = {}
+
+        async def make_request(self, bot, method, timeout=None):
+            name = method.__api_method__
+            data = method.model_dump(exclude_none=True)
+            label = data.get("text", data.get("sticker"))
+            self.log.append((time.perf_counter(), name, data.get("chat_id"), label))
+            if self.flood.get(label, 0) > 0:
+                self.flood[label] -= 1
+                content = json.dumps({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after}
+                })
+                return self.check_response(bot=bot, method=method, status_code=429, content=content).result
+            content = json.dumps({"ok": True, "result": api.result(name, data)})
+            return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    bot = main.Bot(token=TOKEN, session=RecordingSession())
+    bot.session.middleware(scheduler)
+    return bot
+
+
+def report(name: str, ok: bool, details: str) -> bool:
+    print(f"{name + ':':<18}{'OK' if ok else 'FAIL'}  {details}")
+    return ok
+
+
+async def check_chat_rate(main, rate: float, count: int) -> bool:
+    scheduler = main.OutboundScheduler(global_rate=1000, chat_rate=rate, chat_burst=1, chat_backlog=1000)
+    bot = make_bot(main, scheduler)
+    started = time.perf_counter()
+    sends = [bot.send_message(1, f"chat-1 {i}") for i in range(count)]
+    other = asyncio.create_task(bot.send_message(2, "chat-2"))
+    await asyncio.gather(*sends, other)
+
+    times = [moment for moment, _, chat_id, _ in bot.session.log if chat_id == 1]
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    other_delay = next(moment for moment, _, chat_id, _ in bot.session.log if chat_id == 2) - started
+    ok = min(gaps) >= TOLERANCE / rate and other_delay < 1 / rate
+    return report(
+        "per-chat rate", ok,
+        f"{count} requests, min gap {min(gaps) * 1000:.0f} ms (limit {1000 / rate:.0f} ms), "
+        f"other chat after {other_delay * 1000:.0f} ms"
+    )
+
+
+async def check_global_rate(main, rate: float, count: int) -> bool:
+    scheduler = main.OutboundScheduler(global_rate=rate, chat_rate=1000, chat_burst=1000, chat_backlog=1000)
+    bot = make_bot(main, scheduler)
+    await asyncio.gather(*(bot.send_message(chat_id, "global") for chat_id in range(count)))
+
+    times = sorted(moment for moment, _, _, _ in bot.session.log)
+    # К моменту t отправлено не больше начального запаса (rate) и rate * t
+    excess = max(i + 1 - rate - (moment - times[0]) * rate / TOLERANCE for i, moment in enumerate(times))
+    elapsed = times[-1] - times[0]
+    ok = excess <= 0 and elapsed >= TOLERANCE * (count - rate) / rate
+    return report("global rate", ok, f"{count} requests to {count} chats in {elapsed:.2f} s (limit {rate:.0f}/s)")
+
+
+async def check_chat_priority(main) -> bool:
+    scheduler = main.OutboundScheduler(global_rate=1000, chat_rate=10, chat_burst=1, chat_backlog=1000)
+    bot = make_bot(main, scheduler)
+    # Первый ответ забирает токен чата, остальные встают в очередь: стикеры раньше ответов
+    tasks = [asyncio.create_task(bot.send_message(1, "first"))]
+    tasks += [asyncio.create_task(bot.send_sticker(1, f"STICKER_{i}")) for i in range(4)]
+    tasks += [asyncio.create_task(bot.send_message(1, f"reply {i}")) for i in range(3)]
+    await asyncio.gather(*tasks)
+
+    order = [label for _, _, _, label in bot.session.log]
+    expected = ["first"] + [f"reply {i}" for i in range(3)] + [f"STICKER_{i}" for i in range(4)]
+    return report("chat priority", order == expected, f"order {order}")
+
+
+async def check_global_priority(main, rate: float) -> bool:
+    scheduler = main.OutboundScheduler(global_rate=rate, chat_rate=1000, chat_burst=1000, chat_backlog=1000)
+    bot = make_bot(main, scheduler)
+    # Начальный запас глобальных токенов расходуется, дальше запросы ждут в очереди
+    burst = int(rate)
+    tasks = [asyncio.create_task(bot.send_message(100 + i, "burst")) for i in range(burst)]
+    tasks += [asyncio.create_task(bot.send_sticker(200 + i, f"STICKER_{i}")) for i in range(4)]
+    tasks += [asyncio.create_task(bot.send_message(300 + i, f"reply {i}")) for i in range(3)]
+    await asyncio.gather(*tasks)
+
+    order = [label for _, _, _, label in bot.session.log][burst:]
+    expected = [f"reply {i}" for i in range(3)] + [f"STICKER_{i}" for i in range(4)]
+    return report("global priority", order == expected, f"after burst {order}")
+
+
+async def check_retry_after(main, retry_after: int) -> bool:
+    scheduler = main.OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000, max_retries=2)
+    bot = make_bot(main, scheduler, retry_after)
+    bot.session.flood["flooded"] = 1
+
+    started = time.perf_counter()
+    flooded = asyncio.create_task(bot.send_message(1, "flooded"))
+    await asyncio.sleep(0.05)
+    other_started = time.perf_counter()
+    await bot.send_message(2, "other")
+    other_delay = time.perf_counter() - other_started
+    try:
+        await flooded
+    except main.TelegramRetryAfter:
+        pass
+    elapsed = time.perf_counter() - started
+    attempts = [moment for moment, _, _, label in bot.session.log if label == "flooded"]
+    ok = (
+        len(attempts) == 2 and attempts[1] - attempts[0] >= TOLERANCE * retry_after
+        and other_delay < retry_after / 2 and scheduler.retried == 1
+    )
+    ok = report(
+        "429 retry", ok,
+        f"{len(attempts)} attempts, retried after {attempts[-1] - attempts[0]:.2f} s "
+        f"(retry_after {retry_after} s), other chat after {other_delay * 1000:.0f} ms, total {elapsed:.2f} s"
+    )
+
+    # Лимит повторов исчерпан - TelegramRetryAfter доходит до хендлера
+    bot.session.flood["always"] = 100
+    try:
+        await bot.send_message(1, "always")
+        raised = False
+    except main.TelegramRetryAfter:
+        raised = True
+    attempts = sum(1 for _, _, _, label in bot.session.log if label == "always")
+    return report("429 give up", raised and attempts == 3, f"{attempts} attempts, error raised: {raised}") and ok
+
+
+async def run_checks(main, args) -> bool:
+    results = [
+        await check_chat_rate(main, args.chat_rate, args.requests),
+        await check_global_rate(main, args.global_rate, args.requests * 3),
+        await check_chat_priority(main),
+        await check_global_priority(main, args.global_rate),
+        await check_retry_after(main, args.retry_after)
+    ]
+    ok = all(results)
+    print("OK" if ok else "FAIL: scheduler limits or ordering violated")
+    return ok
+
+
+def main_cli(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="scheduler-check-")
+    os.environ.setdefault("TOKEN", TOKEN)
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "stickers.db")
+    os.environ.setdefault("METRICS_SAMPLE_RATE", "0")
+    sys.path.insert(0, ROOT)
+    import main
+
+    try:
+        ok = asyncio.run(run_checks(main, args))
+    finally:
+        main.async_db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if ok else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chat-rate", type=float, default=10, help="лимит запросов в один чат, в секунду")
+    parser.add_argument("--global-rate", type=float, default=20, help="глобальный лимит запросов, в секунду")
+    parser.add_argument("--requests", type=int, default=15, help="запросов в проверке лимита чата")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli(build_parser().parse_args()))
@@ -0,0 +1,181 @@
+"""Нагрузочный стенд для webhook-режима
+
+Поднимает фейковый Bot API, запускает main.py в режиме webhook на
+временной базе и отправляет ему синтетические обновления Telegram.
+Печатает пропускную способность приёма и обработки обновлений.
+
+    python scripts/webhook_load.py --updates 5000 --concurrency 100
+"""
+import argparse
+import asyncio
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from fake_telegram import FakeTelegramAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456789:AAFakeTokenForLocalLoadTesting000000"
+SECRET = "load-test-secret"
+MATCHING = ["привет", "кот", "ахаха", "hello", "грусть", "мяу"]
+OTHER = ["ну", "да", "это", "что", "там", "вообще", "погнали", "ok"]
+
+
+def seed_database(db_path: str):
+    """Наполнение временной базы ассоциациями"""
+    os.environ.setdefault("TOKEN", TOKEN)
+    os.environ["DATABASE_PATH"] = db_path
+    sys.path.insert(0, ROOT)
+    import main
+
+    database = main.StickerDatabase(db_path)
+    for i, association in enumerate(MATCHING):
+        database.add_associations(1, f"FAKE_STICKER_{i}", [association])
+    database.close()
+
+
+def make_update(update_id: int, matching: bool) -> dict:
+    words = random.choices(OTHER, k=random.randint(1, 6))
+    if matching:
+        words.insert(random.randint(0, len(words)), random.choice(MATCHING))
+    chat_id = -1000000000 - random.randint(1, 50)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "load"},
+            "from": {"id": random.randint(1, 10000), "is_bot": False, "first_name": "user"},
+            "text": " ".join(words)
+        }
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def run_load(args, bot_workers: int = 1) -> dict:
+    """Один прогон: запуск бота, отправка обновлений, замер"""
+    api = FakeTelegramAPI(port=args.api_port)
+    await api.start()
+    # setWebhook отправляется, когда все процессы-обработчики готовы: отсчёт начинается после запуска
+    ready = api.wait_for("setWebhook")
+
+    workdir = tempfile.mkdtemp(prefix="webhook-load-")
+    db_path = os.path.join(workdir, "stickers.db")
+    seed_database(db_path)
+
+    env = dict(
+        os.environ,
+        TOKEN=TOKEN,
+        DATABASE_PATH=db_path,
+        TELEGRAM_API_URL=api.url,
+        BOT_MODE="webhook",
+        WEBHOOK_BASE_URL=f"http://127.0.0.1:{args.port}",
+        WEBHOOK_SECRET=SECRET,
+        WEBAPP_HOST="127.0.0.1",
+        WEBAPP_PORT=str(args.port),
+        WEBHOOK_WORKERS=str(args.workers),
+        BOT_WORKERS=str(bot_workers),
+        # Столько же обработчиков в каждом процессе, сколько в однопроцессном режиме:
+        # сравнение по числу процессов, а не по числу одновременных обработчиков
+        WORKER_CONCURRENCY=str(args.workers),
+        # Лимиты Bot API измеряются отдельно, здесь меряем обработку
+        OUTBOUND_GLOBAL_RATE="1000000",
+        OUTBOUND_CHAT_RATE="1000000",
+        OUTBOUND_CHAT_BURST="1000000",
+        OUTBOUND_CHAT_BACKLOG="1000000"
+    )
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], env=env, stdout=log, stderr=log)
+
+    try:
+        await asyncio.wait_for(ready.wait(), 120)
+
+        updates = [make_update(i, random.random() < args.match_ratio) for i in range(1, args.updates + 1)]
+        expected = sum(1 for update in updates if any(w in MATCHING for w in update["message"]["text"].split()))
+        url = f"http://127.0.0.1:{args.port}/webhook"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        latencies = []
+        statuses = {}
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async with aiohttp.ClientSession() as session:
+            async def post(update):
+                async with semaphore:
+                    # Как и Telegram, повторяем доставку при 503 от переполненной очереди - с паузой:
+                    # частые повторы сами съедают процессор бота и занижают результат
+                    while True:
+                        started = time.perf_counter()
+                        async with session.post(url, json=update, headers=headers) as response:
+                            await response.read()
+                            statuses[response.status] = statuses.get(response.status, 0) + 1
+                        latencies.append(time.perf_counter() - started)
+                        if response.status != 503:
+                            break
+                        await asyncio.sleep(0.5)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(post(update) for update in updates))
+            accepted_in = time.perf_counter() - started
+
+            # Ждём, пока бот отправит все стикеры
+            while api.calls["sendSticker"] < expected and time.perf_counter() - started < args.timeout:
+                await asyncio.sleep(0.01)
+            processed_in = time.perf_counter() - started
+
+        return {
+            "bot_workers": bot_workers,
+            "updates": len(updates),
+            "statuses": statuses,
+            "accepted_per_sec": len(updates) / accepted_in,
+            "accept_p50_ms": percentile(latencies, 0.5) * 1000,
+            "accept_p99_ms": percentile(latencies, 0.99) * 1000,
+            "processed_per_sec": len(updates) / processed_in,
+            "stickers_sent": api.calls["sendSticker"],
+            "stickers_expected": expected,
+            "bot_log": log.name
+        }
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        await api.stop()
+
+
+async def run(args):
+    result = await run_load(args, args.bot_workers[0])
+    print(f"updates:           {result['updates']} (statuses: {result['statuses']})")
+    print(f"accepted:          {result['accepted_per_sec']:.0f} updates/s")
+    print(f"accept latency:    p50 {result['accept_p50_ms']:.2f} ms, p99 {result['accept_p99_ms']:.2f} ms")
+    print(f"processed:         {result['processed_per_sec']:.0f} updates/s "
+          f"({result['stickers_sent']}/{result['stickers_expected']} stickers sent)")
+    print(f"bot log:           {result['bot_log']}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=16, help="обработчиков webhook-очереди")
+    parser.add_argument("--bot-workers", type=int, nargs="+", default=[1], help="процессов-обработчиков (BOT_WORKERS)")
+    parser.add_argument("--match-ratio", type=float, default=0.3)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--api-port", type=int, default=8091)
+    parser.add_argument("--timeout", type=float, default=60)
+    return parser
+
+
+if __name__ == "__main__":
+    asyncio.run(run(build_parser().parse_args()))